@@ -0,0 +1,356 @@
+import os
+import re
+import sqlite3
+import tempfile
+import numpy as np
+
+# Seconds in a year of round-the-clock crypto trading, for annualizing
+SECONDS_PER_YEAR = 365 * 24 * 60 * 60
+
+# Assets processed together by the per-asset strategies; bounds the size of
+# the (bars x assets) temporaries for long, wide histories
+COLUMN_BLOCK = 16
+
+
+# Price Loading
+def _cache_file(cache_dir, asset_name):
+    """Path of an asset's columnar cache file"""
+    safe_name = re.sub(r'[^A-Za-z0-9_.-]', '_', asset_name)
+    return os.path.join(cache_dir, f"{safe_name}.npz")
+
+def _fetch_series(cursor, asset_name, after=None):
+    """Read (unix timestamps, prices) for an asset from historical_prices, oldest first"""
+    query = """
+        SELECT CAST(strftime('%s', timestamp) AS INTEGER), price
+        FROM historical_prices WHERE asset_name = ?
+    """
+    params = [asset_name]
+    if after is not None:
+        query += " AND timestamp > datetime(?, 'unixepoch')"
+        params.append(after)
+    cursor.execute(query + " ORDER BY timestamp ASC", params)
+    rows = cursor.fetchall()
+    if not rows:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float64)
+    timestamps, prices = zip(*rows)
+    return np.array(timestamps, dtype=np.int64), np.array(prices, dtype=np.float64)
+
+# Order-sensitive sum over an asset's rows: changes when a price is rewritten
+# in place (INSERT OR REPLACE also gives the row a new rowid)
+CHECKSUM = "TOTAL(price * (rowid % 65521 + 1))"
+
+def load_series(cursor, asset_name, cache_dir=None):
+    """Return (timestamps, prices) for an asset, through the columnar cache when given
+
+    The cache keeps one .npz file of contiguous arrays per asset, with a
+    checksum of the rows it was built from. Prices are usually only
+    appended, so a file whose rows are unchanged is topped up with the
+    rows newer than its last timestamp instead of being rebuilt.
+    """
+    if not cache_dir:
+        return _fetch_series(cursor, asset_name)
+
+    cursor.execute(f"""
+        SELECT COUNT(*), CAST(strftime('%s', MAX(timestamp)) AS INTEGER), {CHECKSUM}
+        FROM historical_prices WHERE asset_name = ?
+    """, (asset_name,))
+    count, last, checksum = cursor.fetchone()
+    if count == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float64)
+
+    path = _cache_file(cache_dir, asset_name)
+    timestamps = prices = None
+    if os.path.exists(path):
+        with np.load(path) as cached:
+            if 'checksum' in cached:
+                timestamps, prices, cached_checksum = cached['timestamps'], cached['prices'], float(cached['checksum'])
+        if timestamps is not None and len(timestamps) == count and timestamps[-1] == last:
+            if cached_checksum == checksum:
+                return timestamps, prices
+            timestamps = None  # a price was rewritten in place
+
+    if timestamps is not None and 0 < len(timestamps) < count:
+        # Only append when the rows the file was built from are unchanged
+        cursor.execute(f"""
+            SELECT COUNT(*), {CHECKSUM} FROM historical_prices
+            WHERE asset_name = ? AND timestamp <= datetime(?, 'unixepoch')
+        """, (asset_name, int(timestamps[-1])))
+        if cursor.fetchone() == (len(timestamps), cached_checksum):
+            new_timestamps, new_prices = _fetch_series(cursor, asset_name, after=int(timestamps[-1]))
+            timestamps = np.concatenate([timestamps, new_timestamps])
+            prices = np.concatenate([prices, new_prices])
+    if timestamps is None or len(timestamps) != count:
+        # No usable cache (or history was rewritten): read the whole series
+        timestamps, prices = _fetch_series(cursor, asset_name)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    # A temp file of its own: threads and workers may rebuild the same asset at once
+    fd, temp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp.npz')
+    try:
+        with os.fdopen(fd, 'wb') as temp_file:
+            np.savez(temp_file, timestamps=timestamps, prices=prices, checksum=checksum)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+    return timestamps, prices
+
+def forward_fill(matrix):
+    """Fill NaNs in each column with the last earlier value (leading NaNs stay)"""
+    rows = np.arange(len(matrix))
+    for start in range(0, matrix.shape[1], COLUMN_BLOCK):
+        block = matrix[:, start:start + COLUMN_BLOCK]
+        last_seen = np.where(np.isnan(block), 0, rows[:, None])
+        np.maximum.accumulate(last_seen, axis=0, out=last_seen)
+        block[:] = np.take_along_axis(block, last_seen, axis=0)
+    return matrix
+
+def align_series(series):
+    """Pivot [(timestamps, prices)] onto one shared time axis, forward-filled
+
+    Returns (timestamps, bars x assets price matrix); an asset's bars
+    before its first observation are NaN. The matrix is column-major so
+    each asset's history is contiguous.
+    """
+    if not series:
+        return np.zeros(0, dtype=np.int64), np.zeros((0, 0))
+
+    # Assets are usually recorded on the same ticks: only merge (and sort)
+    # when a series has timestamps the shared axis does not
+    timestamps = np.unique(series[0][0])
+    for asset_timestamps, _ in series[1:]:
+        positions = np.searchsorted(timestamps, asset_timestamps)
+        found = positions < len(timestamps)
+        found[found] = timestamps[positions[found]] == asset_timestamps[found]
+        if not found.all():
+            timestamps = np.union1d(timestamps, asset_timestamps)
+
+    matrix = np.full((len(timestamps), len(series)), np.nan, order='F')
+    for column, (asset_timestamps, prices) in enumerate(series):
+        matrix[np.searchsorted(timestamps, asset_timestamps), column] = prices
+    return timestamps, forward_fill(matrix)
+
+def pivot_prices(columns, timestamps, prices, asset_count, grid):
+    """Sample observations onto a time grid, forward-filled, as a grid x assets matrix
+
+    Observations must be sorted by (column, timestamp). A single
+    searchsorted over the combined (column, timestamp) key finds every
+    asset's latest observation at or before every grid point; grid points
+    before an asset's first observation are NaN.
+    """
+    matrix_shape = (asset_count, len(grid))
+    if len(timestamps) == 0 or len(grid) == 0:
+        return np.full(matrix_shape, np.nan).T
+
+    base = min(int(timestamps.min()), int(grid.min()))
+    stride = max(int(timestamps.max()), int(grid.max())) - base + 1
+    keys = columns.astype(np.int64) * stride + (timestamps - base)
+    queries = (np.arange(asset_count, dtype=np.int64)[:, None] * stride + (grid - base)[None, :]).ravel()
+
+    found = np.searchsorted(keys, queries, side='right') - 1
+    owner = np.repeat(np.arange(asset_count), len(grid))
+    valid = found >= 0
+    valid[valid] = columns[found[valid]] == owner[valid]
+    values = np.where(valid, prices[np.maximum(found, 0)], np.nan)
+    # Asset-major values, so the transposed view is column-major (one column per asset)
+    return values.reshape(matrix_shape).T
+
+def load_prices(database_path, asset_names, cache_dir=None):
+    """Load aligned price history for several assets, see align_series()"""
+    with sqlite3.connect(database_path) as conn:
+        cursor = conn.cursor()
+        series = [load_series(cursor, asset_name, cache_dir) for asset_name in asset_names]
+    return align_series(series)
+
+
+# Strategies
+#
+# A strategy maps the (bars x assets) price matrix to target weights held
+# from the close of each bar to the close of the next. Per-asset strategies
+# are evaluated block by block and return a 0/1 signal per asset.
+def _window_sums(sums, window):
+    """Trailing sums over window bars per column, from running sums"""
+    windowed = sums.copy()
+    windowed[window:] -= sums[:-window]
+    return windowed
+
+def sma_crossover(prices, fast=20, slow=50):
+    """Long while the fast moving average is above the slow one
+
+    Expects forward-filled prices (see align_series), so an asset's
+    windows are complete from slow - 1 bars after its first price.
+    """
+    fast, slow = int(fast), int(slow)
+    if not 0 < fast < slow:
+        raise ValueError("sma_crossover requires 0 < fast < slow.")
+    observed = ~np.isnan(prices)
+    sums = np.cumsum(np.where(observed, prices, 0), axis=0)
+    # fast_sum / fast > slow_sum / slow, without the divisions
+    signal = _window_sums(sums, fast) * slow > _window_sums(sums, slow) * fast
+    first = observed.argmax(axis=0)
+    signal &= np.arange(len(prices))[:, None] >= first + slow - 1
+    return signal.astype(np.float64)
+
+def momentum(prices, lookback=20, threshold=0.0):
+    """Long while the return over the lookback window exceeds threshold"""
+    lookback, threshold = int(lookback), float(threshold)
+    if lookback <= 0:
+        raise ValueError("momentum requires lookback > 0.")
+    signal = np.zeros_like(prices)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        signal[lookback:] = prices[lookback:] / prices[:-lookback] - 1 > threshold
+    return signal
+
+PER_ASSET_STRATEGIES = {
+    'sma_crossover': sma_crossover,
+    'momentum': momentum,
+}
+
+
+# Engine
+def _per_asset_returns(prices, strategy, params, cost):
+    """Net per-bar returns of a per-asset strategy, one column per asset
+
+    The weight chosen at the close of bar t earns bar t + 1's return; a
+    change of weight at bar t pays cost (fees + slippage) on the traded
+    fraction at that bar.
+    """
+    returns = np.zeros_like(prices)
+    trades = np.zeros(prices.shape[1], dtype=np.int64)
+    for start in range(0, prices.shape[1], COLUMN_BLOCK):
+        block = prices[:, start:start + COLUMN_BLOCK]
+        weights = strategy(block, **params)
+        weights[np.isnan(block)] = 0
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            bar_returns = block[1:] / block[:-1] - 1
+        bar_returns[~np.isfinite(bar_returns)] = 0
+
+        turnover = np.abs(np.diff(weights, axis=0, prepend=0))
+        out = returns[:, start:start + COLUMN_BLOCK]
+        out[1:] = weights[:-1] * bar_returns
+        out -= cost * turnover
+        trades[start:start + COLUMN_BLOCK] = np.count_nonzero(turnover, axis=0)
+    return returns, trades
+
+def _rebalance_returns(prices, every):
+    """Net per-bar returns of an equal-weight portfolio rebalanced every N bars
+
+    Between rebalances the holdings drift with their prices: growth since
+    the last rebalance at bar s is sum_j w_j * P[t, j] / P[s, j], so the
+    whole path is computed without stepping through the bars.
+    """
+    bars, assets = prices.shape
+    every = int(every)
+    if every <= 0:
+        raise ValueError("rebalance requires every > 0.")
+
+    # Rebalance bars, the segment each bar belongs to and its target weights
+    starts = np.arange(0, bars, every)
+    segment = np.zeros(bars, dtype=np.int64)
+    segment[1:] = (np.arange(1, bars) - 1) // every
+    available = ~np.isnan(prices[starts])
+    counts = available.sum(axis=1, keepdims=True)
+    targets = np.divide(available, counts, out=np.zeros(available.shape), where=counts > 0)
+
+    # Growth of the portfolio since its last rebalance, block by block
+    growth = np.zeros(bars)
+    for start in range(0, assets, COLUMN_BLOCK):
+        columns = slice(start, start + COLUMN_BLOCK)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            relative = prices[:, columns] / prices[starts, columns][segment]
+        growth += np.nansum(relative * targets[segment, columns], axis=1)
+    growth[0] = 1
+    invested = counts[segment, 0] > 0
+    growth[~invested] = 1
+
+    # Per-bar return; the bar right after a rebalance starts from growth 1
+    previous = np.ones(bars)
+    previous[1:] = growth[:-1]
+    after_start = np.zeros(bars, dtype=bool)
+    after_start[starts[starts + 1 < bars] + 1] = True
+    previous[after_start] = 1
+    returns = np.zeros(bars)
+    returns[1:] = growth[1:] / previous[1:] - 1
+
+    # Turnover at each rebalance: drifted weights back to the targets
+    drifted = np.zeros_like(targets)
+    if len(starts) > 1:
+        with np.errstate(invalid='ignore', divide='ignore'):
+            relative = prices[starts[1:]] / prices[starts[:-1]]
+        drifted[1:] = np.nan_to_num(targets[:-1] * relative) / growth[starts[1:], None]
+    turnover = np.abs(targets - drifted).sum(axis=1)
+    return returns, starts, turnover
+
+def _finite(value):
+    """A metric as a float, or None when it is NaN or infinite (not valid JSON)"""
+    value = float(value)
+    return value if np.isfinite(value) else None
+
+def summarize(returns, bars_per_year):
+    """Total/annualized return, volatility, Sharpe ratio and max drawdown of a return series
+
+    A metric that is undefined for the series (NaN or infinite) is None.
+    """
+    with np.errstate(invalid='ignore', divide='ignore', over='ignore'):
+        equity = np.cumprod(1 + returns)
+        peaks = np.maximum.accumulate(equity)
+        drawdowns = equity / peaks - 1
+        bars = len(returns)
+        std = returns.std()
+        total_return = equity[-1] - 1 if bars else 0.0
+        return {
+            "total_return": _finite(total_return),
+            "annualized_return": _finite((1 + total_return) ** (bars_per_year / bars) - 1) if bars and total_return > -1 else -1.0,
+            "volatility": _finite(std * np.sqrt(bars_per_year)),
+            "sharpe_ratio": _finite(returns.mean() / std * np.sqrt(bars_per_year)) if std > 0 else 0.0,
+            "max_drawdown": _finite(drawdowns.min()) if bars else 0.0
+        }, equity
+
+def run_backtest(timestamps, prices, asset_names, strategy, params=None, fee=0.001, slippage=0.0005):
+    """Backtest a strategy over aligned prices (see load_prices)
+
+    Per-asset strategies split the capital equally across assets; the
+    'rebalance' strategy holds an equal-weight portfolio rebalanced every
+    ``params['every']`` bars. fee and slippage are fractions of the
+    traded value. Returns (summary, equity curve).
+    """
+    params = dict(params or {})
+    fee, slippage = float(fee), float(slippage)
+    if fee < 0 or slippage < 0:
+        raise ValueError("fee and slippage must not be negative.")
+    if len(timestamps) < 2:
+        raise ValueError("At least two price observations are needed.")
+    cost = fee + slippage
+
+    # Bar length from the median spacing, so gaps do not skew annualizing
+    bars_per_year = SECONDS_PER_YEAR / max(float(np.median(np.diff(timestamps))), 1.0)
+
+    if strategy == 'rebalance':
+        returns, starts, turnover = _rebalance_returns(prices, params.get('every', 1440))
+        returns[starts] -= cost * turnover
+        summary, equity = summarize(returns, bars_per_year)
+        summary["rebalances"] = int(np.count_nonzero(turnover))
+        summary["turnover"] = float(turnover.sum())
+    elif strategy in PER_ASSET_STRATEGIES:
+        try:
+            asset_returns, trades = _per_asset_returns(prices, PER_ASSET_STRATEGIES[strategy], params, cost)
+        except TypeError as e:
+            raise ValueError(f"Invalid parameters for {strategy}: {e}")
+        summary, equity = summarize(asset_returns.mean(axis=1), bars_per_year)
+        summary["trades"] = int(trades.sum())
+        summary["assets"] = {
+            asset_name: dict(summarize(asset_returns[:, column], bars_per_year)[0], trades=int(trades[column]))
+            for column, asset_name in enumerate(asset_names)
+        }
+    else:
+        raise ValueError(f"Unknown strategy: {strategy}")
+
+    summary.update({
+        "strategy": strategy,
+        "params": params,
+        "bars": len(timestamps),
+        "start": int(timestamps[0]),
+        "end": int(timestamps[-1])
+    })
+    return summary, equity
@@ -0,0 +1,71 @@
+import argparse
+import random
+import time
+
+import numpy as np
+
+from leaderboard import Leaderboard
+
+
+def timed(operation, repeat):
+    """Mean seconds per call of operation() over repeat calls"""
+    started = time.perf_counter()
+    for _ in range(repeat):
+        operation()
+    return (time.perf_counter() - started) / repeat
+
+def report(name, seconds):
+    if seconds >= 0.1:
+        print(f"  {name:<32} {seconds:8.2f} s")
+    else:
+        print(f"  {name:<32} {seconds * 1e6:8.1f} us")
+
+def run(args):
+    rng = np.random.default_rng(args.seed)
+    usernames = [f"user{i}" for i in range(args.accounts)]
+    net_worths = rng.lognormal(7, 1.5, args.accounts)
+    board = Leaderboard()
+
+    started = time.perf_counter()
+    board.rebuild(usernames, net_worths)
+    rebuild = time.perf_counter() - started
+
+    random.seed(args.seed)
+    accounts = random.sample(usernames, min(args.repeat, args.accounts))
+    picks = iter(accounts * (args.repeat // len(accounts) + 1))
+    update = timed(lambda: board.update(next(picks), random.uniform(0, 1e5)), args.repeat)
+    rank = timed(lambda: board.rank(random.choice(accounts)), args.repeat)
+    top = timed(lambda: board.top(10), args.repeat)
+
+    # Back to the original scores, with no accounts left to sync from the updates
+    board.rebuild(usernames, net_worths)
+
+    # A narrow tick moves a few accounts (single moves); a broad one rebuilds
+    narrow = net_worths.copy()
+    narrow[rng.choice(args.accounts, args.accounts // 100, replace=False)] *= 1.01
+    sequence = board.sequence
+    started = time.perf_counter()
+    board.sync(usernames, narrow, sequence)
+    narrow_sync = time.perf_counter() - started
+
+    broad = narrow * rng.uniform(0.95, 1.05, args.accounts)
+    sequence = board.sequence
+    started = time.perf_counter()
+    board.sync(usernames, broad, sequence)
+    broad_sync = time.perf_counter() - started
+
+    print(f"Leaderboard with {args.accounts:,} accounts (mean of {args.repeat:,} calls)")
+    report("update (move one account)", update)
+    report("rank of user", rank)
+    report("top 10", top)
+    report("full rebuild", rebuild)
+    report("sync, 1% of accounts moved", narrow_sync)
+    report("sync, every account moved", broad_sync)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Micro-benchmark of leaderboard.Leaderboard")
+    parser.add_argument('--accounts', type=int, default=1_000_000)
+    parser.add_argument('--repeat', type=int, default=100_000, help="calls timed per single-account operation")
+    parser.add_argument('--seed', type=int, default=1)
+    run(parser.parse_args())
@@ -0,0 +1,78 @@
+import argparse
+import os
+import random
+import tempfile
+import time
+
+# Keep the server's log out of the working directory
+os.environ.setdefault('LOG_FILE', '')
+
+import server  # noqa: E402
+
+
+def generate_events(accounts, events, seed):
+    """Yield ledger_events rows: an opening deposit per account, then random buys and sells"""
+    rng = random.Random(seed)
+    usernames = [f"user{i}" for i in range(accounts)]
+    held = {username: 0 for username in usernames}
+    for username in usernames:
+        yield (username, 'open', None, 0, 0, server.to_micros(1_000_000), 0.0)
+    for i in range(events - accounts):
+        username = usernames[i % accounts]
+        price = server.to_price(round(rng.uniform(1, 100), 6))
+        if held[username] and rng.random() < 0.5:
+            quantity = -rng.randint(1, held[username])
+            event_type = 'sell'
+        else:
+            quantity = rng.randint(1, 10) * server.MICROS
+            event_type = 'buy'
+        held[username] += quantity
+        amount = server.notional(price, -quantity) if quantity < 0 else -server.notional(price, quantity)
+        yield (username, event_type, 'Bitcoin', quantity, price, amount, float(i))
+
+def run(args):
+    server.DATABASE_PATH = os.path.join(tempfile.mkdtemp(), 'ledger.db')
+    server.init_db()
+    with server.connect_db(server.DATABASE_PATH) as conn:
+        conn.executemany("""
+            INSERT INTO ledger_events (username, event_type, asset_name, quantity, price, amount, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, generate_events(args.accounts, args.events, args.seed))
+        conn.commit()
+        cursor = conn.cursor()
+        cursor.execute("SELECT username, asset_name, quantity, price, amount FROM ledger_events ORDER BY seq")
+        events = cursor.fetchall()
+
+    started = time.perf_counter()
+    server.replay_events({}, events)
+    in_memory = time.perf_counter() - started
+
+    with server.connect_db(server.DATABASE_PATH) as conn:
+        started = time.perf_counter()
+        genesis = server.rebuild_account(conn.cursor(), 'user0')
+        from_genesis = time.perf_counter() - started
+
+    started = time.perf_counter()
+    server.take_account_snapshots()
+    snapshot_run = time.perf_counter() - started
+
+    with server.connect_db(server.DATABASE_PATH) as conn:
+        started = time.perf_counter()
+        snapshot = server.rebuild_account(conn.cursor(), 'user0')
+        from_snapshot = time.perf_counter() - started
+    assert snapshot == genesis
+
+    per_account = args.events // args.accounts
+    print(f"Ledger of {args.events:,} events over {args.accounts:,} accounts")
+    print(f"  in-memory replay          {args.events / in_memory / 1e6:8.2f} M events/s")
+    print(f"  snapshot run from SQLite  {args.events / snapshot_run / 1e6:8.2f} M events/s ({snapshot_run:.1f} s)")
+    print(f"  rebuild of one account    {from_genesis * 1e3:8.1f} ms from genesis ({per_account:,} events)")
+    print(f"                            {from_snapshot * 1e3:8.1f} ms after a snapshot")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark of event-ledger replay with and without account snapshots")
+    parser.add_argument('--events', type=int, default=2_000_000)
+    parser.add_argument('--accounts', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=1)
+    run(parser.parse_args())
@@ -1,5 +1,6 @@
 import requests
 import json
+import uuid
 import matplotlib.pyplot as plt
 from datetime import datetime
 
@@ -7,16 +8,21 @@ class CryptoTradingClient:
     def __init__(self, base_url='http://localhost:5000'):
         self.base_url = base_url
         self.current_user = None
+        self.token = None  # session token issued by /login
         self.market_data = None
 
-    def _make_request(self, endpoint, method='get', data=None):
+    def _make_request(self, endpoint, method='get', data=None, idempotent=False):
         """Helper method to make HTTP requests"""
         try:
             full_url = f"{self.base_url}{endpoint}"
+            # Tag state-changing requests so duplicates are not executed twice
+            headers = {'Idempotency-Key': str(uuid.uuid4())} if idempotent else {}
+            if self.token:
+                headers['Authorization'] = f"Bearer {self.token}"
             if method.lower() == 'get':
-                response = requests.get(full_url)
+                response = requests.get(full_url, headers=headers)
             elif method.lower() == 'post':
-                response = requests.post(full_url, json=data)
+                response = requests.post(full_url, json=data, headers=headers)
             else:
                 raise ValueError(f"Unsupported HTTP method: {method}")
             
@@ -26,6 +32,14 @@ class CryptoTradingClient:
             print(f"Error making request: {e}")
             return None
 
+    def _await_order(self, response):
+        """Wait for a queued order to be filled and return its result"""
+        if response and response.get('status') == 'pending' and response.get('order_id'):
+            order = self._make_request(f"/orders/{response['order_id']}?wait=30")
+            if order and order.get('status') != 'pending':
+                return order.get('result')
+        return response
+
     def create_account(self):
         """Create a new user account"""
         print("\n--- Create New Account ---")
@@ -57,6 +71,7 @@ class CryptoTradingClient:
         response = self._make_request('/login', method='post', data=data)
         if response and response.get('message') == 'Login successful.':
             self.current_user = username
+            self.token = response.get('token')
             print(f"Welcome, {username}!")
         else:
             print("Login failed.")
@@ -84,7 +99,7 @@ class CryptoTradingClient:
                 'amount': amount
             }
 
-            response = self._make_request('/deposit', method='post', data=data)
+            response = self._make_request('/deposit', method='post', data=data, idempotent=True)
             if response:
                 print(response.get('message', 'Deposit successful!'))
         except ValueError:
@@ -103,7 +118,7 @@ class CryptoTradingClient:
                 'amount': amount
             }
 
-            response = self._make_request('/withdraw', method='post', data=data)
+            response = self._make_request('/withdraw', method='post', data=data, idempotent=True)
             if response:
                 print(response.get('message', 'Withdrawal successful!'))
         except ValueError:
@@ -164,7 +179,7 @@ class CryptoTradingClient:
                     'quantity': quantity
                 }
 
-                response = self._make_request('/trade/buy', method='post', data=data)
+                response = self._await_order(self._make_request('/trade/buy', method='post', data=data, idempotent=True))
                 if response:
                     print(response.get('message', 'Purchase successful!'))
             else:
@@ -198,7 +213,7 @@ class CryptoTradingClient:
                         'quantity': quantity
                     }
 
-                    response = self._make_request('/trade/sell', method='post', data=sell_data)
+                    response = self._await_order(self._make_request('/trade/sell', method='post', data=sell_data, idempotent=True))
                     if response:
                         print(response.get('message', 'Sale successful!'))
                         print(f"Total Revenue: ${response.get('total_revenue', 0):.2f}")
@@ -256,6 +271,48 @@ class CryptoTradingClient:
         except ValueError:
             print("Invalid input.")
 
+    def backtest_strategy(self):
+        """Backtest a strategy on stored price history"""
+        assets = [name.strip() for name in input("Asset names (comma separated): ").split(',') if name.strip()]
+        if not assets:
+            print("Enter at least one asset.")
+            return
+
+        print("1. SMA Crossover")
+        print("2. Momentum")
+        print("3. Equal-Weight Rebalancing")
+        try:
+            choice = int(input("Select strategy: "))
+            if choice == 1:
+                strategy = 'sma_crossover'
+                params = {'fast': int(input("Fast window (bars): ")), 'slow': int(input("Slow window (bars): "))}
+            elif choice == 2:
+                strategy = 'momentum'
+                params = {'lookback': int(input("Lookback (bars): "))}
+            elif choice == 3:
+                strategy = 'rebalance'
+                params = {'every': int(input("Rebalance every (bars): "))}
+            else:
+                print("Invalid selection.")
+                return
+            fee = float(input("Fee per trade (%): ") or 0.1) / 100
+        except ValueError:
+            print("Invalid input.")
+            return
+
+        response = self._make_request('/backtest', method='post', data={
+            'assets': assets, 'strategy': strategy, 'params': params, 'fee': fee
+        })
+        if response and 'total_return' in response:
+            print(f"\n--- Backtest: {strategy} ({response['bars']} bars) ---")
+            print(f"Total Return: {response['total_return'] * 100:.2f}%")
+            print(f"Annualized Return: {response['annualized_return'] * 100:.2f}%")
+            print(f"Volatility: {response['volatility'] * 100:.2f}%")
+            print(f"Sharpe Ratio: {response['sharpe_ratio']:.2f}")
+            print(f"Max Drawdown: {response['max_drawdown'] * 100:.2f}%")
+            for asset_name, result in response.get('assets', {}).items():
+                print(f"  {asset_name}: {result['total_return'] * 100:.2f}% return, {result['max_drawdown'] * 100:.2f}% max drawdown, {result['trades']} trades")
+
     def main_menu(self):
         """Main application loop"""
         while True:
@@ -275,8 +332,9 @@ class CryptoTradingClient:
                 print("7. Sell Asset")
                 print("8. Transaction History")
                 print("9. Asset Price Trend")
-                print("10. Logout")
-                print("11. Exit")
+                print("10. Backtest Strategy")
+                print("11. Logout")
+                print("12. Exit")
 
             try:
                 choice = int(input("Enter your choice: "))
@@ -314,9 +372,12 @@ class CryptoTradingClient:
                     elif choice == 9:
                         self.view_asset_trend()
                     elif choice == 10:
+                        self.backtest_strategy()
+                    elif choice == 11:
                         print(f"Goodbye, {self.current_user}!")
                         self.current_user = None
-                    elif choice == 11:
+                        self.token = None
+                    elif choice == 12:
                         print("Goodbye!")
                         break
                     else:
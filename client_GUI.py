@@ -1,4 +1,5 @@
 import sys
+import uuid
 import requests
 from matplotlib.backends.backend_qtagg import FigureCanvasQTAgg as FigureCanvas
 from matplotlib.figure import Figure
@@ -66,6 +67,7 @@ class CryptoTradingGUI(QMainWindow):
         super().__init__()
         self.base_url = 'http://localhost:5000'  # Base URL for API requests
         self.current_user = None  # Store the current user
+        self.token = None  # Session token issued by /login
         self.market_data = None  # Store retrieved market data
         self.available_assets = []  # Initialize available assets to empty list
         
@@ -761,13 +763,15 @@ class CryptoTradingGUI(QMainWindow):
                 # Display an error message if the request is not successful
                 self.trend_display.setText("Error fetching trend data.")
 
-    def _make_request(self, endpoint, method='get', data=None):
+    def _make_request(self, endpoint, method='get', data=None, idempotent=False):
         """Make an HTTP request to the server
 
         Args:
             endpoint (str): The endpoint to make the request to
             method (str, optional): The HTTP method to use. Defaults to 'get'.
             data (dict, optional): The data to send in the request body. Defaults to None.
+            idempotent (bool, optional): Send a fresh Idempotency-Key so the server
+                executes the request at most once. Defaults to False.
 
         Returns:
             dict: The JSON response from the server if the request is successful
@@ -775,13 +779,18 @@ class CryptoTradingGUI(QMainWindow):
         try:
             # Construct full URL
             full_url = f"{self.base_url}{endpoint}"
+            # Tag state-changing requests so duplicates are not executed twice
+            headers = {'Idempotency-Key': str(uuid.uuid4())} if idempotent else {}
+            # Authenticate with the session token once logged in
+            if self.token:
+                headers['Authorization'] = f"Bearer {self.token}"
             # Determine HTTP method
             if method.lower() == 'get':
                 # Send GET request
-                response = requests.get(full_url)
+                response = requests.get(full_url, headers=headers)
             elif method.lower() == 'post':
                 # Send POST request with JSON data
-                response = requests.post(full_url, json=data)
+                response = requests.post(full_url, json=data, headers=headers)
             else:
                 # Raise error for unsupported methods
                 raise ValueError(f"Unsupported HTTP method: {method}")
@@ -797,6 +806,18 @@ class CryptoTradingGUI(QMainWindow):
 
 
 
+    def _await_order(self, response):
+        """Wait for a queued order to be filled and return its result
+
+        When the server runs with asynchronous order intake, trade requests
+        return 202 with an order id; this long-polls /orders/<id> for the fill.
+        """
+        if response and response.get('status') == 'pending' and response.get('order_id'):
+            order = self._make_request(f"/orders/{response['order_id']}?wait=30")
+            if order and order.get('status') != 'pending':
+                return order.get('result'), order.get('status_code', 200)
+        return response, 200
+
     def show_error_message(self, message):
         """Display error message with modern styling"""
         error_dialog = QMessageBox(self)
@@ -875,6 +896,7 @@ class CryptoTradingGUI(QMainWindow):
         # Successful login
         if response and response.get('message') == 'Login successful.':
             self.current_user = username
+            self.token = response.get('token')
 
             # Directly set the welcome message
             self.welcome_label.setText(f"Welcome back, {username}!")
@@ -999,7 +1021,7 @@ class CryptoTradingGUI(QMainWindow):
                 }
             
                 # Send deposit request to server
-                response = self._make_request('/deposit', method='post', data=data)
+                response = self._make_request('/deposit', method='post', data=data, idempotent=True)
                 if response:
                     # Show success message and refresh balance
                     self.show_success_message(response.get('message', 'Deposit successful!'))
@@ -1053,7 +1075,7 @@ class CryptoTradingGUI(QMainWindow):
                 }
             
                 # Make POST request to server
-                response = self._make_request('/withdraw', method='post', data=data)
+                response = self._make_request('/withdraw', method='post', data=data, idempotent=True)
                 if response:
                     # Show success message and update balance label
                     self.show_success_message(response.get('message', 'Withdrawal successful!'))
@@ -1154,7 +1176,7 @@ class CryptoTradingGUI(QMainWindow):
                 }
             
                 # Make POST request to server
-                response = self._make_request('/deposit', method='post', data=data)
+                response = self._make_request('/deposit', method='post', data=data, idempotent=True)
                 if response:
                     # Show success message and update balance label
                     self.show_success_message(response.get('message', 'Deposit successful!'))
@@ -1202,7 +1224,7 @@ class CryptoTradingGUI(QMainWindow):
                 }
 
                 # Send withdrawal request to server
-                response = self._make_request('/withdraw', method='post', data=data)
+                response = self._make_request('/withdraw', method='post', data=data, idempotent=True)
                 if response:
                     # Show success message and refresh balance
                     self.show_success_message(response.get('message', 'Withdrawal successful!'))
@@ -1310,8 +1332,13 @@ class CryptoTradingGUI(QMainWindow):
                 'asset_name': asset_name,
                 'quantity': quantity
             }
-            response = self._make_request('/trade/buy', method='post', data=data)
-            if response:
+            response, status_code = self._await_order(
+                self._make_request('/trade/buy', method='post', data=data, idempotent=True)
+            )
+            if response and status_code != 200:
+                # Order was queued but rejected by the server
+                self.show_error_message(response.get('message', 'Purchase failed.'))
+            elif response:
                 # Show success message and refresh balance
                 self.show_success_message(response.get('message', 'Purchase successful!'))
                 self.check_balance()
@@ -1337,18 +1364,22 @@ class CryptoTradingGUI(QMainWindow):
                 "username": self.current_user,
                 "asset_name": asset_name,
                 "quantity": quantity
-            })
+            }, headers={"Idempotency-Key": str(uuid.uuid4()), "Authorization": f"Bearer {self.token}"})
+
+            # Wait for the fill if the order was queued
+            status_code = response.status_code
+            data = response.json()
+            if status_code == 202:
+                data, status_code = self._await_order(data)
 
             # Check response status code
-            if response.status_code == 200:
+            if status_code == 200:
                 # Show success message and refresh portfolio view
-                data = response.json()
                 self.show_success_message(data["message"])
                 self.view_portfolio()
             else:
                 # Show error message
-                data = response.json()
-                self.show_error_message(data.get("message", "Error selling asset."))
+                self.show_error_message((data or {}).get("message", "Error selling asset."))
 
         # Catch invalid input and other exceptions
         except ValueError:
@@ -1430,6 +1461,7 @@ class CryptoTradingGUI(QMainWindow):
     def logout(self):
         """Handle user logout"""
         self.current_user = None  # Clear current user data
+        self.token = None  # Drop the session token
         self.username_input.clear()  # Clear username input field
         self.password_input.clear()  # Clear password input field
         self.balance_label.setText("Balance: $0.00")  # Reset balance label
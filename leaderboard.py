@@ -0,0 +1,150 @@
+import threading
+from itertools import islice
+
+import numpy as np
+from sortedcontainers import SortedList
+
+
+class Leaderboard:
+    """Accounts ranked by net worth, maintained incrementally
+
+    Entries are kept in a SortedList keyed on (-net_worth, username), an
+    order-statistics structure: updating one account, finding the rank of
+    a user and reading the top N all cost O(log n) (plus N for the top-N
+    slice). Ties are broken by username so ranks are deterministic.
+
+    Every update() takes the next number of a sequence. A caller of sync()
+    or rebuild() reads ``sequence`` before computing its net worths and
+    passes it in; accounts updated after that keep their (fresher) score.
+    """
+
+    # Above this fraction of changed accounts a full rebuild beats single updates
+    REBUILD_FRACTION = 0.125
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ranking = SortedList()
+        self.scores = {}  # username -> net worth currently in the ranking
+        self.synced = np.zeros(0, dtype=np.float64)  # net worths at the last sync/rebuild
+        self.rows = {}  # username -> row in the synced array
+        self.sequence = 0  # number of the last update()
+        self.dirty = {}  # username -> sequence of its last update() since the last sync
+
+    def __len__(self):
+        return len(self.scores)
+
+    def _move(self, username, net_worth):
+        """Insert or move one account (lock held); returns whether its score changed"""
+        previous = self.scores.get(username)
+        if previous == net_worth:
+            return False
+        if previous is not None:
+            self.ranking.remove((-previous, username))
+        self.ranking.add((-net_worth, username))
+        self.scores[username] = net_worth
+        return True
+
+    def update(self, username, net_worth):
+        """Insert or move one account, O(log n)"""
+        net_worth = float(net_worth)
+        with self.lock:
+            self._move(username, net_worth)
+            # Recorded even when the score is unchanged: a sync computed
+            # before this call must not move the account back
+            self.sequence += 1
+            self.dirty[username] = self.sequence
+
+    def remove(self, username):
+        """Drop an account from the ranking"""
+        with self.lock:
+            previous = self.scores.pop(username, None)
+            if previous is not None:
+                self.ranking.remove((-previous, username))
+
+    def rebuild(self, usernames, net_worths, sequence=None):
+        """Replace the whole ranking (one vectorized sort)
+
+        sequence is the value of ``self.sequence`` read before net_worths
+        were computed (default: now).
+        """
+        net_worths = np.asarray(net_worths, dtype=np.float64)
+        values = net_worths.tolist()
+        order = np.argsort(-net_worths, kind='stable').tolist()
+        entries = [(-values[i], usernames[i]) for i in order]
+        scores = dict(zip(usernames, values))
+        with self.lock:
+            if sequence is None:
+                sequence = self.sequence
+            # Accounts updated since the net worths were computed keep their score
+            fresh = [(username, self.scores[username]) for username, updated in self.dirty.items()
+                     if updated > sequence and username in self.scores]
+            # Already (almost) sorted, so SortedList's initial sort is near linear
+            self.ranking = SortedList(entries)
+            self.scores = scores
+            for username, net_worth in fresh:
+                self._move(username, net_worth)
+            self.synced = net_worths.copy()
+            self.rows = dict(zip(usernames, range(len(usernames))))
+            # Older updates are part of the new ranking; newer ones stay for the next sync
+            self.dirty = {username: updated for username, updated in self.dirty.items() if updated > sequence}
+
+    def sync(self, usernames, net_worths, sequence=None):
+        """Bring the ranking in line with fresh net worths after a price tick
+
+        Only accounts whose net worth changed are moved; when a large share
+        changed (the usual case for a broad market move) the ranking is
+        rebuilt in one pass instead. sequence is as for rebuild().
+        """
+        net_worths = np.asarray(net_worths, dtype=np.float64)
+        with self.lock:
+            if sequence is None:
+                sequence = self.sequence
+            # Accounts only ever get appended, so rows line up with the last sync
+            previous = np.full(len(net_worths), np.nan)
+            count = min(len(self.synced), len(net_worths))
+            previous[:count] = self.synced[:count]
+            # Only the names taken here are processed. Updates newer than the
+            # net worths go back, as do update() calls made while this sync
+            # runs: self.dirty then holds exactly the accounts not to touch
+            dirty = self.dirty
+            self.dirty = {username: updated for username, updated in dirty.items() if updated > sequence}
+
+        changed = np.flatnonzero(previous != net_worths)
+        if len(changed) > self.REBUILD_FRACTION * max(len(usernames), 1):
+            self.rebuild(usernames, net_worths, sequence)
+            return
+
+        # Accounts moved by a trade since the last sync may differ from the
+        # ranking even when their synced value did not change. The lock is
+        # taken per account so readers are not held up for the whole pass
+        for username, updated in dirty.items():
+            row = self.rows.get(username)
+            if updated <= sequence and row is not None and row < len(net_worths):
+                with self.lock:
+                    if username not in self.dirty:
+                        self._move(username, float(net_worths[row]))
+
+        # _move() is a no-op for accounts whose score is already current
+        for index in changed.tolist():
+            with self.lock:
+                if usernames[index] not in self.dirty:
+                    self._move(usernames[index], float(net_worths[index]))
+
+        with self.lock:
+            for row in range(count, len(usernames)):
+                self.rows[usernames[row]] = row
+            self.synced = net_worths.copy()
+
+    def top(self, limit):
+        """Return [(rank, username, net_worth)] for the best accounts"""
+        with self.lock:
+            entries = list(islice(self.ranking, limit))
+        return [(rank, username, -score) for rank, (score, username) in enumerate(entries, start=1)]
+
+    def rank(self, username):
+        """Return (rank, net_worth) of an account, or None, O(log n)"""
+        with self.lock:
+            net_worth = self.scores.get(username)
+            if net_worth is None:
+                return None
+            return self.ranking.index((-net_worth, username)) + 1, net_worth
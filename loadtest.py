@@ -0,0 +1,101 @@
+import argparse
+import asyncio
+import json
+import time
+import uuid
+
+import aiohttp
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+async def login(session, base_url):
+    """Create a throwaway account and return its Authorization header"""
+    username = f"load_{uuid.uuid4().hex[:12]}"
+    password = uuid.uuid4().hex
+    async with session.post(f"{base_url}/create_account",
+                            json={"username": username, "password": password, "email": f"{username}@example.com"}) as response:
+        response.raise_for_status()
+    async with session.post(f"{base_url}/login", json={"username": username, "password": password}) as response:
+        response.raise_for_status()
+        token = (await response.json())["token"]
+    return username, {"Authorization": f"Bearer {token}"}
+
+async def hold_slow_connection(host, port, stop):
+    """A slow client: sends a request header one line at a time, never finishing it"""
+    try:
+        reader, writer = await asyncio.open_connection(host, port)
+        writer.write(f"GET /market_data HTTP/1.1\r\nHost: {host}\r\n".encode())
+        while not stop.is_set():
+            await asyncio.sleep(1)
+            writer.write(b"X-Slow: 1\r\n")
+            await writer.drain()
+        writer.close()
+    except (OSError, asyncio.CancelledError):
+        pass
+
+async def client(session, url, method, body, headers, deadline, latencies, errors):
+    while time.perf_counter() < deadline:
+        started = time.perf_counter()
+        try:
+            async with session.request(method, url, json=body, headers=headers) as response:
+                await response.read()
+                if response.status >= 400:
+                    errors[response.status] = errors.get(response.status, 0) + 1
+                    continue
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            errors[type(e).__name__] = errors.get(type(e).__name__, 0) + 1
+            continue
+        latencies.append(time.perf_counter() - started)
+
+async def run(args):
+    base_url = args.url.rstrip('/')
+    timeout = aiohttp.ClientTimeout(total=args.timeout)
+    connector = aiohttp.TCPConnector(limit=0)  # one connection per client
+    async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
+        username, headers = await login(session, base_url)
+        body = json.loads(args.body.replace('{username}', username)) if args.body else None
+
+        stop = asyncio.Event()
+        host, port = connector_address(base_url)
+        slow = [asyncio.create_task(hold_slow_connection(host, port, stop)) for _ in range(args.slow)]
+        await asyncio.sleep(1 if args.slow else 0)  # let the slow clients connect
+
+        latencies, errors = [], {}
+        started = time.perf_counter()
+        deadline = started + args.duration
+        await asyncio.gather(*(
+            client(session, base_url + args.path, args.method, body, headers, deadline, latencies, errors)
+            for _ in range(args.concurrency)
+        ))
+        elapsed = time.perf_counter() - started
+        stop.set()
+        for task in slow:
+            task.cancel()
+
+    latencies.sort()
+    print(f"{args.method} {args.path}: {args.concurrency} clients, {args.slow} slow connections, {elapsed:.1f}s")
+    print(f"  {len(latencies)} ok ({len(latencies) / elapsed:.0f} req/s), errors: {errors or 0}")
+    print(f"  latency ms: p50 {percentile(latencies, 0.5) * 1000:.1f}  p90 {percentile(latencies, 0.9) * 1000:.1f}  "
+          f"p99 {percentile(latencies, 0.99) * 1000:.1f}  max {(latencies[-1] if latencies else 0) * 1000:.1f}")
+
+def connector_address(base_url):
+    address = base_url.split('://', 1)[-1].split('/', 1)[0]
+    host, _, port = address.rpartition(':')
+    return host, int(port)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Closed-loop HTTP load generator for server.py / server_async.py")
+    parser.add_argument('--url', default='http://127.0.0.1:5000')
+    parser.add_argument('--path', default='/market_data')
+    parser.add_argument('--method', default='GET')
+    parser.add_argument('--body', help="JSON body; {username} is replaced by the load test account")
+    parser.add_argument('--concurrency', type=int, default=50, help="clients, each with its own connection")
+    parser.add_argument('--duration', type=float, default=10, help="seconds")
+    parser.add_argument('--slow', type=int, default=0, help="extra connections that never finish their request")
+    parser.add_argument('--timeout', type=float, default=30, help="per-request timeout in seconds")
+    asyncio.run(run(parser.parse_args()))
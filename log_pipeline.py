@@ -0,0 +1,219 @@
+import json
+import logging
+import os
+import queue
+import threading
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+try:
+    import fcntl
+except ImportError:  # Windows: rotation is not coordinated between processes
+    fcntl = None
+
+TEXT_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
+# Attributes every LogRecord has; any other attribute came from extra= and is
+# written as a field of its own in JSON output
+RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime', 'taskName'}
+
+
+class TextFormatter(logging.Formatter):
+    """The classic one-line format, noting how many similar records sampling dropped"""
+
+    def format(self, record):
+        line = super().format(record)
+        suppressed = getattr(record, 'suppressed', 0)
+        return f"{line} [{suppressed} similar messages suppressed]" if suppressed else line
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: time, level, logger, message, extra fields and exception"""
+
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "process": record.process,
+            "thread": record.threadName,
+        }
+        for key, value in vars(record).items():
+            if key not in RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        if record.stack_info:
+            entry["stack"] = record.stack_info
+        return json.dumps(entry, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """Let through at most `limit` records per second from each call site
+
+    Records at `level` and above (warnings and errors by default) always
+    pass. The number dropped in a second is reported on the next record
+    let through from the same call site, as its `suppressed` attribute.
+    """
+
+    def __init__(self, limit, level=logging.WARNING):
+        super().__init__()
+        self.limit = limit
+        self.level = level
+        self.lock = threading.Lock()
+        self.windows = {}  # (pathname, lineno) -> [second, records passed, records suppressed]
+        self.suppressed = 0
+
+    def filter(self, record):
+        if record.levelno >= self.level:
+            return True
+        key = (record.pathname, record.lineno)
+        second = int(record.created)
+        with self.lock:
+            window = self.windows.get(key)
+            if window is None or window[0] != second:
+                if window is not None and window[2]:
+                    record.suppressed = window[2]
+                self.windows[key] = [second, 1, 0]
+                return True
+            if window[1] < self.limit:
+                window[1] += 1
+                return True
+            window[2] += 1
+            self.suppressed += 1
+            return False
+
+
+class DroppingQueueHandler(QueueHandler):
+    """QueueHandler that never blocks the thread logging
+
+    Records are put on a bounded queue; when the listener has fallen that
+    far behind, new records are dropped and counted instead of waiting.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+        self.dropped_lock = threading.Lock()
+
+    def prepare(self, record):
+        # Merge the arguments now (they may be mutated after the call returns) but
+        # leave the formatting, including tracebacks, to the listener thread. The
+        # queue never leaves the process, so the record need not be copied or pickled
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self.dropped_lock:
+                self.dropped += 1
+
+
+class SharedRotatingFileHandler(RotatingFileHandler):
+    """RotatingFileHandler that several processes can append to
+
+    A rollover takes an flock on <file>.lock and only rotates when the
+    file is still the one this process opened, so it is rotated once no
+    matter how many workers see it reach maxBytes. The others notice the
+    file was replaced and reopen it.
+    """
+
+    def _replaced(self):
+        try:
+            return os.stat(self.baseFilename).st_ino != os.fstat(self.stream.fileno()).st_ino
+        except FileNotFoundError:
+            return True
+
+    def _reopen(self):
+        self.stream.close()
+        self.stream = self._open()
+
+    def shouldRollover(self, record):
+        if self.stream is not None and self._replaced():
+            self._reopen()
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        if fcntl is None or self.stream is None:
+            return super().doRollover()
+        with open(self.baseFilename + '.lock', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            if self._replaced():
+                self._reopen()  # rotated by another process meanwhile
+            else:
+                super().doRollover()
+
+
+class LogPipeline:
+    """Root logging through a bounded queue drained by a background listener
+
+    Threads that log only format the message and enqueue the record; the
+    listener thread does the file and console I/O, so a slow disk delays
+    the log, not the request.
+    """
+
+    def __init__(self, handlers, queue_size, sample_limit=0):
+        self.handlers = handlers
+        self.queue_size = queue_size
+        self.handler = DroppingQueueHandler(queue.Queue(queue_size))
+        self.sampler = None
+        if sample_limit > 0:
+            self.sampler = SamplingFilter(sample_limit)
+            self.handler.addFilter(self.sampler)
+        self.listener = None
+
+    def start(self):
+        self.listener = QueueListener(self.handler.queue, *self.handlers, respect_handler_level=True)
+        self.listener.start()
+
+    def stop(self):
+        """Write out the queued records and stop the listener"""
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+
+    def after_fork(self):
+        # Only the forking thread exists in the child: the listener is gone and
+        # the queue's lock may have been held by it. The parent writes out what
+        # was queued before the fork
+        self.handler.queue = queue.Queue(self.queue_size)
+        self.start()
+
+    def queue_depth(self):
+        return self.handler.queue.qsize()
+
+
+def configure_logging(level='INFO', path='server.log', json_output=False, max_bytes=0, backup_count=5,
+                      queue_size=10000, sample_limit=0):
+    """Send the root logger's records to the console and `path` through a LogPipeline
+
+    max_bytes > 0 rotates the file, keeping backup_count old files. Like
+    logging.basicConfig, does nothing (and returns None) when the root
+    logger already has handlers.
+    """
+    root = logging.getLogger()
+    if root.handlers:
+        return None
+
+    formatter = JsonFormatter() if json_output else TextFormatter(TEXT_FORMAT)
+    handlers = [logging.StreamHandler()]
+    if path:
+        if max_bytes > 0:
+            handlers.append(SharedRotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count))
+        else:
+            handlers.append(logging.FileHandler(path))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    pipeline = LogPipeline(handlers, queue_size, sample_limit)
+    root.setLevel(level)
+    root.addHandler(pipeline.handler)
+    pipeline.start()
+    if hasattr(os, 'register_at_fork'):
+        os.register_at_fork(after_in_child=pipeline.after_fork)
+    return pipeline
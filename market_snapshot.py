@@ -0,0 +1,77 @@
+import mmap
+import os
+import struct
+import time
+
+# Header: sequence number (odd while a write is in progress), payload length, tick timestamp
+HEADER = struct.Struct('<QQd')
+SEQUENCE = struct.Struct('<Q')
+HEADER_SIZE = 64  # the payload starts on its own cache line
+
+# Reads retried while the writer is mid-update before giving up
+READ_ATTEMPTS = 1000
+
+
+class SharedSnapshot:
+    """Latest market tick in a memory-mapped file shared by all worker processes
+
+    A single writer (the leader) publishes serialized ticks and every
+    worker maps the same pages, so there is one copy of the snapshot no
+    matter how many workers run. Reads take no lock, seqlock style: the
+    writer makes the sequence number odd, writes, then makes it even
+    again, and a reader retries when the number was odd or changed while
+    it copied the payload. Checking for a new tick reads 8 bytes of
+    shared memory without a system call.
+    """
+
+    def __init__(self, path, capacity):
+        size = HEADER_SIZE + capacity
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            # Never shrink: other workers may already map the file
+            if os.fstat(fd).st_size < size:
+                os.ftruncate(fd, size)
+            self.map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        self.capacity = capacity
+
+    def version(self):
+        """Sequence number of the published tick (0 before the first one)"""
+        return SEQUENCE.unpack_from(self.map)[0]
+
+    def publish(self, payload, timestamp):
+        """Replace the snapshot with payload (bytes); returns its sequence number
+
+        Must only be called by one process at a time.
+        """
+        if len(payload) > self.capacity:
+            raise ValueError(f"Snapshot of {len(payload)} bytes exceeds the {self.capacity} byte segment")
+        sequence = self.version()
+        # An odd number left by a writer that died mid-update is skipped over
+        sequence += 1 if sequence % 2 == 0 else 2
+        SEQUENCE.pack_into(self.map, 0, sequence)
+        HEADER.pack_into(self.map, 0, sequence, len(payload), timestamp)
+        self.map[HEADER_SIZE:HEADER_SIZE + len(payload)] = payload
+        SEQUENCE.pack_into(self.map, 0, sequence + 1)
+        return sequence + 1
+
+    def read(self):
+        """Return (sequence, payload, timestamp) of a consistent snapshot, or None
+
+        None means nothing was published yet, or the writer kept updating
+        for READ_ATTEMPTS tries.
+        """
+        for _ in range(READ_ATTEMPTS):
+            sequence, length, timestamp = HEADER.unpack_from(self.map)
+            if sequence == 0:
+                return None
+            if sequence % 2 == 0:
+                payload = self.map[HEADER_SIZE:HEADER_SIZE + min(length, self.capacity)]
+                if self.version() == sequence:
+                    return sequence, payload, timestamp
+            time.sleep(0)  # writer mid-update: yield, then retry
+        return None
+
+    def close(self):
+        self.map.close()
@@ -0,0 +1,163 @@
+import cProfile
+import marshal
+import os
+import pstats
+import random
+import sys
+import threading
+import time
+from collections import Counter
+
+
+def _frame_name(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+def _function_name(function):
+    filename, line, name = function
+    return f"{name} ({os.path.basename(filename)}:{line})" if line else name
+
+
+class RequestProfiler:
+    """Profiles a sampled fraction of requests, aggregated per endpoint
+
+    While enabled, each request picked by sample_rate (and, if given,
+    belonging to one of `endpoints`) runs under cProfile, and a sampler
+    thread records its stack every `interval` seconds. The cProfile
+    statistics are merged per endpoint for pstats; the sampled stacks are
+    counted per endpoint for flamegraphs. Disabled, the only cost is the
+    `enabled` check in should_profile().
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.sample_rate = 0.0
+        self.endpoints = None  # None profiles every endpoint
+        self.interval = 0.005
+        self.lock = threading.Lock()
+        self.started_at = None
+        self.requests = Counter()  # endpoint -> requests profiled
+        self.stats = {}  # endpoint -> pstats.Stats
+        self.stacks = {}  # endpoint -> Counter of collapsed stack -> samples
+        self.active = {}  # thread id -> endpoint of the request being profiled on it
+        self.sampler = None
+
+    def start(self, sample_rate, endpoints=None, interval=0.005):
+        """Clear earlier results and start profiling"""
+        if not 0 < sample_rate <= 1:
+            raise ValueError("sample_rate must be in (0, 1]")
+        if interval <= 0:
+            raise ValueError("interval must be positive")
+        self.stop()
+        with self.lock:
+            self.requests.clear()
+            self.stats.clear()
+            self.stacks.clear()
+            self.sample_rate = sample_rate
+            self.endpoints = set(endpoints) if endpoints else None
+            self.interval = interval
+            self.started_at = time.time()
+            self.enabled = True
+        self.sampler = threading.Thread(target=self._sample, name='profile-sampler', daemon=True)
+        self.sampler.start()
+
+    def stop(self):
+        """Stop profiling; the results stay available until the next start()"""
+        self.enabled = False
+        if self.sampler is not None:
+            self.sampler.join()
+            self.sampler = None
+
+    def should_profile(self, endpoint):
+        return (self.enabled and (self.endpoints is None or endpoint in self.endpoints)
+                and random.random() < self.sample_rate)
+
+    def begin(self, endpoint):
+        """Start profiling the current thread's request; returns the token for end()"""
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Python 3.12+ allows one active cProfile per process: stacks are still sampled
+            profile = None
+        self.active[threading.get_ident()] = endpoint
+        return endpoint, profile
+
+    def end(self, token):
+        endpoint, profile = token
+        self.active.pop(threading.get_ident(), None)
+        if profile is not None:
+            profile.disable()
+        with self.lock:
+            self.requests[endpoint] += 1
+            if profile is not None:
+                if endpoint in self.stats:
+                    self.stats[endpoint].add(profile)
+                else:
+                    self.stats[endpoint] = pstats.Stats(profile)
+
+    def _sample(self):
+        while self.enabled:
+            time.sleep(self.interval)
+            if not self.active:
+                continue
+            frames = sys._current_frames()
+            for thread_id, endpoint in list(self.active.items()):
+                frame = frames.get(thread_id)
+                names = []
+                while frame is not None:
+                    names.append(_frame_name(frame.f_code))
+                    frame = frame.f_back
+                if names:
+                    stack = ';'.join(reversed(names))
+                    with self.lock:
+                        self.stacks.setdefault(endpoint, Counter())[stack] += 1
+
+    def _merged_stats(self, endpoint):
+        with self.lock:
+            selected = [stats for name, stats in self.stats.items() if endpoint is None or name == endpoint]
+            if not selected:
+                return None
+            merged = pstats.Stats()
+            merged.add(*selected)
+        return merged
+
+    def pstats_data(self, endpoint=None):
+        """Merged cProfile statistics in the pstats file format, or None"""
+        merged = self._merged_stats(endpoint)
+        return marshal.dumps(merged.stats) if merged is not None else None
+
+    def collapsed_stacks(self, endpoint=None):
+        """Sampled stacks as "endpoint;frame;...;frame count" lines, for flamegraph.pl or speedscope"""
+        with self.lock:
+            lines = [
+                f"{name};{stack} {count}"
+                for name, stacks in self.stacks.items() if endpoint is None or name == endpoint
+                for stack, count in stacks.items()
+            ]
+        return '\n'.join(sorted(lines)) + '\n' if lines else ''
+
+    def summary(self, top=10):
+        """Status, and per endpoint the requests profiled, stack samples and hottest functions"""
+        with self.lock:
+            endpoints = sorted(set(self.requests) | set(self.stacks))
+            report = {}
+            for endpoint in endpoints:
+                stats = self.stats.get(endpoint)
+                functions = sorted(stats.stats.items(), key=lambda item: item[1][2], reverse=True)[:top] if stats else []
+                report[endpoint] = {
+                    "requests": self.requests[endpoint],
+                    "samples": sum(self.stacks.get(endpoint, {}).values()),
+                    "top_functions": [
+                        {"function": _function_name(function), "calls": calls,
+                         "self_ms": round(self_time * 1000, 3), "cumulative_ms": round(cumulative * 1000, 3)}
+                        for function, (_, calls, self_time, cumulative, _) in functions
+                    ],
+                }
+        return {
+            "enabled": self.enabled,
+            "sample_rate": self.sample_rate,
+            "endpoints": sorted(self.endpoints) if self.endpoints else None,
+            "interval": self.interval,
+            "started_at": self.started_at,
+            "profiled": report,
+        }
@@ -0,0 +1,89 @@
+import re
+import threading
+import time
+
+# Fingerprints tracked before further new ones are folded into OTHER
+MAX_FINGERPRINTS = 2000
+OTHER = '<other>'
+
+STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+NUMBER_LITERAL = re.compile(r"(?<![\w.])-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?\b")
+WHITESPACE = re.compile(r"\s+")
+VALUE_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)")
+REPEATED_LISTS = re.compile(r"\(\.\.\.\)(?:\s*,\s*\(\.\.\.\))+")
+
+
+def fingerprint(sql):
+    """Normalize a statement so its variants aggregate together
+
+    Literals become ?, runs of whitespace one space, and placeholder
+    lists (an IN list, VALUES rows) a single (...), e.g.
+    "SELECT * FROM t WHERE a IN (?, ?) AND b = 'x'" becomes
+    "SELECT * FROM t WHERE a IN (...) AND b = ?".
+    """
+    sql = STRING_LITERAL.sub('?', sql)
+    sql = NUMBER_LITERAL.sub('?', sql)
+    sql = WHITESPACE.sub(' ', sql).strip()
+    sql = VALUE_LIST.sub('(...)', sql)
+    return REPEATED_LISTS.sub('(...)', sql)
+
+
+class QueryStats:
+    """Count, total and maximum duration of the statements run, per fingerprint
+
+    Also counts the executions slower than the slow-query threshold and
+    keeps the query plan captured for the first of them.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}  # fingerprint -> [count, total seconds, max seconds, slow count, plan]
+        self.since = time.time()
+
+    def record(self, fingerprint, duration, slow=False):
+        with self.lock:
+            entry = self.entries.get(fingerprint)
+            if entry is None:
+                if len(self.entries) >= MAX_FINGERPRINTS:
+                    fingerprint = OTHER
+                entry = self.entries.setdefault(fingerprint, [0, 0.0, 0.0, 0, None])
+            entry[0] += 1
+            entry[1] += duration
+            if duration > entry[2]:
+                entry[2] = duration
+            if slow:
+                entry[3] += 1
+
+    def plan(self, fingerprint):
+        entry = self.entries.get(fingerprint)
+        return entry[4] if entry is not None else None
+
+    def set_plan(self, fingerprint, plan):
+        with self.lock:
+            entry = self.entries.get(fingerprint)
+            if entry is not None:
+                entry[4] = plan
+
+    def top(self, sort='total', limit=50):
+        """Return the `limit` fingerprints with the highest total, max, mean, count or slow"""
+        with self.lock:
+            rows = [
+                {
+                    "fingerprint": fingerprint,
+                    "count": count,
+                    "total_ms": round(total * 1000, 3),
+                    "mean_ms": round(total * 1000 / count, 3),
+                    "max_ms": round(longest * 1000, 3),
+                    "slow": slow,
+                    "plan": plan,
+                }
+                for fingerprint, (count, total, longest, slow, plan) in self.entries.items()
+            ]
+        key = {'total': 'total_ms', 'max': 'max_ms', 'mean': 'mean_ms'}.get(sort, sort)
+        rows.sort(key=lambda row: row[key], reverse=True)
+        return rows[:limit]
+
+    def reset(self):
+        with self.lock:
+            self.entries.clear()
+            self.since = time.time()
@@ -0,0 +1,115 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+# Seconds in a year of round-the-clock crypto trading, for annualizing
+SECONDS_PER_YEAR = 365 * 24 * 60 * 60
+
+
+class RiskCache:
+    """LRU of window statistics keyed on (asset set, window)
+
+    Entries are only valid for the prices they were computed from, so the
+    whole cache is dropped whenever new prices are ingested. A generation
+    counter keeps a computation that raced with an ingestion from storing
+    its (already stale) result afterwards.
+    """
+
+    def __init__(self, max_entries=128):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.max_entries = max_entries
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Return (entry or None, generation to pass to put())"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries.move_to_end(key)
+            return entry, self.generation
+
+    def put(self, key, entry, generation):
+        """Store an entry unless prices changed since generation"""
+        with self.lock:
+            if generation != self.generation:
+                return
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def invalidate(self):
+        """Drop every entry (new prices were ingested)"""
+        with self.lock:
+            self.entries.clear()
+            self.generation += 1
+
+
+def window_statistics(timestamps, prices, window):
+    """Return statistics of the last window bars of aligned prices (see backtest.align_series)
+
+    Bars before every asset has a price are dropped so all returns are
+    over the same periods. Returns None when fewer than two bars remain.
+    """
+    complete = ~np.isnan(prices).any(axis=1)
+    timestamps, prices = timestamps[complete], prices[complete]
+    timestamps, prices = timestamps[-(window + 1):], np.ascontiguousarray(prices[-(window + 1):])
+    if len(timestamps) < 2:
+        return None
+
+    returns = prices[1:] / prices[:-1] - 1
+    covariance = np.atleast_2d(np.cov(returns, rowvar=False))
+    deviations = np.sqrt(np.diag(covariance))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        correlation = covariance / np.outer(deviations, deviations)
+    np.fill_diagonal(correlation, 1.0)
+
+    return {
+        "timestamps": timestamps,
+        "prices": prices,
+        "returns": returns,
+        "covariance": covariance,
+        "correlation": correlation,
+        "bar_seconds": float(np.median(np.diff(timestamps)))
+    }
+
+
+def portfolio_risk(stats, quantities, confidence=0.95, horizon=1):
+    """Volatility, historical VaR and max drawdown of fixed holdings over a window
+
+    quantities are units held per asset, in the column order of stats.
+    VaR is the loss not exceeded with the given confidence over horizon
+    bars, from the window's overlapping horizon-bar returns.
+    """
+    prices = stats["prices"]
+    values = prices @ quantities  # portfolio value at each bar, holdings kept fixed
+    current_value = float(values[-1])
+    weights = prices[-1] * quantities / current_value
+
+    # Variance from the covariance matrix: w' S w
+    bar_volatility = float(np.sqrt(max(weights @ stats["covariance"] @ weights, 0.0)))
+    bars_per_year = SECONDS_PER_YEAR / max(stats["bar_seconds"], 1.0)
+
+    horizon_returns = values[horizon:] / values[:-horizon] - 1
+    if len(horizon_returns):
+        var_return = -float(np.quantile(horizon_returns, 1 - confidence))
+    else:
+        var_return = None
+
+    drawdowns = values / np.maximum.accumulate(values) - 1
+    return {
+        "value": current_value,
+        "weights": weights,
+        "volatility": bar_volatility,
+        "annualized_volatility": bar_volatility * float(np.sqrt(bars_per_year)),
+        "var_return": var_return,
+        "var": var_return * current_value if var_return is not None else None,
+        "max_drawdown": float(drawdowns.min())
+    }
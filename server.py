@@ -3,18 +3,67 @@ import sqlite3
 import requests
 import time
 import logging
-from flask import Flask, request, jsonify
+import queue
+import atexit
+import json
+import uuid
+import threading
+import math
+import io
+import hmac
+import hashlib
+import base64
+import secrets
+import re
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, ExitStack
+from functools import wraps
+from datetime import datetime, timezone
+from decimal import Decimal, InvalidOperation, ROUND_HALF_EVEN
+from flask import Flask, Response, g, request, jsonify, make_response, stream_with_context
 from flask_cors import CORS
-
-# Logging Configuration
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('server.log'),
-        logging.StreamHandler()
-    ]
+import numpy as np
+from valuation import ValuationCache, position_value
+from leaderboard import Leaderboard
+from backtest import load_prices, pivot_prices, run_backtest
+from sweep import RANK_METRICS, parameter_grid, run_sweep
+from risk import RiskCache, window_statistics, portfolio_risk
+from market_snapshot import SharedSnapshot
+from metrics import Registry
+from log_pipeline import configure_logging
+from query_log import QueryStats, fingerprint
+from profiling import RequestProfiler
+
+try:
+    import fcntl
+except ImportError:  # Windows: no flock, so only a single server process is supported
+    fcntl = None
+
+# Logging Configuration: records are queued and written by a background
+# listener thread (see LogPipeline), so request threads never wait on disk
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_FILE = os.environ.get('LOG_FILE', 'server.log')  # empty: console only
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'text').lower()  # 'text' or 'json'
+LOG_MAX_BYTES = int(os.environ.get('LOG_MAX_BYTES', 10 * 1024 * 1024))  # rotate at this size, 0 = never
+LOG_BACKUP_COUNT = int(os.environ.get('LOG_BACKUP_COUNT', 5))
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', 10000))  # records waiting before new ones are dropped
+LOG_SAMPLE_LIMIT = int(os.environ.get('LOG_SAMPLE_LIMIT', 100))  # info records per call site per second, 0 = all
+if LOG_FORMAT not in ('text', 'json'):
+    raise ValueError(f"LOG_FORMAT must be 'text' or 'json', not {LOG_FORMAT!r}")
+
+log_pipeline = configure_logging(
+    level=LOG_LEVEL,
+    path=LOG_FILE,
+    json_output=LOG_FORMAT == 'json',
+    max_bytes=LOG_MAX_BYTES,
+    backup_count=LOG_BACKUP_COUNT,
+    queue_size=LOG_QUEUE_SIZE,
+    sample_limit=LOG_SAMPLE_LIMIT,
 )
+if log_pipeline is not None:
+    # Registered before any other exit handler, so it runs last and their records are written
+    atexit.register(log_pipeline.stop)
 logger = logging.getLogger(__name__)
 
 # Single Database Configuration
@@ -27,15 +76,265 @@ CORS(app)  # Enable CORS for all routes
 # Configuration
 CRYPTO_API_URL = "https://api.coingecko.com/api/v3/coins/markets"
 
+# Fixed-point representation: balances and quantities are stored as integer
+# micro-units (1 unit == 1_000_000 micros) so trade math is exact
+MICROS = 1_000_000
+
+# Prices (average purchase prices, lots, fills) are integers at a finer scale:
+# at micro-units a $0.0000098 asset would trade at $0.00001, and anything below
+# $0.0000005 for nothing. Only the cash notional of a fill is rounded, to micros
+PRICE_SCALE = 10 ** 12
+MAX_PRICE = 10 ** 6 * PRICE_SCALE  # $1,000,000, inside SQLite's 64-bit INTEGER
+
+# Starting balance of a new account (micro-units)
+INITIAL_BALANCE = 1000 * MICROS
+
+# Largest amount or quantity accepted in a request, and largest balance a deposit
+# may reach (micro-units); both stay far below SQLite's 64-bit INTEGER limit, where
+# arithmetic would silently turn into REAL
+MAX_AMOUNT = 10 ** 9 * MICROS
+MAX_BALANCE = 10 ** 12 * MICROS
+
+# Schema version stored in PRAGMA user_version, see migrate_db()
+SCHEMA_VERSION = 5
+
+# Cost basis used for realized P&L on sells: 'average' or 'fifo'
+COST_BASIS_METHOD = os.environ.get('COST_BASIS_METHOD', 'average').lower()
+if COST_BASIS_METHOD not in ('average', 'fifo'):
+    raise ValueError(f"COST_BASIS_METHOD must be 'average' or 'fifo', not {COST_BASIS_METHOD!r}")
+
+# Per-user serialization of balance and portfolio mutations
+USER_LOCK_STRIPES = int(os.environ.get('USER_LOCK_STRIPES', 256))
+DB_TIMEOUT = float(os.environ.get('DB_TIMEOUT', 30))
+
+# Session tokens: HMAC signing secret, lifetime and size of the validated-token cache
+SESSION_SECRET = os.environ.get('SESSION_SECRET', '')
+SESSION_TTL = int(os.environ.get('SESSION_TTL', 24 * 60 * 60))  # seconds
+SESSION_CACHE_SIZE = int(os.environ.get('SESSION_CACHE_SIZE', 10000))
+PUBLIC_ENDPOINTS = {  # reachable without a session
+    'create_account', 'login', 'get_metrics', 'get_query_stats', 'reset_query_stats',
+    'get_profile', 'start_profile', 'stop_profile', 'download_profile',
+}
+
+# Bearer token required by /metrics (open when empty)
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+
+# Bearer token required by the /admin endpoints (disabled when empty)
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN', '')
+
+# Statements slower than this are logged with their query plan (0 disables the log)
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', 100))
+
+# Fraction of requests profiled from startup (0 = only when enabled via /admin/profile)
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+
+# Per-client rate limits: endpoint -> (requests per second, burst). Clients are
+# keyed by session user, or by address on the public endpoints
+RATE_LIMITING = os.environ.get('RATE_LIMITING', '1') == '1'
+RATE_LIMITS = {
+    'create_account': (0.1, 3),
+    'login': (0.5, 5),
+    'get_market_data': (2, 10),
+    'buy_asset': (10, 20),
+    'sell_asset': (10, 20),
+    'add_asset': (10, 20),
+    'remove_asset': (10, 20),
+    'deposit': (2, 10),
+    'withdraw': (2, 10),
+    'rebuild_account_state': (0.1, 2),
+    'get_price_matrix': (1, 5),
+    'get_risk_analytics': (1, 5),
+    'backtest_strategy': (0.2, 3),
+    'sweep_strategy': (0.02, 1),
+}
+DEFAULT_RATE_LIMIT = (20, 40)
+RATE_LIMIT_SWEEP_INTERVAL = 60  # seconds between evictions of idle (full) buckets
+
+# Password hashing (scrypt) and the bounded pool that runs it
+SCRYPT_N = 2 ** 14
+SCRYPT_R = 8
+SCRYPT_P = 1
+KDF_WORKERS = int(os.environ.get('KDF_WORKERS', 2))
+# Hashes computing or waiting per process before logins get 503 (0: half the request threads)
+KDF_MAX_PENDING = int(os.environ.get('KDF_MAX_PENDING', 0))
+
+# Idempotency-Key handling for trade and funds endpoints
+IDEMPOTENCY_TTL = int(os.environ.get('IDEMPOTENCY_TTL', 24 * 60 * 60))  # seconds
+IDEMPOTENCY_LEASE = int(os.environ.get('IDEMPOTENCY_LEASE', 60))  # seconds an in-progress claim is honoured
+IDEMPOTENCY_CACHE_SIZE = int(os.environ.get('IDEMPOTENCY_CACHE_SIZE', 10000))
+IDEMPOTENCY_EVICT_EVERY = 1000  # stored keys between expired-row sweeps
+
+# Asynchronous order intake for /trade/buy and /trade/sell (disabled by default)
+ASYNC_ORDER_INTAKE = os.environ.get('ASYNC_ORDER_INTAKE', '0') == '1'
+ORDER_WORKERS = int(os.environ.get('ORDER_WORKERS', 4))
+ORDER_BATCH_SIZE = int(os.environ.get('ORDER_BATCH_SIZE', 64))
+ORDER_QUEUE_SIZE = int(os.environ.get('ORDER_QUEUE_SIZE', 10000))  # per worker
+ORDER_MAX_WAIT = 30  # longest /orders/<id>?wait= long-poll, in seconds
+
+# In-memory portfolio valuation cache (see valuation.ValuationCache)
+VALUATION_CACHE = os.environ.get('VALUATION_CACHE', '1') == '1'
+
+# Largest top-N served by /leaderboard
+LEADERBOARD_MAX_LIMIT = 100
+
+# Portfolio snapshots for /portfolio/history (0 disables the background job)
+SNAPSHOT_INTERVAL = int(os.environ.get('SNAPSHOT_INTERVAL', 300))  # seconds
+HISTORY_MAX_POINTS = 1000  # default and upper bound for downsampled equity curves
+
+# Backtesting: columnar price cache ('' reads SQLite every time) and request bounds
+BACKTEST_CACHE_DIR = os.environ.get('BACKTEST_CACHE_DIR', os.path.join(BASE_DIR, 'price_cache'))
+BACKTEST_MAX_ASSETS = 100
+
+# Price matrix: most assets and grid rows per /prices/matrix request
+PRICE_MATRIX_MAX_ASSETS = 100
+PRICE_MATRIX_MAX_ROWS = 100000
+
+# Risk analytics: price bars per window (default and upper bound) and cached windows
+RISK_DEFAULT_WINDOW = 1000
+RISK_MAX_WINDOW = 100000
+RISK_CACHE_SIZE = 128
+
+# Parameter sweeps: worker processes per sweep and largest accepted grid
+SWEEP_WORKERS = int(os.environ.get('SWEEP_WORKERS', os.cpu_count() or 1))
+SWEEP_MAX_COMBINATIONS = 10000
+
+# Live market data refresh interval, and recording/replay of ticks (see MarketReplay)
+MARKET_REFRESH_INTERVAL = 45  # seconds
+MARKET_RECORD_FILE = os.environ.get('MARKET_RECORD_FILE', '')
+MARKET_REPLAY_FILE = os.environ.get('MARKET_REPLAY_FILE', '')
+MARKET_REPLAY_SPEED = float(os.environ.get('MARKET_REPLAY_SPEED', 100))  # x real time, 0 = unthrottled
+MARKET_REPLAY_LOOP = os.environ.get('MARKET_REPLAY_LOOP', '0') == '1'
+
+# Ledger write-behind configuration (disabled by default, see LedgerWriter)
+LEDGER_WRITE_BEHIND = os.environ.get('LEDGER_WRITE_BEHIND', '0') == '1'
+LEDGER_QUEUE_SIZE = int(os.environ.get('LEDGER_QUEUE_SIZE', 10000))
+LEDGER_FLUSH_INTERVAL = float(os.environ.get('LEDGER_FLUSH_INTERVAL', 0.005))
+LEDGER_BATCH_SIZE = int(os.environ.get('LEDGER_BATCH_SIZE', 500))
+
+# Production serving (see create_app() and serve_production()): worker processes
+# sharing the database (gunicorn's WEB_CONCURRENCY), threads per worker and address
+PRODUCTION = os.environ.get('PRODUCTION', '0') == '1'
+WORKERS = int(os.environ.get('WEB_CONCURRENCY', 1))
+WORKER_THREADS = int(os.environ.get('WORKER_THREADS', 8))
+SERVER_BIND = os.environ.get('SERVER_BIND', '127.0.0.1:5000')
+
+# Memory-mapped segment holding the latest market tick for all workers (see SharedSnapshot)
+MARKET_SNAPSHOT_FILE = os.environ.get('MARKET_SNAPSHOT_FILE', DATABASE_PATH + '.market')
+MARKET_SNAPSHOT_SIZE = int(os.environ.get('MARKET_SNAPSHOT_SIZE', 4 * 1024 * 1024))  # bytes
+
+# Cross-process locks: database initialization, and leadership (see elect_leader())
+INIT_LOCK_FILE = DATABASE_PATH + '.init.lock'
+LEADER_LOCK_FILE = DATABASE_PATH + '.leader.lock'
+
 # Global variable to store last update time and market data
 last_update_time = 0
 market_data_cache = None
 
+# Recorded market data replay, started by start_market_replay() when configured
+market_replay = None
+
+# Live market data poller of the leader: a thread started by start_market_refresher(),
+# or the asyncio task of server_async
+market_refresher = None
+
+# Market tick shared by all workers, opened by open_market_snapshot() when several serve,
+# and the version of it this process's valuations are marked at
+market_snapshot = None
+market_snapshot_version = 0
+market_snapshot_lock = threading.Lock()
+
+# Held for life by the leader process, see elect_leader()
+leader_lock = None
+
+# Set once create_app() has started this process's services
+app_started = False
+
+# Whether other processes may serve the same database, see serving_multiprocess()
+multiprocess = False
+
+# Return statistics per (asset set, window), invalidated by ingest_market_data()
+risk_cache = RiskCache(RISK_CACHE_SIZE)
+
+# Background ledger writer, created by start_ledger_writer() when enabled
+ledger_writer = None
+
+# Valuation cache, built from the database by load_valuations()
+valuations = None
+
+# Last ledger event reflected in the valuation cache, and the connection
+# sync_valuations() polls it with (only used under the lock)
+valuations_seq = 0
+valuations_sync_lock = threading.Lock()
+valuations_sync_conn = None
+
+# Net-worth ranking, fed from the valuation cache
+leaderboard = Leaderboard()
+
+# Background portfolio snapshot thread, started by start_snapshot_job()
+snapshot_thread = None
+
+# Asynchronous order intake, created by start_order_intake() when enabled
+order_intake = None
+failed_orders = OrderedDict()  # orders whose whole batch failed to commit
+
+# Key used to sign session tokens; a random one only lasts for this process
+session_key = SESSION_SECRET.encode() or secrets.token_bytes(32)
+session_key_pid = os.getpid()  # worker processes forked after import inherit the same key
+if not SESSION_SECRET:
+    logger.warning("SESSION_SECRET is not set; session tokens will not survive a restart")
+
+# In-memory LRU of validated session tokens: token -> (username, expires_at)
+session_cache = OrderedDict()
+session_lock = threading.Lock()
+
+# In-memory LRU of completed idempotent responses: key -> (endpoint, status, body, created_at)
+idempotency_cache = OrderedDict()
+idempotency_lock = threading.Lock()
+idempotency_stores = 0
+
+# Metrics exposed at /metrics; gauges are registered with the objects they read
+registry = Registry()
+request_latency = registry.histogram(
+    'http_request_duration_seconds', 'Time from routing to response, by route', ('endpoint', 'method'))
+request_count = registry.counter('http_requests_total', 'Responses by route and status', ('endpoint', 'method', 'status'))
+query_latency = registry.histogram(
+    'db_query_duration_seconds', 'SQLite statement execution time by statement class', ('operation', 'table'))
+cache_requests = registry.counter('cache_requests_total', 'Cache lookups by cache and outcome', ('cache', 'result'))
+market_fetch_latency = registry.histogram(
+    'market_data_fetch_duration_seconds', 'Market data API calls', ('outcome',),
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30))
+market_ticks = registry.counter('market_ticks_total', 'Market data ticks applied, by source', ('source',))
+trade_count = registry.counter('trades_total', 'Executed orders by side and response status', ('side', 'status'))
+trade_latency = registry.histogram('trade_duration_seconds', 'Synchronous trade execution and commit time', ('side',))
+order_batch_latency = registry.histogram('order_batch_duration_seconds', 'Asynchronous order batch execution time')
+order_batch_size = registry.histogram(
+    'order_batch_size', 'Orders per asynchronous batch', buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256, 512))
+
+def create_idempotency_keys_table(cursor):
+    """Create the idempotency keys table: a key is only unique within its user's requests"""
+    cursor.execute(""" 
+    CREATE TABLE IF NOT EXISTS idempotency_keys (
+        username TEXT NOT NULL,
+        key TEXT NOT NULL,
+        endpoint TEXT NOT NULL,
+        status_code INTEGER NOT NULL,
+        response BLOB,
+        created_at INTEGER NOT NULL,
+        PRIMARY KEY (username, key)
+    ) WITHOUT ROWID""")
+    cursor.execute(""" 
+    CREATE INDEX IF NOT EXISTS idx_idempotency_keys_created_at
+    ON idempotency_keys (created_at)""")
+
 def init_db():
     """Initialize the database and create necessary tables"""
     try:
-        with sqlite3.connect(DATABASE_PATH) as conn:
+        with connect_db(DATABASE_PATH) as conn:
             cursor = conn.cursor()
+
+            # Write-ahead log (persistent in the file): readers no longer wait for a
+            # committing writer, nor writers for readers. Writers still take turns
+            cursor.execute("PRAGMA journal_mode=WAL")
             
             # Accounts Table
             cursor.execute(""" 
@@ -43,7 +342,7 @@ def init_db():
                 username TEXT PRIMARY KEY,
                 password TEXT NOT NULL,
                 email TEXT UNIQUE,
-                balance REAL NOT NULL DEFAULT 1000.0,
+                balance INTEGER NOT NULL DEFAULT 1000000000,
                 created_at DATETIME DEFAULT CURRENT_TIMESTAMP
             )""")
             
@@ -73,8 +372,8 @@ def init_db():
             CREATE TABLE IF NOT EXISTS portfolios (
                 username TEXT NOT NULL,
                 asset_name TEXT NOT NULL,
-                quantity REAL NOT NULL DEFAULT 0.0,
-                avg_purchase_price REAL NOT NULL DEFAULT 0.0,
+                quantity INTEGER NOT NULL DEFAULT 0,
+                avg_purchase_price INTEGER NOT NULL DEFAULT 0,
                 PRIMARY KEY (username, asset_name)
             )""")
 
@@ -86,6 +385,87 @@ def init_db():
                 timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
                 PRIMARY KEY (asset_name, timestamp)
             )""")
+
+            # Orders Table (fills recorded by the asynchronous intake workers)
+            cursor.execute(""" 
+            CREATE TABLE IF NOT EXISTS orders (
+                id TEXT PRIMARY KEY,
+                username TEXT NOT NULL,
+                side TEXT NOT NULL,
+                asset_name TEXT NOT NULL,
+                quantity INTEGER NOT NULL,
+                status TEXT NOT NULL,
+                status_code INTEGER NOT NULL,
+                result TEXT,
+                created_at REAL NOT NULL,
+                completed_at REAL
+            ) WITHOUT ROWID""")
+
+            # Portfolio Snapshots Table (equity curve, micro-units, clustered by user)
+            cursor.execute(""" 
+            CREATE TABLE IF NOT EXISTS portfolio_snapshots (
+                username TEXT NOT NULL,
+                taken_at INTEGER NOT NULL,
+                balance INTEGER NOT NULL,
+                holdings_value INTEGER NOT NULL,
+                PRIMARY KEY (username, taken_at)
+            ) WITHOUT ROWID""")
+
+            # Ledger Events Table (append-only; amount and quantity are signed deltas)
+            cursor.execute(""" 
+            CREATE TABLE IF NOT EXISTS ledger_events (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                username TEXT NOT NULL,
+                event_type TEXT NOT NULL,
+                asset_name TEXT,
+                quantity INTEGER NOT NULL DEFAULT 0,
+                price INTEGER NOT NULL DEFAULT 0,
+                amount INTEGER NOT NULL DEFAULT 0,
+                created_at REAL NOT NULL
+            )""")
+            cursor.execute(""" 
+            CREATE INDEX IF NOT EXISTS idx_ledger_events_username_seq
+            ON ledger_events (username, seq)""")
+
+            # Account Snapshots Table (state of an account after event seq)
+            cursor.execute(""" 
+            CREATE TABLE IF NOT EXISTS account_snapshots (
+                username TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                balance INTEGER NOT NULL,
+                positions TEXT NOT NULL,
+                taken_at REAL NOT NULL,
+                PRIMARY KEY (username, seq)
+            ) WITHOUT ROWID""")
+
+            # Position Lots Table (open purchase lots, consumed oldest first)
+            cursor.execute(""" 
+            CREATE TABLE IF NOT EXISTS position_lots (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                username TEXT NOT NULL,
+                asset_name TEXT NOT NULL,
+                quantity INTEGER NOT NULL,
+                price INTEGER NOT NULL
+            )""")
+            cursor.execute(""" 
+            CREATE INDEX IF NOT EXISTS idx_position_lots_position
+            ON position_lots (username, asset_name, id)""")
+
+            # Position P&L Table (running totals; kept after a position is closed)
+            cursor.execute(""" 
+            CREATE TABLE IF NOT EXISTS position_pnl (
+                username TEXT NOT NULL,
+                asset_name TEXT NOT NULL,
+                realized_pnl INTEGER NOT NULL DEFAULT 0,
+                fifo_cost_basis INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (username, asset_name)
+            ) WITHOUT ROWID""")
+
+            # Idempotency Keys Table (per user; status_code 0 marks a request in progress)
+            create_idempotency_keys_table(cursor)
+
+            # Bring databases created by older versions up to date
+            migrate_db(conn)
         
         logger.info(f"Database initialized at {DATABASE_PATH}")
     
@@ -93,86 +473,1958 @@ def init_db():
         logger.error(f"Database initialization failed: {e}")
         raise
 
+class TicketLock:
+    """FIFO lock: waiters acquire it strictly in arrival order"""
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._next_ticket = 0
+        self._now_serving = 0
+
+    def __enter__(self):
+        with self._condition:
+            ticket = self._next_ticket
+            self._next_ticket += 1
+            while ticket != self._now_serving:
+                self._condition.wait()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        with self._condition:
+            self._now_serving += 1
+            self._condition.notify_all()
+
+# Statement class (operation, table) and fingerprint per SQL string, see statement_info()
+statement_infos = {}
+STATEMENT_TABLE = re.compile(r'\b(?:FROM|INTO|UPDATE|ON|TABLE(?:\s+IF\s+NOT\s+EXISTS)?)\s+([A-Za-z_]\w*)', re.IGNORECASE)
+EXPLAINED_OPERATIONS = {'select', 'insert', 'update', 'delete', 'replace', 'with'}
+
+# Per-fingerprint totals of every statement run by this process, see /admin/queries
+query_stats = QueryStats()
+
+# Sampled request profiling, switched on and off through /admin/profile
+profiler = RequestProfiler()
+
+def statement_info(sql):
+    """Return (operation, table, fingerprint) of a statement, e.g. ('select', 'accounts', 'SELECT ...')"""
+    cached = statement_infos.get(sql)
+    if cached is None:
+        words = sql.split(None, 1)
+        operation = words[0].lower() if words else ''
+        table = STATEMENT_TABLE.search(sql)
+        cached = (operation, table.group(1).lower() if table else '', fingerprint(sql))
+        # Statements are literals, but some embed a variable number of placeholders
+        if len(statement_infos) > 4096:
+            statement_infos.clear()
+        statement_infos[sql] = cached
+    return cached
+
+def explain_query(conn, sql, parameters):
+    """Return SQLite's query plan of a statement as one line, or None"""
+    try:
+        rows = sqlite3.Cursor(conn).execute("EXPLAIN QUERY PLAN " + sql, parameters).fetchall()
+    except sqlite3.Error:
+        return None
+    return '; '.join(row[3] for row in rows)
+
+def record_query(conn, sql, parameters, duration):
+    """Time a statement in the metrics and query stats; log it when slow
+
+    parameters is None when there is no single parameter set to explain
+    the statement with. Parameter values are never logged.
+    """
+    operation, table, statement = statement_info(sql)
+    query_latency.observe(duration, operation, table)
+    slow = SLOW_QUERY_MS > 0 and duration * 1000 >= SLOW_QUERY_MS
+    query_stats.record(statement, duration, slow)
+    if not slow:
+        return
+    plan = query_stats.plan(statement)
+    if plan is None and parameters is not None and operation in EXPLAINED_OPERATIONS:
+        # Explained once per fingerprint
+        plan = explain_query(conn, sql, parameters)
+        query_stats.set_plan(statement, plan)
+    logger.warning(
+        f"Slow query ({duration * 1000:.1f} ms): {statement}" + (f" | plan: {plan}" if plan else ""),
+        extra={"fingerprint": statement, "duration_ms": round(duration * 1000, 3), "plan": plan},
+    )
+
+class TimedCursor(sqlite3.Cursor):
+    """Cursor recording execution time per statement, see record_query()
+
+    For a SELECT this covers preparing it and stepping to the first row;
+    rows fetched afterwards are not included.
+    """
+
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            record_query(self.connection, sql, parameters, time.perf_counter() - started)
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            record_query(self.connection, sql, None, time.perf_counter() - started)
+
+class TimedConnection(sqlite3.Connection):
+    """Connection whose cursors, shortcut execute() and commit() are timed"""
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def commit(self):
+        started = time.perf_counter()
+        try:
+            super().commit()
+        finally:
+            record_query(self, 'COMMIT', None, time.perf_counter() - started)
+
+def connect_db(database, **kwargs):
+    """sqlite3.connect() returning an instrumented TimedConnection"""
+    return sqlite3.connect(database, factory=TimedConnection, **kwargs)
+
+# Striped locks: every user maps to one stripe, so a user's mutations are
+# strictly ordered while different users mostly proceed in parallel
+user_locks = [TicketLock() for _ in range(USER_LOCK_STRIPES)]
+
+def user_lock(username):
+    """Return the lock stripe that serializes mutations for a user"""
+    return user_locks[hash(username) % USER_LOCK_STRIPES]
+
+@contextmanager
+def user_transaction(username):
+    """Hold the user's lock and run the block in one write transaction
+
+    BEGIN IMMEDIATE takes SQLite's write lock before the first read, so the
+    read-check-update sequences in the handlers are atomic even against
+    other processes writing the same database. SQLite has a single writer,
+    so write transactions of all users run one at a time; the user's lock
+    only keeps that user's requests in arrival order without polling the
+    busy handler. Reads are not blocked (the database is in WAL mode).
+    """
+    with user_lock(username):
+        with connect_db(DATABASE_PATH, timeout=DB_TIMEOUT) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            yield conn
+
+def to_micros(value):
+    """Convert a decimal amount to integer micro-units"""
+    try:
+        amount = Decimal(str(value))
+    except InvalidOperation:
+        raise ValueError(f"Invalid amount: {value}")
+    if not amount.is_finite():
+        raise ValueError(f"Invalid amount: {value}")
+    units = int((amount * MICROS).to_integral_value(rounding=ROUND_HALF_EVEN))
+    if abs(units) > MAX_AMOUNT:
+        raise ValueError(f"Amount out of range: {value}")
+    return units
+
+def from_micros(units):
+    """Convert integer micro-units to a float for JSON responses"""
+    return units / MICROS
+
+def mul_micros(a, b):
+    """Multiply two micro-unit values, rounding back to micro-units"""
+    # Round half away from zero; operands are non-negative in trade math
+    return (a * b + MICROS // 2) // MICROS
+
+def to_price(value):
+    """Convert a decimal price to integer price units (PRICE_SCALE per dollar)"""
+    try:
+        price = Decimal(str(value))
+    except InvalidOperation:
+        raise ValueError(f"Invalid price: {value}")
+    if not price.is_finite() or price < 0:
+        raise ValueError(f"Invalid price: {value}")
+    units = int((price * PRICE_SCALE).to_integral_value(rounding=ROUND_HALF_EVEN))
+    if units > MAX_PRICE:
+        raise ValueError(f"Price out of range: {value}")
+    return units
+
+def from_price(units):
+    """Convert integer price units to a float for JSON responses"""
+    return units / PRICE_SCALE
+
+def format_price(units):
+    """A price for messages: in cents, or every significant digit below $1"""
+    if units >= PRICE_SCALE:
+        return f"{from_price(units):.2f}"
+    return format((Decimal(units) / PRICE_SCALE).normalize(), 'f')
+
+def notional(price, quantity):
+    """Cash value (micro-units) of quantity (micro-units) at price (price units)"""
+    # Round half away from zero; operands are non-negative in trade math
+    return (price * quantity + PRICE_SCALE // 2) // PRICE_SCALE
+
+def average_price(avg_price, held, price, quantity):
+    """Average price (price units) of held units at avg_price plus quantity more at price"""
+    total = held + quantity
+    return (avg_price * held + price * quantity + total // 2) // total
+
+def value_position(quantity, current_price):
+    """Value (micro-units) of quantity (micro-units) at a market price in dollars"""
+    # NULL for the unmatched rows of an outer join, which SUM() skips
+    if quantity is None or current_price is None:
+        return None
+    return position_value(quantity, to_price(current_price))
+
+def register_value_position(conn):
+    """Make value_position() callable from SQL on a connection"""
+    conn.create_function('value_position', 2, value_position, deterministic=True)
+
+def add_to_position(cursor, username, asset_name, quantity, price):
+    """Add quantity (micro-units) bought at price (price units) to a position, updating its average cost"""
+    cursor.execute(
+        "SELECT quantity, avg_purchase_price FROM portfolios WHERE username = ? AND asset_name = ?",
+        (username, asset_name)
+    )
+    position = cursor.fetchone()
+    if position is None:
+        cursor.execute("""
+            INSERT INTO portfolios (username, asset_name, quantity, avg_purchase_price)
+            VALUES (?, ?, ?, ?)
+        """, (username, asset_name, quantity, price))
+        return
+
+    # Weighted average in Python integers, which cannot overflow like SQLite's
+    held, avg_purchase_price = position
+    new_quantity = held + quantity
+    new_avg_price = average_price(avg_purchase_price, held, price, quantity)
+    cursor.execute("""
+        UPDATE portfolios SET quantity = ?, avg_purchase_price = ?
+        WHERE username = ? AND asset_name = ?
+    """, (new_quantity, new_avg_price, username, asset_name))
+
+def _column_type(cursor, table, column):
+    """Return the declared type of a table column"""
+    cursor.execute(f"PRAGMA table_info({table})")
+    for row in cursor.fetchall():
+        if row[1] == column:
+            return row[2].upper()
+    return None
+
+def _migrate_fixed_point(cursor):
+    """Convert REAL balances and positions to integer micro-units"""
+    if _column_type(cursor, 'accounts', 'balance') == 'REAL':
+        cursor.execute("ALTER TABLE accounts RENAME TO accounts_old")
+        cursor.execute("""
+            CREATE TABLE accounts (
+                username TEXT PRIMARY KEY,
+                password TEXT NOT NULL,
+                email TEXT UNIQUE,
+                balance INTEGER NOT NULL DEFAULT 1000000000,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            )""")
+        cursor.execute("""
+            INSERT INTO accounts (username, password, email, balance, created_at)
+            SELECT username, password, email, CAST(ROUND(balance * ?) AS INTEGER), created_at
+            FROM accounts_old
+        """, (MICROS,))
+        cursor.execute("DROP TABLE accounts_old")
+
+    if _column_type(cursor, 'portfolios', 'quantity') == 'REAL':
+        cursor.execute("ALTER TABLE portfolios RENAME TO portfolios_old")
+        cursor.execute("""
+            CREATE TABLE portfolios (
+                username TEXT NOT NULL,
+                asset_name TEXT NOT NULL,
+                quantity INTEGER NOT NULL DEFAULT 0,
+                avg_purchase_price INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (username, asset_name)
+            )""")
+        cursor.execute("""
+            INSERT INTO portfolios (username, asset_name, quantity, avg_purchase_price)
+            SELECT username, asset_name,
+                   CAST(ROUND(quantity * ?) AS INTEGER),
+                   CAST(ROUND(avg_purchase_price * ?) AS INTEGER)
+            FROM portfolios_old
+        """, (MICROS, MICROS))
+        cursor.execute("DROP TABLE portfolios_old")
+
+        # Positions that were only float dust are dropped
+        cursor.execute("DELETE FROM portfolios WHERE quantity <= 0")
+
+def _migrate_event_ledger(cursor):
+    """Seed the event ledger with a seq 0 snapshot of every existing account"""
+    cursor.execute("SELECT username, balance FROM accounts")
+    accounts = cursor.fetchall()
+    cursor.execute("SELECT username, asset_name, quantity, avg_purchase_price FROM portfolios")
+    positions = {}
+    for username, asset_name, quantity, avg_purchase_price in cursor.fetchall():
+        positions.setdefault(username, {})[asset_name] = [quantity, avg_purchase_price]
+
+    now = time.time()
+    cursor.executemany("""
+        INSERT OR IGNORE INTO account_snapshots (username, seq, balance, positions, taken_at)
+        VALUES (?, 0, ?, ?, ?)
+    """, [(username, balance, json.dumps(positions.get(username, {})), now) for username, balance in accounts])
+
+def _migrate_position_lots(cursor):
+    """Open one lot per existing position at its average purchase price"""
+    cursor.execute("SELECT username, asset_name, quantity, avg_purchase_price FROM portfolios")
+    positions = cursor.fetchall()
+    cursor.executemany("""
+        INSERT INTO position_lots (username, asset_name, quantity, price) VALUES (?, ?, ?, ?)
+    """, positions)
+    cursor.executemany("""
+        INSERT OR IGNORE INTO position_pnl (username, asset_name, fifo_cost_basis) VALUES (?, ?, ?)
+    """, [(username, asset_name, mul_micros(quantity, price)) for username, asset_name, quantity, price in positions])
+
+def _migrate_idempotency_owner(cursor):
+    """Scope idempotency keys to their user
+
+    Keys stored before this version cannot be attributed to a user, so
+    they are dropped; clients only lose replays of old requests.
+    """
+    if _column_type(cursor, 'idempotency_keys', 'username') is None:
+        cursor.execute("DROP TABLE idempotency_keys")
+        create_idempotency_keys_table(cursor)
+
+def _migrate_price_scale(cursor):
+    """Rescale stored prices from micro-units to PRICE_SCALE price units
+
+    Earlier versions kept prices at the cash scale, so the digits below a
+    micro-dollar are already lost; this keeps what is there.
+    """
+    factor = PRICE_SCALE // MICROS
+    cursor.execute("UPDATE portfolios SET avg_purchase_price = avg_purchase_price * ?", (factor,))
+    cursor.execute("UPDATE position_lots SET price = price * ?", (factor,))
+    cursor.execute("UPDATE ledger_events SET price = price * ?", (factor,))
+    cursor.execute("SELECT username, seq, positions FROM account_snapshots")
+    snapshots = [
+        (json.dumps({asset_name: [quantity, avg_price * factor] for asset_name, (quantity, avg_price) in json.loads(positions).items()}),
+         username, seq)
+        for username, seq, positions in cursor.fetchall()
+    ]
+    cursor.executemany("UPDATE account_snapshots SET positions = ? WHERE username = ? AND seq = ?", snapshots)
+
+# Schema migrations, applied in order; entry N upgrades user_version N to N + 1
+MIGRATIONS = [
+    _migrate_fixed_point,
+    _migrate_event_ledger,
+    _migrate_position_lots,
+    _migrate_idempotency_owner,
+    _migrate_price_scale,
+]
+
+def migrate_db(conn):
+    """Apply pending schema migrations inside a single transaction"""
+    cursor = conn.cursor()
+    cursor.execute("PRAGMA user_version")
+    version = cursor.fetchone()[0]
+    if version >= SCHEMA_VERSION:
+        return
+
+    cursor.execute("BEGIN")
+    for migration in MIGRATIONS[version:SCHEMA_VERSION]:
+        logger.info(f"Applying database migration: {migration.__name__}")
+        migration(cursor)
+    cursor.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+    conn.commit()
+
+# Rate Limiting
+class RateLimiter:
+    """Token buckets keyed by (endpoint, client), refilled lazily
+
+    Each bucket is a small list [tokens, last update, rate, burst]. It is
+    only refilled when its client makes a request, so idle clients cost
+    nothing. Buckets that have refilled completely carry no state and are
+    dropped by a periodic sweep, which keeps the dict as small as the set
+    of recently active clients.
+    """
+
+    def __init__(self, sweep_interval=RATE_LIMIT_SWEEP_INTERVAL):
+        self.lock = threading.Lock()
+        self.buckets = {}
+        self.sweep_interval = sweep_interval
+        self.next_sweep = time.monotonic() + sweep_interval
+
+    def acquire(self, key, rate, burst):
+        """Take one token; returns 0 when allowed, else seconds until a token is available"""
+        now = time.monotonic()
+        with self.lock:
+            if now >= self.next_sweep:
+                self._sweep(now)
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                self.buckets[key] = [burst - 1.0, now, rate, burst]
+                return 0.0
+            tokens = bucket[0] + (now - bucket[1]) * rate
+            if tokens > burst:
+                tokens = burst
+            bucket[1] = now
+            if tokens >= 1.0:
+                bucket[0] = tokens - 1.0
+                return 0.0
+            bucket[0] = tokens
+            return (1.0 - tokens) / rate
+
+    def _sweep(self, now):
+        """Drop buckets that are full again (lock held)"""
+        self.buckets = {
+            key: bucket for key, bucket in self.buckets.items()
+            if bucket[0] + (now - bucket[1]) * bucket[2] < bucket[3]
+        }
+        self.next_sweep = now + self.sweep_interval
+
+# Token buckets for RATE_LIMITS, checked by enforce_rate_limit()
+rate_limiter = RateLimiter()
+
+# Session Tokens
+def _b64encode(raw):
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode()
+
+def _b64decode(text):
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+def _sign(payload):
+    return _b64encode(hmac.new(session_key, payload.encode(), hashlib.sha256).digest())
+
+def issue_session_token(username):
+    """Return (token, expires_at) for a new signed session
+
+    The token is ``<payload>.<signature>``: base64url JSON claims (``sub``,
+    ``exp``) and their HMAC-SHA256, so it can be checked without a database
+    lookup.
+    """
+    expires_at = int(time.time()) + SESSION_TTL
+    payload = _b64encode(json.dumps({"sub": username, "exp": expires_at}, separators=(',', ':')).encode())
+    return f"{payload}.{_sign(payload)}", expires_at
+
+def verify_session_token(token):
+    """Return the username of a valid, unexpired session token, or None
+
+    Tokens that verified before are served from an in-memory LRU, so a
+    client's follow-up requests skip the HMAC and decoding.
+    """
+    now = time.time()
+    with session_lock:
+        cached = session_cache.get(token)
+        if cached is not None:
+            username, expires_at = cached
+            if expires_at > now:
+                session_cache.move_to_end(token)
+                cache_requests.inc('session', 'hit')
+                return username
+            del session_cache[token]
+            return None
+
+    cache_requests.inc('session', 'miss')
+    try:
+        payload, signature = token.split('.')
+        if not hmac.compare_digest(signature, _sign(payload)):
+            return None
+        claims = json.loads(_b64decode(payload))
+        username, expires_at = claims['sub'], claims['exp']
+    except (ValueError, KeyError, TypeError):
+        # Malformed token (bad base64, JSON or claims)
+        return None
+    if expires_at <= now:
+        return None
+
+    with session_lock:
+        session_cache[token] = (username, expires_at)
+        if len(session_cache) > SESSION_CACHE_SIZE:
+            session_cache.popitem(last=False)
+    return username
+
+# Password Hashing
+class KdfOverloaded(Exception):
+    """Raised when the KDF pool's queue is full"""
+
+class KdfPool:
+    """Bounded thread pool for password hashing and verification
+
+    scrypt releases the GIL, so its cost is CPU time on ``workers`` cores
+    at most, whatever the number of concurrent logins. At most
+    ``max_pending`` jobs are computed or waiting: each holds a request
+    thread, so the limit is set below the server's thread count (see
+    set_limit()) to keep threads for other routes. Further submits raise
+    KdfOverloaded immediately instead of tying up request threads. Queue
+    wait and compute time of recent jobs are kept for latency stats.
+    """
+
+    def __init__(self, workers=KDF_WORKERS, max_pending=None):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='kdf')
+        self.set_limit(max_pending or max(1, WORKER_THREADS // 2))
+        self.lock = threading.Lock()
+        self.waits = deque(maxlen=1000)
+        self.durations = deque(maxlen=1000)
+        self.completed = 0
+        self.rejected = 0
+
+    def set_limit(self, max_pending):
+        """Allow max_pending jobs computed or waiting (jobs already running keep their slot)"""
+        self.max_pending = max(1, max_pending)
+        self.slots = threading.BoundedSemaphore(self.max_pending)
+
+    def run(self, function, *args):
+        """Run function(*args) on the pool and return its result"""
+        slots = self.slots
+        if not slots.acquire(blocking=False):
+            with self.lock:
+                self.rejected += 1
+            raise KdfOverloaded()
+        submitted = time.perf_counter()
+        try:
+            return self.executor.submit(self._timed, function, args, submitted).result()
+        finally:
+            slots.release()
+
+    def _timed(self, function, args, submitted):
+        started = time.perf_counter()
+        try:
+            return function(*args)
+        finally:
+            finished = time.perf_counter()
+            with self.lock:
+                self.waits.append(started - submitted)
+                self.durations.append(finished - started)
+                self.completed += 1
+
+    def stats(self):
+        """Job counts and p50/p99 queue wait and compute time (seconds) of recent jobs"""
+        with self.lock:
+            waits, durations = np.array(self.waits), np.array(self.durations)
+            stats = {"completed": self.completed, "rejected": self.rejected}
+        for name, values in (("wait", waits), ("duration", durations)):
+            for q in (50, 99):
+                stats[f"{name}_p{q}"] = float(np.percentile(values, q)) if len(values) else 0.0
+        return stats
+
+kdf_pool = KdfPool(max_pending=KDF_MAX_PENDING)
+
+def _scrypt(password, salt, n, r, p):
+    return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p, maxmem=2 * 128 * n * r * p)
+
+def _hash_password(password):
+    """Return a new 'scrypt$n$r$p$salt$hash' string (runs on the KDF pool)"""
+    salt = secrets.token_bytes(16)
+    digest = _scrypt(password, salt, SCRYPT_N, SCRYPT_R, SCRYPT_P)
+    return f"scrypt${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}${_b64encode(salt)}${_b64encode(digest)}"
+
+def _verify_password(password, stored):
+    """Check a password against a stored scrypt hash (runs on the KDF pool)"""
+    _, n, r, p, salt, digest = stored.split('$')
+    return hmac.compare_digest(_scrypt(password, _b64decode(salt), int(n), int(r), int(p)), _b64decode(digest))
+
+def hash_password(password):
+    """Hash a password on the KDF pool; raises KdfOverloaded when it is full"""
+    return kdf_pool.run(_hash_password, password)
+
+def kdf_busy_response():
+    """503 response for requests turned away by a full KDF pool"""
+    response = jsonify({"message": "Too many logins in progress, please retry."})
+    response.headers['Retry-After'] = '1'
+    return response, 503
+
+# Verified against for unknown usernames so they take as long as known ones
+_DUMMY_PASSWORD_HASH = _hash_password(secrets.token_hex(16))
+
 def authenticate(username, password):
-    """Authenticate user credentials"""
+    """Authenticate user credentials
+
+    Passwords are stored as scrypt hashes. Accounts created before hashing
+    still hold the plaintext password; it is compared once and replaced by
+    its hash on that successful login. Raises KdfOverloaded when the KDF
+    pool cannot take the verification.
+    """
+    if not isinstance(password, str):
+        return False
     try:
-        with sqlite3.connect(DATABASE_PATH) as conn:
+        with connect_db(DATABASE_PATH) as conn:
             cursor = conn.cursor()
-            # Execute query to check if user exists with provided credentials
-            cursor.execute(
-                "SELECT * FROM accounts WHERE username = ? AND password = ?", 
-                (username, password)
-            )
-            # Return True if user is found, otherwise False
-            return cursor.fetchone() is not None
+            cursor.execute("SELECT password FROM accounts WHERE username = ?", (username,))
+            row = cursor.fetchone()
     except sqlite3.Error as e:
         # Log any database errors encountered during authentication
         logger.error(f"Authentication error: {e}")
         return False
 
+    if row is None:
+        kdf_pool.run(_verify_password, password, _DUMMY_PASSWORD_HASH)
+        return False
+
+    stored = row[0]
+    if stored.startswith('scrypt$'):
+        return kdf_pool.run(_verify_password, password, stored)
+
+    # Legacy plaintext password: check it, then migrate to a hash
+    if not hmac.compare_digest(stored.encode(), password.encode()):
+        return False
+    hashed = hash_password(password)
+    try:
+        with connect_db(DATABASE_PATH, timeout=DB_TIMEOUT) as conn:
+            # Only replace the value that was checked
+            conn.execute(
+                "UPDATE accounts SET password = ? WHERE username = ? AND password = ?",
+                (hashed, username, stored)
+            )
+            conn.commit()
+        logger.info(f"Migrated password of {username} to scrypt")
+    except sqlite3.Error as e:
+        logger.error(f"Password migration failed for {username}: {e}")
+    return True
+
 def update_market_data():
-    global last_update_time, market_data_cache
-    current_time = time.time()
-    
-    # Check if 45 seconds have passed since the last update
-    if current_time - last_update_time < 45:
+    """Return the latest market data, fetching it upstream when it is stale
+
+    Only one process talks to the API: with several workers the leader's
+    refresher thread polls it and every other worker reads the snapshot
+    the leader publishes. A process without a refresher (e.g. one that
+    never ran create_app()) still fetches lazily here.
+    """
+    # In replay mode the replay thread supplies every tick, else the refresher does
+    if market_replay is not None or market_refresher is not None:
+        return market_data_cache
+    if market_snapshot is not None:
+        # Decoded per call: workers other than the leader keep no copy
+        snapshot = market_snapshot.read()
+        return json.loads(snapshot[1]) if snapshot is not None else None
+
+    # Check if the refresh interval has passed since the last update
+    if time.time() - last_update_time < MARKET_REFRESH_INTERVAL:
         return market_data_cache  # Return cached data if it's still valid
-    
+    return fetch_market_data()
+
+def fetch_market_data():
+    """Poll the market data API and ingest the tick"""
+    global last_update_time
+    current_time = time.time()
     try:
         headers = {
             "accept": "application/json",
         }
         # Request market data from the API
-        response = requests.get(CRYPTO_API_URL, headers=headers, params={"vs_currency": "usd"})
-        response.raise_for_status()  # Raise an error for bad responses
-        market_data = response.json()
-
-        # Update the cache and last update time
-        market_data_cache = market_data
+        started = time.perf_counter()
+        try:
+            response = requests.get(CRYPTO_API_URL, headers=headers, params={"vs_currency": "usd"})
+            response.raise_for_status()  # Raise an error for bad responses
+            market_data = response.json()
+        except Exception:
+            market_fetch_latency.observe(time.perf_counter() - started, 'error')
+            raise
+        market_fetch_latency.observe(time.perf_counter() - started, 'ok')
+
+        # Store the tick, then keep a copy for later replay (if enabled)
         last_update_time = current_time
-        
-        # Store the data in the database
-        with sqlite3.connect(DATABASE_PATH) as conn:
-            cursor = conn.cursor()
-            for asset in market_data:
-                # Insert or replace current asset data
-                cursor.execute(""" 
-                    INSERT OR REPLACE INTO assets
-                    (name, symbol, current_price, market_cap, last_updated) 
-                    VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
-                """, (
-                    asset['name'], 
-                    asset['symbol'], 
-                    asset['current_price'], 
-                    asset['market_cap']
-                ))
-
-                # Insert historical price data
-                cursor.execute(""" 
-                    INSERT INTO historical_prices (asset_name, price)
-                    VALUES (?, ?)
-                """, (asset['name'], asset['current_price']))
-                
-            conn.commit()  # Commit changes to the database
+        ingest_market_data(market_data, current_time)
+        record_market_data(market_data, current_time)
         
         return market_data  # Return the updated market data
     except Exception as e:
         logger.error(f"Error updating market data: {e}")
         return market_data_cache  # Return cached data in case of an error
 
+def _run_market_refresher(interval):
+    while True:
+        fetch_market_data()
+        time.sleep(interval)
+
+def start_market_refresher():
+    """Start polling the API every MARKET_REFRESH_INTERVAL in the background (unless replaying)"""
+    global market_refresher
+    if market_replay is None and market_refresher is None:
+        market_refresher = threading.Thread(
+            target=_run_market_refresher, args=(MARKET_REFRESH_INTERVAL,), name='market-refresher', daemon=True
+        )
+        market_refresher.start()
+    return market_refresher
+
+def ingest_market_data(market_data, timestamp):
+    """Apply one market data tick: store prices, re-mark portfolios and publish it to the other workers
+
+    timestamp (unix seconds) is the tick's market time; live ticks pass
+    the wall clock, replayed ticks their recorded time.
+    """
+    global market_data_cache
+    tick_time = datetime.fromtimestamp(timestamp, timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+    # Store the data in the database
+    with connect_db(DATABASE_PATH) as conn:
+        cursor = conn.cursor()
+        # Insert or replace current asset data
+        cursor.executemany(""" 
+            INSERT OR REPLACE INTO assets
+            (name, symbol, current_price, market_cap, last_updated) 
+            VALUES (?, ?, ?, ?, ?)
+        """, [(asset['name'], asset['symbol'], asset['current_price'], asset['market_cap'], tick_time)
+              for asset in market_data])
+
+        # Insert historical price data (one row per asset per second)
+        cursor.executemany(""" 
+            INSERT OR REPLACE INTO historical_prices (asset_name, price, timestamp)
+            VALUES (?, ?, ?)
+        """, [(asset['name'], asset['current_price'], tick_time) for asset in market_data])
+        
+        conn.commit()  # Commit changes to the database
+
+    market_data_cache = market_data
+    apply_market_prices(market_data)
+    market_ticks.inc('ingested')
+    if market_snapshot is not None:
+        publish_market_snapshot(market_data, timestamp)
+
+def apply_market_prices(market_data):
+    """Re-mark this process's caches against a stored tick"""
+    # Risk statistics were computed from the previous prices
+    risk_cache.invalidate()
+
+    # Re-mark every cached portfolio against the new prices
+    if valuations is not None:
+        valuations.mark({asset['name']: to_price(asset['current_price']) for asset in market_data
+                         if asset['current_price'] is not None})
+        sequence = leaderboard.sequence
+        leaderboard.sync(*valuations.net_worths(), sequence)
+
+def open_market_snapshot():
+    """Map the shared market snapshot when several workers serve the app"""
+    global market_snapshot
+    if multiprocess and market_snapshot is None:
+        market_snapshot = SharedSnapshot(MARKET_SNAPSHOT_FILE, MARKET_SNAPSHOT_SIZE)
+    return market_snapshot
+
+def publish_market_snapshot(market_data, timestamp):
+    """Publish a tick to the other workers (once it is in the database)"""
+    global market_snapshot_version
+    try:
+        # Serialized once, the way /market_data returns it
+        payload = app.json.dumps(market_data, separators=(',', ':')).encode()
+        with market_snapshot_lock:
+            market_snapshot_version = market_snapshot.publish(payload, timestamp)
+    except ValueError as e:
+        logger.error(f"Error publishing market snapshot: {e}")
+
+def load_market_snapshot():
+    """Re-mark this worker's caches if the leader published a newer tick
+
+    Polling costs one 8-byte read of the shared segment; the tick is
+    only decoded when its version changed.
+    """
+    global market_snapshot_version
+    if market_snapshot is None or market_snapshot.version() == market_snapshot_version:
+        return
+    with market_snapshot_lock:
+        snapshot = market_snapshot.read()
+        if snapshot is None or snapshot[0] == market_snapshot_version:
+            return
+        try:
+            apply_market_prices(json.loads(snapshot[1]))
+            market_ticks.inc('snapshot')
+        except (ValueError, KeyError, TypeError) as e:
+            logger.error(f"Error loading market snapshot: {e}")
+        market_snapshot_version = snapshot[0]
+
+def record_market_data(market_data, timestamp):
+    """Append a live tick to MARKET_RECORD_FILE as one JSON line (if enabled)"""
+    if not MARKET_RECORD_FILE:
+        return
+    try:
+        with open(MARKET_RECORD_FILE, 'a') as f:
+            f.write(json.dumps({"timestamp": timestamp, "market_data": market_data}) + "\n")
+    except OSError as e:
+        logger.error(f"Error recording market data: {e}")
+
+class VirtualClock:
+    """Market time running ``speed`` times faster than the wall clock"""
+
+    def __init__(self, start, speed):
+        self.start = start
+        self.speed = speed
+        self.real_start = time.monotonic()
+
+    def now(self):
+        return self.start + (time.monotonic() - self.real_start) * self.speed
+
+    def seconds_until(self, timestamp):
+        """Real seconds to wait until the clock reaches timestamp (<= 0 when late)"""
+        return (timestamp - self.now()) / self.speed
+
+class MarketReplay:
+    """Replays a recorded tick file through ingest_market_data() on a virtual clock
+
+    The file holds one JSON object per line, ``{"timestamp": <unix
+    seconds>, "market_data": [...]}`` as written by MARKET_RECORD_FILE.
+    Ticks are ingested when the virtual clock reaches their recorded time,
+    so gaps between ticks shrink by ``speed``; speed 0 ingests back to
+    back as fast as the database allows. When ingestion cannot keep up the
+    replay runs late rather than skipping ticks, and reports the lag.
+    """
+
+    def __init__(self, path, speed=MARKET_REPLAY_SPEED, loop=False):
+        self.path = path
+        self.speed = speed
+        self.loop = loop
+        self.stats = {"ticks": 0, "late_ticks": 0, "max_lag": 0.0, "market_seconds": 0.0, "elapsed": 0.0}
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Start the replay thread"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='market-replay', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def wait(self, timeout=None):
+        """Block until the replay has finished (or timeout); returns True when done"""
+        if self._thread is not None:
+            self._thread.join(timeout)
+            return not self._thread.is_alive()
+        return True
+
+    def _ticks(self):
+        """Yield (timestamp, market_data) from the file, streaming it line by line"""
+        previous = None
+        with open(self.path) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                tick = json.loads(line)
+                # Untimed ticks are spaced by the live refresh interval
+                timestamp = tick.get('timestamp')
+                if timestamp is None:
+                    timestamp = previous + MARKET_REFRESH_INTERVAL if previous is not None else time.time()
+                previous = timestamp
+                yield float(timestamp), tick['market_data']
+
+    def _run(self):
+        started = time.monotonic()
+        offset = 0.0  # shifts each loop pass after the previous one in market time
+        try:
+            while not self._stop_event.is_set():
+                clock = None
+                first = last = None
+                for timestamp, market_data in self._ticks():
+                    if self._stop_event.is_set():
+                        break
+                    if clock is None:
+                        clock = VirtualClock(timestamp, self.speed) if self.speed > 0 else None
+                        first = timestamp
+                    if clock is not None:
+                        delay = clock.seconds_until(timestamp)
+                        if delay > 0:
+                            if self._stop_event.wait(delay):
+                                break
+                        elif delay < 0:
+                            self.stats["late_ticks"] += 1
+                            self.stats["max_lag"] = max(self.stats["max_lag"], -delay * self.speed)
+                    ingest_market_data(market_data, timestamp + offset)
+                    self.stats["ticks"] += 1
+                    last = timestamp
+                if first is not None:
+                    self.stats["market_seconds"] += last - first
+                    offset += last - first + MARKET_REFRESH_INTERVAL
+                if not self.loop or first is None:
+                    break
+        except Exception as e:
+            logger.error(f"Market replay failed: {e}")
+        finally:
+            self.stats["elapsed"] = time.monotonic() - started
+            stats = self.stats
+            rate = stats["ticks"] / stats["elapsed"] if stats["elapsed"] > 0 else 0
+            logger.info(
+                f"Market replay finished: {stats['ticks']} ticks covering {stats['market_seconds']:.0f}s of market time "
+                f"in {stats['elapsed']:.1f}s ({rate:.1f} ticks/s), {stats['late_ticks']} late (max lag {stats['max_lag']:.1f}s)"
+            )
+
+def start_market_replay():
+    """Start replaying MARKET_REPLAY_FILE instead of polling the live API, if set"""
+    global market_replay
+    if MARKET_REPLAY_FILE and market_replay is None:
+        market_replay = MarketReplay(MARKET_REPLAY_FILE, MARKET_REPLAY_SPEED, MARKET_REPLAY_LOOP).start()
+        logger.info(f"Replaying market data from {MARKET_REPLAY_FILE} at {MARKET_REPLAY_SPEED or 'max'}x speed")
+    return market_replay
+
+class LedgerWriter:
+    """Write-behind writer that group-commits ledger rows in batches
+
+    Records are accepted into a bounded in-memory queue and a single
+    background thread flushes them every ``flush_interval`` seconds (or as
+    soon as ``batch_size`` rows are waiting) in one SQLite transaction, so
+    many ledger rows share a single commit/fsync.
+
+    Durability guarantees:
+    - The balance/portfolio change a record describes is committed by the
+      request handler *before* the record is submitted, so account state is
+      never lost, only its audit row.
+    - A record is durable once its batch has been committed. Rows still in
+      the queue when the process dies abruptly (SIGKILL, power loss) are
+      lost; the loss window is bounded by ``flush_interval`` plus the time to
+      commit one batch.
+    - On clean shutdown (``stop()``, registered with ``atexit``) the queue is
+      drained and committed before the process exits.
+    - Timestamps are captured at submit time, so rows keep their original
+      order and time even though they are written later.
+    - When the queue is full ``submit()`` blocks, applying backpressure to
+      request threads instead of dropping records.
+    """
+
+    def __init__(self, database_path, max_queue=LEDGER_QUEUE_SIZE,
+                 flush_interval=LEDGER_FLUSH_INTERVAL, batch_size=LEDGER_BATCH_SIZE):
+        self.database_path = database_path
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.queue = queue.Queue(maxsize=max_queue)
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Start the background flush thread"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='ledger-writer', daemon=True)
+            self._thread.start()
+        return self
+
+    def submit(self, record):
+        """Queue a (username, type, amount, asset_name, timestamp) row"""
+        self.queue.put(record)
+
+    def flush(self):
+        """Block until every submitted record has been committed"""
+        self.queue.join()
+
+    def stop(self):
+        """Drain the queue, commit the remaining rows and stop the thread"""
+        if self._thread is None:
+            return
+        self._stop_event.set()
+        self._thread.join()
+        self._thread = None
+
+    def _next_batch(self):
+        """Wait for the first record, then collect the rest of the batch"""
+        try:
+            batch = [self.queue.get(timeout=self.flush_interval)]
+        except queue.Empty:
+            return []
+
+        # Give concurrent writers one flush interval to join this commit
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0:
+                    batch.append(self.queue.get(timeout=remaining))
+                else:
+                    batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _write_batch(self, conn, batch):
+        """Insert one batch of rows in a single transaction"""
+        try:
+            conn.executemany("""
+                INSERT INTO transactions
+                (username, transaction_type, amount, asset_name, timestamp)
+                VALUES (?, ?, ?, ?, ?)
+            """, batch)
+            conn.commit()
+        except sqlite3.Error as e:
+            conn.rollback()
+            logger.error(f"Ledger batch of {len(batch)} rows failed: {e}")
+        finally:
+            for _ in batch:
+                self.queue.task_done()
+
+    def _run(self):
+        conn = connect_db(self.database_path)
+        try:
+            while not self._stop_event.is_set():
+                batch = self._next_batch()
+                if batch:
+                    self._write_batch(conn, batch)
+
+            # Drain whatever was submitted before stop() was called
+            while True:
+                batch = self._next_batch()
+                if not batch:
+                    break
+                self._write_batch(conn, batch)
+        finally:
+            conn.close()
+
+def start_ledger_writer():
+    """Start the write-behind ledger writer if it is enabled"""
+    global ledger_writer
+    if LEDGER_WRITE_BEHIND and ledger_writer is None:
+        ledger_writer = LedgerWriter(DATABASE_PATH).start()
+        atexit.register(ledger_writer.stop)
+        logger.info(f"Ledger write-behind enabled (flush interval {LEDGER_FLUSH_INTERVAL * 1000:.1f} ms)")
+    return ledger_writer
+
 def log_transaction(username, transaction_type, amount, asset_name=None):
     """Log transactions for audit and tracking"""
+    # Same format as SQLite's CURRENT_TIMESTAMP, captured now rather than at flush time
+    timestamp = datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+    if ledger_writer is not None:
+        # Hand the row to the group-commit writer
+        ledger_writer.submit((username, transaction_type, amount, asset_name, timestamp))
+        return
+
     # Insert transaction into database
-    with sqlite3.connect(DATABASE_PATH) as conn:
+    with connect_db(DATABASE_PATH) as conn:
         cursor = conn.cursor()
         cursor.execute(""" 
             INSERT INTO transactions 
-            (username, transaction_type, amount, asset_name) 
-            VALUES (?, ?, ?, ?)
-        """, (username, transaction_type, amount, asset_name))
+            (username, transaction_type, amount, asset_name, timestamp) 
+            VALUES (?, ?, ?, ?, ?)
+        """, (username, transaction_type, amount, asset_name, timestamp))
         conn.commit()  # Commit changes to the database
 
+def _cache_idempotent_response(owner, key, entry):
+    """Remember a completed response in the in-memory LRU"""
+    with idempotency_lock:
+        idempotency_cache[owner, key] = entry
+        idempotency_cache.move_to_end((owner, key))
+        while len(idempotency_cache) > IDEMPOTENCY_CACHE_SIZE:
+            idempotency_cache.popitem(last=False)
+
+def _lookup_idempotency_key(owner, key):
+    """Find a user's stored response for a key: LRU first, then the keys table"""
+    now = int(time.time())
+    with idempotency_lock:
+        entry = idempotency_cache.get((owner, key))
+        if entry is not None:
+            if now - entry[3] < IDEMPOTENCY_TTL:
+                idempotency_cache.move_to_end((owner, key))
+                cache_requests.inc('idempotency', 'hit')
+                return entry
+            del idempotency_cache[owner, key]
+    cache_requests.inc('idempotency', 'miss')
+
+    # Primary-key lookup on a WITHOUT ROWID table: a single B-tree probe
+    with connect_db(DATABASE_PATH, timeout=DB_TIMEOUT) as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT endpoint, status_code, response, created_at FROM idempotency_keys "
+            "WHERE username = ? AND key = ? AND created_at >= ?",
+            (owner, key, now - IDEMPOTENCY_TTL)
+        )
+        row = cursor.fetchone()
+
+    if row is not None and row[1] != 0:
+        _cache_idempotent_response(owner, key, row)
+    elif row is not None and row[3] < now - IDEMPOTENCY_LEASE:
+        # Claimed by a request that never finished (its process died): expired
+        return None
+    return row
+
+def _evict_expired_idempotency_keys():
+    """Delete keys older than the TTL (runs every IDEMPOTENCY_EVICT_EVERY stores)"""
+    global idempotency_stores
+    with idempotency_lock:
+        idempotency_stores += 1
+        if idempotency_stores % IDEMPOTENCY_EVICT_EVERY:
+            return
+
+    with connect_db(DATABASE_PATH, timeout=DB_TIMEOUT) as conn:
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM idempotency_keys WHERE created_at < ?", (int(time.time()) - IDEMPOTENCY_TTL,))
+        conn.commit()
+        if cursor.rowcount:
+            logger.info(f"Evicted {cursor.rowcount} expired idempotency keys")
+
+def _replay_idempotent_response(key, entry):
+    """Build a response for a key that has already been seen"""
+    endpoint, status_code, body, _ = entry
+    if endpoint != request.path:
+        return jsonify({"message": "Idempotency-Key was already used for a different endpoint."}), 422
+    if status_code == 0:
+        return jsonify({"message": "A request with this Idempotency-Key is still in progress."}), 409
+
+    response = make_response(body, status_code)
+    response.mimetype = 'application/json'
+    response.headers['Idempotent-Replayed'] = 'true'
+    logger.info(f"Replayed idempotent response for key {key} on {endpoint}")
+    return response
+
+def idempotent(view):
+    """Execute a request at most once per user and Idempotency-Key header
+
+    The first request with a key inserts an in-progress row, runs the
+    handler and stores its response; duplicates from the same user replay
+    the stored response without running the handler again. Keys are scoped
+    to the session user, so users cannot see or block each other's
+    requests. Server errors (5xx) and exceptions are not stored: the claim
+    is released so the client can retry. A claim left behind by a process
+    that died expires after IDEMPOTENCY_LEASE seconds, stored responses
+    after IDEMPOTENCY_TTL seconds.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get('Idempotency-Key')
+        if not key:
+            return view(*args, **kwargs)
+        if len(key) > 255:
+            return jsonify({"message": "Idempotency-Key must be at most 255 characters."}), 400
+        owner = g.username
+
+        entry = _lookup_idempotency_key(owner, key)
+        if entry is not None:
+            return _replay_idempotent_response(key, entry)
+
+        # Claim the key; the primary key makes concurrent duplicates lose the race
+        now = int(time.time())
+        try:
+            with connect_db(DATABASE_PATH, timeout=DB_TIMEOUT) as conn:
+                conn.execute("""
+                    DELETE FROM idempotency_keys WHERE username = ? AND key = ?
+                    AND (created_at < ? OR (status_code = 0 AND created_at < ?))
+                """, (owner, key, now - IDEMPOTENCY_TTL, now - IDEMPOTENCY_LEASE))
+                conn.execute(
+                    "INSERT INTO idempotency_keys (username, key, endpoint, status_code, created_at) VALUES (?, ?, ?, 0, ?)",
+                    (owner, key, request.path, now)
+                )
+                conn.commit()
+        except sqlite3.IntegrityError:
+            entry = _lookup_idempotency_key(owner, key)
+            if entry is None:
+                return jsonify({"message": "A request with this Idempotency-Key is still in progress."}), 409
+            return _replay_idempotent_response(key, entry)
+
+        stored = False
+        try:
+            response = make_response(view(*args, **kwargs))
+            if response.status_code < 500:
+                body = response.get_data()
+                with connect_db(DATABASE_PATH, timeout=DB_TIMEOUT) as conn:
+                    conn.execute(
+                        "UPDATE idempotency_keys SET status_code = ?, response = ? WHERE username = ? AND key = ?",
+                        (response.status_code, body, owner, key)
+                    )
+                    conn.commit()
+                stored = True
+                _cache_idempotent_response(owner, key, (request.path, response.status_code, body, now))
+        finally:
+            if not stored:
+                # A server error, or the handler raised: release the key so the client can retry
+                with connect_db(DATABASE_PATH, timeout=DB_TIMEOUT) as conn:
+                    conn.execute(
+                        "DELETE FROM idempotency_keys WHERE username = ? AND key = ? AND status_code = 0",
+                        (owner, key)
+                    )
+                    conn.commit()
+
+        _evict_expired_idempotency_keys()
+        return response
+    return wrapper
+
+# Valuation Cache
+def load_valuations():
+    """Build the in-memory valuation cache from the database
+
+    The cache is kept current by the mutation paths of this process; with
+    several worker processes, sync_valuations() also applies the changes
+    made by the others.
+    """
+    global valuations, valuations_seq
+    if not VALUATION_CACHE:
+        return None
+
+    with connect_db(DATABASE_PATH, timeout=DB_TIMEOUT) as conn:
+        cursor = conn.cursor()
+        # Read the ledger position first: a change racing with the load is re-synced
+        cursor.execute("SELECT COALESCE(MAX(seq), 0) FROM ledger_events")
+        valuations_seq = cursor.fetchone()[0]
+        cursor.execute("SELECT username, balance FROM accounts")
+        accounts = cursor.fetchall()
+        cursor.execute("SELECT username, asset_name, quantity, avg_purchase_price FROM portfolios")
+        positions = cursor.fetchall()
+        cursor.execute("SELECT name, current_price FROM assets")
+        prices = {name: to_price(price) for name, price in cursor.fetchall()}
+
+    cache = ValuationCache(capacity=max(1024, len(positions)))
+    cache.load(accounts, positions, prices)
+    valuations = cache
+    # Read before the net worths: trades updating the ranking meanwhile keep their score
+    sequence = leaderboard.sequence
+    leaderboard.rebuild(*valuations.net_worths(), sequence)
+    logger.info(f"Valuation cache loaded: {len(accounts)} accounts, {len(positions)} positions")
+    return valuations
+
+def sync_valuations():
+    """Apply the leader's latest tick and other workers' account changes to the valuation cache
+
+    Every balance or position change appends to ledger_events in its own
+    transaction, so the events past the last one seen name exactly the
+    accounts other processes changed; those are re-read in full. Only
+    needed with several workers, as a single process's own mutation paths
+    keep its cache current.
+    """
+    global valuations_seq, valuations_sync_conn
+    load_market_snapshot()
+    if valuations is None or not multiprocess:
+        return
+
+    with valuations_sync_lock:
+        if valuations_sync_conn is None:
+            valuations_sync_conn = connect_db(DATABASE_PATH, timeout=DB_TIMEOUT, check_same_thread=False)
+        cursor = valuations_sync_conn.cursor()
+        # Fast path: nothing was committed since the last sync
+        cursor.execute("SELECT COALESCE(MAX(seq), 0) FROM ledger_events")
+        if cursor.fetchone()[0] <= valuations_seq:
+            return
+
+        # One read transaction, so the re-read accounts match the seq recorded
+        cursor.execute("BEGIN")
+        try:
+            cursor.execute("SELECT username, MAX(seq) FROM ledger_events WHERE seq > ? GROUP BY username", (valuations_seq,))
+            changed = cursor.fetchall()
+            accounts = []
+            for username, _ in changed:
+                cursor.execute("SELECT balance FROM accounts WHERE username = ?", (username,))
+                account = cursor.fetchone()
+                if account is not None:
+                    cursor.execute("SELECT asset_name, quantity, avg_purchase_price FROM portfolios WHERE username = ?", (username,))
+                    accounts.append((username, account[0], cursor.fetchall()))
+        finally:
+            valuations_sync_conn.rollback()
+
+        for username, balance, positions in accounts:
+            valuations.set_account(username, balance, positions)
+            leaderboard.update(username, valuations.net_worth(username)[2])
+        if changed:
+            valuations_seq = max(seq for _, seq in changed)
+
+def read_account_state(cursor, username, asset_name=None):
+    """Read a user's balance and one position inside a transaction, for the valuation cache"""
+    if valuations is None:
+        return None
+
+    cursor.execute("SELECT balance FROM accounts WHERE username = ?", (username,))
+    account = cursor.fetchone()
+    if account is None:
+        return None
+
+    quantity, avg_purchase_price = 0, 0
+    if asset_name is not None:
+        cursor.execute(
+            "SELECT quantity, avg_purchase_price FROM portfolios WHERE username = ? AND asset_name = ?",
+            (username, asset_name)
+        )
+        quantity, avg_purchase_price = cursor.fetchone() or (0, 0)
+    return username, account[0], asset_name, quantity, avg_purchase_price
+
+def update_valuations(state):
+    """Apply a committed account state from read_account_state() to the cache"""
+    if valuations is None or state is None:
+        return
+    username, balance, asset_name, quantity, avg_purchase_price = state
+    valuations.set_balance(username, balance)
+    if asset_name is not None:
+        valuations.set_position(username, asset_name, quantity, avg_purchase_price)
+    leaderboard.update(username, valuations.net_worth(username)[2])
+
+# Cost Basis Lots and P&L
+def open_lot(cursor, username, asset_name, quantity, price):
+    """Record a purchase lot and add its cost to the running FIFO cost basis"""
+    cursor.execute(
+        "INSERT INTO position_lots (username, asset_name, quantity, price) VALUES (?, ?, ?, ?)",
+        (username, asset_name, quantity, price)
+    )
+    cursor.execute("""
+        INSERT INTO position_pnl (username, asset_name, fifo_cost_basis) VALUES (?, ?, ?)
+        ON CONFLICT(username, asset_name) DO UPDATE SET fifo_cost_basis = fifo_cost_basis + excluded.fifo_cost_basis
+    """, (username, asset_name, notional(price, quantity)))
+
+def consume_lots(cursor, username, asset_name, quantity, closes_position):
+    """Take quantity out of the oldest open lots; returns its FIFO cost
+
+    Each fully consumed lot is deleted, so the work per fill is amortized
+    O(1) in the number of lots it touches.
+    """
+    fifo_cost = 0
+    remaining = quantity
+    while remaining > 0:
+        cursor.execute("""
+            SELECT id, quantity, price FROM position_lots
+            WHERE username = ? AND asset_name = ? ORDER BY id LIMIT 1
+        """, (username, asset_name))
+        lot = cursor.fetchone()
+        if lot is None:
+            break
+        lot_id, lot_quantity, lot_price = lot
+        taken = min(lot_quantity, remaining)
+        fifo_cost += notional(lot_price, taken)
+        remaining -= taken
+        if taken == lot_quantity:
+            cursor.execute("DELETE FROM position_lots WHERE id = ?", (lot_id,))
+        else:
+            cursor.execute("UPDATE position_lots SET quantity = quantity - ? WHERE id = ?", (taken, lot_id))
+
+    if closes_position:
+        # Drop any rounding residue together with the position
+        cursor.execute("DELETE FROM position_lots WHERE username = ? AND asset_name = ?", (username, asset_name))
+        cursor.execute(
+            "UPDATE position_pnl SET fifo_cost_basis = 0 WHERE username = ? AND asset_name = ?",
+            (username, asset_name)
+        )
+    else:
+        cursor.execute(
+            "UPDATE position_pnl SET fifo_cost_basis = fifo_cost_basis - ? WHERE username = ? AND asset_name = ?",
+            (fifo_cost, username, asset_name)
+        )
+    return fifo_cost
+
+def realize_pnl(cursor, username, asset_name, profit_loss):
+    """Add a fill's realized P&L to the position's running total"""
+    cursor.execute("""
+        INSERT INTO position_pnl (username, asset_name, realized_pnl) VALUES (?, ?, ?)
+        ON CONFLICT(username, asset_name) DO UPDATE SET realized_pnl = realized_pnl + excluded.realized_pnl
+    """, (username, asset_name, profit_loss))
+
+# Event Ledger
+def record_event(cursor, username, event_type, amount=0, asset_name=None, quantity=0, price=0):
+    """Append an event to the ledger inside the caller's transaction
+
+    amount is the signed cash delta and quantity the signed position delta,
+    both in micro-units; price is the fill price for buys and sells, in
+    price units (see PRICE_SCALE).
+    """
+    cursor.execute("""
+        INSERT INTO ledger_events (username, event_type, asset_name, quantity, price, amount, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    """, (username, event_type, asset_name, quantity, price, amount, time.time()))
+
+def replay_events(accounts, events):
+    """Apply (username, asset_name, quantity, price, amount) events in one pass
+
+    accounts maps username -> [balance, positions], where positions maps
+    asset name -> [quantity, avg_purchase_price]; accounts without an entry
+    start empty. States are updated in place with the same integer math as
+    the live trade path.
+    """
+    for username, asset_name, quantity, price, amount in events:
+        account = accounts.get(username)
+        if account is None:
+            account = accounts[username] = [0, {}]
+        account[0] += amount
+        if not quantity:
+            continue
+        positions = account[1]
+        position = positions.get(asset_name)
+        if quantity > 0:
+            if position is None:
+                positions[asset_name] = [quantity, price]
+            else:
+                held, avg_purchase_price = position
+                position[0] = held + quantity
+                position[1] = average_price(avg_purchase_price, held, price, quantity)
+        elif position is not None:
+            position[0] += quantity
+            if position[0] <= 0:
+                del positions[asset_name]
+    return accounts
+
+def _latest_account_snapshot(cursor, username, max_seq):
+    """Return (seq, balance, positions) of the newest snapshot at or before max_seq"""
+    cursor.execute("""
+        SELECT seq, balance, positions FROM account_snapshots
+        WHERE username = ? AND seq <= ? ORDER BY seq DESC LIMIT 1
+    """, (username, max_seq))
+    row = cursor.fetchone()
+    if row is None:
+        return 0, 0, {}
+    return row[0], row[1], json.loads(row[2])
+
+def rebuild_account(cursor, username, seq=None, at=None):
+    """Reconstruct an account's state as of an event seq or a unix time
+
+    Starts from the latest snapshot before the target and replays only the
+    events after it. Returns (seq, balance, positions).
+    """
+    if at is not None:
+        cursor.execute("SELECT COALESCE(MAX(seq), 0) FROM ledger_events WHERE created_at <= ?", (at,))
+        seq = cursor.fetchone()[0]
+    elif seq is None:
+        cursor.execute("SELECT COALESCE(MAX(seq), 0) FROM ledger_events")
+        seq = cursor.fetchone()[0]
+
+    snapshot_seq, balance, positions = _latest_account_snapshot(cursor, username, seq)
+    cursor.execute("""
+        SELECT username, asset_name, quantity, price, amount FROM ledger_events
+        WHERE username = ? AND seq > ? AND seq <= ? ORDER BY seq
+    """, (username, snapshot_seq, seq))
+    balance, positions = replay_events({username: [balance, positions]}, cursor)[username]
+    return seq, balance, positions
+
+def take_account_snapshots():
+    """Snapshot every account with events since the last run, from the event log alone
+
+    Each run covers all events up to its target seq, so an account's latest
+    snapshot plus the events after the previous run's watermark is its state.
+    """
+    with connect_db(DATABASE_PATH, timeout=DB_TIMEOUT) as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT COALESCE(MAX(seq), 0) FROM account_snapshots")
+        watermark = cursor.fetchone()[0]
+        cursor.execute("SELECT COALESCE(MAX(seq), 0) FROM ledger_events")
+        target = cursor.fetchone()[0]
+        if target <= watermark:
+            return 0
+
+        # Start from the latest snapshot of every account with new events
+        cursor.execute("""
+            SELECT s.username, s.balance, s.positions FROM account_snapshots s
+            JOIN (
+                SELECT username, MAX(seq) AS seq FROM account_snapshots
+                WHERE username IN (SELECT DISTINCT username FROM ledger_events WHERE seq > ? AND seq <= ?)
+                GROUP BY username
+            ) latest ON latest.username = s.username AND latest.seq = s.seq
+        """, (watermark, target))
+        accounts = {username: [balance, json.loads(positions)] for username, balance, positions in cursor.fetchall()}
+
+        # Replay the new events of all accounts in a single pass, in seq order
+        cursor.execute("""
+            SELECT username, asset_name, quantity, price, amount FROM ledger_events
+            WHERE seq > ? AND seq <= ? ORDER BY seq
+        """, (watermark, target))
+        replay_events(accounts, cursor)
+
+        now = time.time()
+        snapshots = [
+            (username, target, balance, json.dumps(positions), now)
+            for username, (balance, positions) in accounts.items()
+        ]
+
+        cursor.executemany("""
+            INSERT OR REPLACE INTO account_snapshots (username, seq, balance, positions, taken_at)
+            VALUES (?, ?, ?, ?, ?)
+        """, snapshots)
+        conn.commit()
+    return len(snapshots)
+
+# Portfolio Snapshots
+def take_portfolio_snapshot(taken_at=None):
+    """Record every account's balance and holdings value in one bulk insert"""
+    taken_at = int(taken_at if taken_at is not None else time.time())
+    with connect_db(DATABASE_PATH, timeout=DB_TIMEOUT) as conn:
+        if valuations is not None:
+            sync_valuations()
+            # Vectorized: read balances and holdings straight from the cache
+            with valuations.lock:
+                users = len(valuations.usernames)
+                usernames = list(valuations.usernames)
+                balances = valuations.balances[:users].tolist()
+                holdings = valuations.holdings_value[:users].tolist()
+            conn.executemany("""
+                INSERT OR REPLACE INTO portfolio_snapshots (username, taken_at, balance, holdings_value)
+                VALUES (?, ?, ?, ?)
+            """, zip(usernames, [taken_at] * users, balances, holdings))
+        else:
+            # Single INSERT ... SELECT valuing every account in SQLite
+            register_value_position(conn)
+            conn.execute("""
+                INSERT OR REPLACE INTO portfolio_snapshots (username, taken_at, balance, holdings_value)
+                SELECT a.username, ?, a.balance,
+                       COALESCE(SUM(value_position(p.quantity, s.current_price)), 0)
+                FROM accounts a
+                LEFT JOIN portfolios p ON p.username = a.username
+                LEFT JOIN assets s ON s.name = p.asset_name
+                GROUP BY a.username
+            """, (taken_at,))
+        conn.commit()
+    return taken_at
+
+def _run_snapshot_job(interval):
+    while True:
+        time.sleep(interval)
+        try:
+            started = time.perf_counter()
+            take_portfolio_snapshot()
+            accounts = take_account_snapshots()
+            logger.info(f"Portfolio snapshot taken in {(time.perf_counter() - started) * 1000:.1f} ms ({accounts} account snapshots)")
+        except Exception as e:
+            logger.error(f"Portfolio snapshot failed: {e}")
+
+def start_snapshot_job():
+    """Start the background snapshot thread if SNAPSHOT_INTERVAL is set"""
+    global snapshot_thread
+    if SNAPSHOT_INTERVAL > 0 and snapshot_thread is None:
+        snapshot_thread = threading.Thread(
+            target=_run_snapshot_job, args=(SNAPSHOT_INTERVAL,), name='portfolio-snapshots', daemon=True
+        )
+        snapshot_thread.start()
+    return snapshot_thread
+
+def downsample_indices(count, max_points):
+    """Evenly spaced indices into a series of count points, always keeping the last"""
+    if count <= max_points:
+        return np.arange(count)
+    return np.unique(np.linspace(0, count - 1, max_points).round().astype(np.int64))
+
+# Trade Execution
+def apply_buy(cursor, username, asset_name, quantity):
+    """Buy quantity (micro-units) of an asset inside the caller's transaction
+
+    Returns (response body, status code, ledger entry or None). The caller
+    commits and then logs the ledger entry.
+    """
+    # Retrieve asset's current price
+    cursor.execute("SELECT current_price FROM assets WHERE name = ?", (asset_name,))
+    asset_data = cursor.fetchone()
+    if not asset_data:
+        return {"message": "Asset not found."}, 404, None
+
+    current_price = to_price(asset_data[0])
+    total_cost = notional(current_price, quantity)
+
+    # Check user's balance
+    cursor.execute("SELECT balance FROM accounts WHERE username = ?", (username,))
+    account = cursor.fetchone()
+    if account is None:
+        return {"message": "Account not found."}, 404, None
+    balance = account[0]
+    if balance < total_cost:
+        return {"message": "Insufficient funds."}, 400, None
+
+    # Deduct cost and update portfolio
+    cursor.execute(
+        "UPDATE accounts SET balance = balance - ? WHERE username = ? AND balance >= ?",
+        (total_cost, username, total_cost)
+    )
+    add_to_position(cursor, username, asset_name, quantity, current_price)
+    open_lot(cursor, username, asset_name, quantity, current_price)
+    record_event(cursor, username, 'buy', -total_cost, asset_name, quantity, current_price)
+
+    body = {
+        "message": f"Purchased {from_micros(quantity)} units of {asset_name} for ${from_micros(total_cost):.2f}.",
+        "current_balance": from_micros(balance - total_cost)
+    }
+    return body, 200, (username, 'buy', from_micros(total_cost), asset_name)
+
+def apply_sell(cursor, username, asset_name, quantity):
+    """Sell quantity (micro-units) of an asset inside the caller's transaction
+
+    Returns (response body, status code, ledger entry or None). The caller
+    commits and then logs the ledger entry.
+    """
+    # Validate user's portfolio
+    cursor.execute("SELECT quantity, avg_purchase_price FROM portfolios WHERE username = ? AND asset_name = ?", (username, asset_name))
+    portfolio_data = cursor.fetchone()
+
+    if portfolio_data is None:
+        return {"message": "Asset not found in portfolio."}, 404, None
+
+    current_quantity, avg_purchase_price = portfolio_data
+    if current_quantity < quantity:
+        return {"message": "Insufficient quantity to sell."}, 400, None
+
+    # Fetch current market price
+    cursor.execute("SELECT current_price FROM assets WHERE name = ?", (asset_name,))
+    current_price = to_price(cursor.fetchone()[0])
+    total_revenue = notional(current_price, quantity)
+
+    # Calculate profit/loss against the configured cost basis
+    fifo_cost = consume_lots(cursor, username, asset_name, quantity, current_quantity == quantity)
+    if COST_BASIS_METHOD == 'fifo':
+        total_cost = fifo_cost
+    else:
+        total_cost = notional(avg_purchase_price, quantity)
+    profit_loss = total_revenue - total_cost
+    realize_pnl(cursor, username, asset_name, profit_loss)
+
+    # Update user's balance
+    cursor.execute("UPDATE accounts SET balance = balance + ? WHERE username = ?", (total_revenue, username))
+
+    # Update portfolio
+    if current_quantity == quantity:
+        # Remove the entire asset if selling all quantity (exact in micro-units)
+        cursor.execute("DELETE FROM portfolios WHERE username = ? AND asset_name = ?", (username, asset_name))
+    else:
+        # Update remaining quantity; the average cost of the rest is unchanged
+        cursor.execute(""" 
+            UPDATE portfolios 
+            SET quantity = quantity - ?
+            WHERE username = ? AND asset_name = ?
+        """, (quantity, username, asset_name))
+    record_event(cursor, username, 'sell', total_revenue, asset_name, -quantity, current_price)
+
+    body = {
+        "message": f"Sold {from_micros(quantity)} units of {asset_name} at ${format_price(current_price)} each.", 
+        "total_revenue": from_micros(total_revenue),
+        "profit_loss": from_micros(profit_loss),
+        "profit_loss_percentage": (profit_loss / total_cost) * 100 if total_cost > 0 else 0
+    }
+    return body, 200, (username, 'sell', from_micros(total_revenue), asset_name)
+
+# Order handlers shared by the synchronous routes and the intake workers
+TRADE_HANDLERS = {
+    'buy': apply_buy,
+    'sell': apply_sell,
+}
+
+def execute_trade(side, username, asset_name, quantity):
+    """Execute one trade in its own write transaction; returns (body, status code)"""
+    started = time.perf_counter()
+    with user_transaction(username) as conn:
+        cursor = conn.cursor()
+        body, status_code, ledger_entry = TRADE_HANDLERS[side](cursor, username, asset_name, quantity)
+        state = read_account_state(cursor, username, asset_name) if status_code == 200 else None
+        conn.commit()
+        update_valuations(state)
+    trade_latency.observe(time.perf_counter() - started, side)
+    trade_count.inc(side, status_code)
+
+    # Log transaction
+    if ledger_entry:
+        log_transaction(*ledger_entry)
+    return body, status_code
+
+class OrderIntake:
+    """Asynchronous order intake: a bounded queue drained by a worker pool
+
+    /trade/buy and /trade/sell enqueue the order and return 202 with an
+    order id. Orders are routed to a worker by username, so one user's orders
+    are always executed by the same worker in submission order. Each worker
+    drains up to ``batch_size`` orders at a time and executes the whole batch
+    in one SQLite transaction (one savepoint per order), recording each fill
+    in the ``orders`` table in that same transaction.
+
+    Pending orders only live in memory: if the process dies before a batch
+    commits, those orders are lost and /orders/<id> returns 404 for them.
+    """
+
+    def __init__(self, database_path, workers, batch_size, max_queue):
+        self.database_path = database_path
+        self.batch_size = batch_size
+        self.queues = [queue.Queue(maxsize=max_queue) for _ in range(workers)]
+        self.pending = {}  # order id -> order dict, until its batch commits
+        self.condition = threading.Condition()
+        self.listeners = []  # callables notified with the order ids of each completed batch
+        self.threads = []
+
+    def start(self):
+        """Start one worker thread per queue"""
+        for index, order_queue in enumerate(self.queues):
+            thread = threading.Thread(target=self._run, args=(order_queue,), name=f'order-worker-{index}', daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        return self
+
+    def submit(self, username, side, asset_name, quantity):
+        """Queue an order and return the 202 (or 503 when full) response"""
+        order = {
+            "order_id": uuid.uuid4().hex,
+            "username": username,
+            "side": side,
+            "asset_name": asset_name,
+            "quantity": from_micros(quantity),
+            "status": "pending",
+            "created_at": time.time(),
+        }
+        order_queue = self.queues[hash(username) % len(self.queues)]
+        with self.condition:
+            self.pending[order["order_id"]] = order
+        try:
+            order_queue.put_nowait((order, quantity))
+        except queue.Full:
+            with self.condition:
+                del self.pending[order["order_id"]]
+            response = jsonify({"message": "Order queue is full, please retry."})
+            response.headers['Retry-After'] = '1'
+            return response, 503
+
+        return jsonify({
+            "message": "Order accepted.",
+            "order_id": order["order_id"],
+            "status": "pending"
+        }), 202
+
+    def get(self, order_id):
+        """Return a pending order, or None once it has been committed"""
+        with self.condition:
+            return self.pending.get(order_id)
+
+    def wait(self, order_id, timeout):
+        """Wait until an order leaves the pending set; returns it if done"""
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while order_id in self.pending:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return self.pending.get(order_id)
+                self.condition.wait(remaining)
+        return None
+
+    def add_listener(self, callback):
+        """Call callback(order_ids) from a worker thread whenever a batch leaves the pending set"""
+        self.listeners.append(callback)
+
+    def _next_batch(self, order_queue):
+        """Block for one order, then take whatever else is already queued"""
+        batch = [order_queue.get()]
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(order_queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _execute_batch(self, batch):
+        """Execute a batch of orders in one transaction, one savepoint each"""
+        started = time.perf_counter()
+        # Lock the stripes of every user in the batch, in index order to avoid deadlocks
+        stripes = sorted({hash(order["username"]) % USER_LOCK_STRIPES for order, _ in batch})
+        ledger_entries = []
+        states = []
+        with ExitStack() as stack:
+            for stripe in stripes:
+                stack.enter_context(user_locks[stripe])
+
+            with connect_db(self.database_path, timeout=DB_TIMEOUT) as conn:
+                conn.execute("BEGIN IMMEDIATE")
+                cursor = conn.cursor()
+                for order, quantity in batch:
+                    cursor.execute("SAVEPOINT order_fill")
+                    try:
+                        body, status_code, ledger_entry = TRADE_HANDLERS[order["side"]](
+                            cursor, order["username"], order["asset_name"], quantity
+                        )
+                        cursor.execute("RELEASE SAVEPOINT order_fill")
+                    except Exception as e:
+                        cursor.execute("ROLLBACK TO SAVEPOINT order_fill")
+                        cursor.execute("RELEASE SAVEPOINT order_fill")
+                        logger.error(f"Order {order['order_id']} failed: {e}")
+                        body, status_code, ledger_entry = {"error": str(e)}, 500, None
+
+                    order["status"] = "filled" if status_code == 200 else "rejected"
+                    order["status_code"] = status_code
+                    order["result"] = body
+                    order["completed_at"] = time.time()
+                    if ledger_entry:
+                        ledger_entries.append(ledger_entry)
+                    if status_code == 200:
+                        states.append(read_account_state(cursor, order["username"], order["asset_name"]))
+
+                cursor.executemany("""
+                    INSERT INTO orders
+                    (id, username, side, asset_name, quantity, status, status_code, result, created_at, completed_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """, [
+                    (order["order_id"], order["username"], order["side"], order["asset_name"], quantity,
+                     order["status"], order["status_code"], json.dumps(order["result"]),
+                     order["created_at"], order["completed_at"])
+                    for order, quantity in batch
+                ])
+                conn.commit()
+
+            # Still under the users' locks, so cache updates keep commit order
+            for state in states:
+                update_valuations(state)
+
+        order_batch_latency.observe(time.perf_counter() - started)
+        order_batch_size.observe(len(batch))
+        for order, _ in batch:
+            trade_count.inc(order["side"], order["status_code"])
+
+        # Ledger rows are written after the fills are durable, as in the sync path
+        log_transactions(ledger_entries)
+
+    def _run(self, order_queue):
+        while True:
+            batch = self._next_batch(order_queue)
+            try:
+                self._execute_batch(batch)
+            except Exception as e:
+                # The whole batch rolled back; report every order as failed
+                logger.error(f"Order batch of {len(batch)} failed: {e}")
+                for order, _ in batch:
+                    order["status"] = "failed"
+                    order["status_code"] = 500
+                    order["result"] = {"error": str(e)}
+                    order["completed_at"] = time.time()
+            finally:
+                with self.condition:
+                    for order, _ in batch:
+                        self.pending.pop(order["order_id"], None)
+                        if order["status"] == "failed":
+                            failed_orders[order["order_id"]] = order
+                    while len(failed_orders) > ORDER_QUEUE_SIZE:
+                        failed_orders.popitem(last=False)
+                    self.condition.notify_all()
+                for listener in self.listeners:
+                    listener([order["order_id"] for order, _ in batch])
+                for _ in batch:
+                    order_queue.task_done()
+
+def start_order_intake():
+    """Start the asynchronous order intake workers if enabled"""
+    global order_intake
+    if ASYNC_ORDER_INTAKE and order_intake is None:
+        order_intake = OrderIntake(DATABASE_PATH, ORDER_WORKERS, ORDER_BATCH_SIZE, ORDER_QUEUE_SIZE).start()
+        logger.info(f"Async order intake enabled ({ORDER_WORKERS} workers, batches of {ORDER_BATCH_SIZE})")
+    return order_intake
+
+def find_order(order_id):
+    """Look up an order: pending in memory, failed in memory, or filled in the database"""
+    if order_intake is not None:
+        order = order_intake.get(order_id)
+        if order is not None:
+            return dict(order)
+    if order_id in failed_orders:
+        return dict(failed_orders[order_id])
+
+    with connect_db(DATABASE_PATH, timeout=DB_TIMEOUT) as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT id, username, side, asset_name, quantity, status, status_code, result, created_at, completed_at
+            FROM orders WHERE id = ?
+        """, (order_id,))
+        row = cursor.fetchone()
+
+    if row is None:
+        return None
+    return {
+        "order_id": row[0],
+        "username": row[1],
+        "side": row[2],
+        "asset_name": row[3],
+        "quantity": from_micros(row[4]),
+        "status": row[5],
+        "status_code": row[6],
+        "result": json.loads(row[7]),
+        "created_at": row[8],
+        "completed_at": row[9],
+    }
+
+def log_transactions(entries):
+    """Log several (username, type, amount, asset_name) rows with one commit"""
+    if not entries:
+        return
+    timestamp = datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+    rows = [(username, transaction_type, amount, asset_name, timestamp)
+            for username, transaction_type, amount, asset_name in entries]
+
+    if ledger_writer is not None:
+        for row in rows:
+            ledger_writer.submit(row)
+        return
+
+    with connect_db(DATABASE_PATH) as conn:
+        conn.executemany(""" 
+            INSERT INTO transactions 
+            (username, transaction_type, amount, asset_name, timestamp) 
+            VALUES (?, ?, ?, ?, ?)
+        """, rows)
+        conn.commit()
+
+# Request metrics; registered first so rejected requests are timed too
+@app.before_request
+def start_request_timer():
+    request.environ['metrics.started'] = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    current = request._get_current_object()
+    started = current.environ.get('metrics.started')
+    if started is not None:
+        endpoint = current.endpoint or 'unmatched'
+        request_latency.observe(time.perf_counter() - started, endpoint, current.method)
+        request_count.inc(endpoint, current.method, response.status_code)
+    return response
+
+# Sampled profiling; costs one attribute check per request while switched off
+@app.before_request
+def start_profiling():
+    if profiler.enabled:
+        endpoint = request.endpoint or 'unmatched'
+        if profiler.should_profile(endpoint):
+            request.environ['profiling.token'] = profiler.begin(endpoint)
+
+def _finish_profiling():
+    if profiler.active:  # some request is being profiled, maybe this one
+        token = request.environ.pop('profiling.token', None)
+        if token is not None:
+            profiler.end(token)
+
+@app.after_request
+def stop_profiling(response):
+    # Ended here, on the thread it began on; a streamed body is not profiled
+    _finish_profiling()
+    return response
+
+@app.teardown_request
+def stop_profiling_on_error(exc):
+    # after_request is skipped when no response could be built
+    _finish_profiling()
+
 # Account-related Routes
+def session_user():
+    """The user of the request's bearer session token, or None; verified once per request"""
+    current = g._get_current_object()
+    if 'session_user' not in current:
+        scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+        current.session_user = verify_session_token(token.strip()) if scheme.lower() == 'bearer' and token else None
+    return current.session_user
+
+@app.before_request
+def enforce_rate_limit():
+    """Answer 429 with Retry-After once a client exceeds its endpoint's rate limit"""
+    if not RATE_LIMITING:
+        return None
+    # Unwrap the context proxies once; each proxied attribute lookup costs
+    # more than the token bucket itself
+    current = request._get_current_object()
+    endpoint = current.endpoint
+    if endpoint is None or current.method == 'OPTIONS':
+        return None
+    rate, burst = RATE_LIMITS.get(endpoint, DEFAULT_RATE_LIMIT)
+    # Runs before require_session, so requests without a valid session are
+    # throttled by address before they are rejected
+    user = session_user() if endpoint not in PUBLIC_ENDPOINTS else None
+    client = user or current.remote_addr
+    retry_after = rate_limiter.acquire((endpoint, client), rate, burst)
+    if retry_after:
+        response = jsonify({"message": "Too many requests, please retry later."})
+        response.headers['Retry-After'] = str(math.ceil(retry_after))
+        return response, 429
+    return None
+
+@app.before_request
+def require_session():
+    """Require a session token on every route but account creation and login
+
+    The session's user is stored in ``g.username``. A username in the URL
+    or JSON body must match it; when the body has none it is filled in.
+    """
+    if request.method == 'OPTIONS' or request.endpoint is None or request.endpoint in PUBLIC_ENDPOINTS:
+        return None
+
+    username = session_user()
+    if username is None:
+        return jsonify({"message": "Authentication required."}), 401
+    g.username = username
+
+    claimed = (request.view_args or {}).get('username')
+    if claimed is None and request.is_json:
+        data = request.get_json(silent=True)
+        if isinstance(data, dict):
+            claimed = data.setdefault('username', username)
+    if claimed is not None and claimed != username:
+        return jsonify({"message": "Not allowed for this user."}), 403
+    return None
+
 @app.route('/create_account', methods=['POST'])
 def create_account():
     """Create a new user account"""
@@ -182,23 +2434,33 @@ def create_account():
         password = data.get('password')
         email = data.get('email')
 
+        if not isinstance(password, str) or not password:
+            return jsonify({"message": "Password is required."}), 400
+        # Hash off the request thread, before taking any database lock
+        password_hash = hash_password(password)
+
         # Create a new account in the database
-        with sqlite3.connect(DATABASE_PATH) as conn:
+        with connect_db(DATABASE_PATH) as conn:
             cursor = conn.cursor()
             try:
                 cursor.execute(
                     """ 
-                    INSERT INTO accounts (username, password, email) VALUES (?, ?, ?) 
+                    INSERT INTO accounts (username, password, email, balance) VALUES (?, ?, ?, ?) 
                     """, 
-                    (username, password, email)
+                    (username, password_hash, email, INITIAL_BALANCE)
                 )
+                record_event(cursor, username, 'open', INITIAL_BALANCE)
+                state = read_account_state(cursor, username)
                 conn.commit()
+                update_valuations(state)
                 logger.info(f"Account created for username: {username}")
                 return jsonify({"message": f"Account for {username} created successfully."}), 201
             except sqlite3.IntegrityError:
                 # Handle duplicate username or email
                 logger.warning(f"Account creation failed: Username or email already exists - {username}")
                 return jsonify({"message": "Username or email already exists!"}), 400
+    except KdfOverloaded:
+        return kdf_busy_response()
     except Exception as e:
         # Handle any other exceptions
         logger.error(f"Account creation error: {e}")
@@ -216,16 +2478,22 @@ def login():
         password = data.get('password')
 
         if authenticate(username, password):
-            # Successful login
+            # Successful login: issue a signed session token
+            token, expires_at = issue_session_token(username)
             logger.info(f"Successful login for username: {username}")
             return jsonify({
                 "message": "Login successful.", 
-                "username": username
+                "username": username,
+                "token": token,
+                "expires_at": expires_at
             }), 200
         else:
             # Invalid credentials
             logger.warning(f"Failed login attempt for username: {username}")
             return jsonify({"message": "Invalid credentials."}), 401
+    except KdfOverloaded:
+        logger.warning(f"Login rejected, KDF pool is full: {username}")
+        return kdf_busy_response()
     except Exception as e:
         # Handle any unexpected errors
         logger.error(f"Login error: {e}")
@@ -240,7 +2508,7 @@ def get_account(username):
 
     try:
         # Connect to the database
-        with sqlite3.connect(DATABASE_PATH) as conn:
+        with connect_db(DATABASE_PATH) as conn:
             # Retrieve the account balance
             cursor = conn.cursor()
             cursor.execute("SELECT balance FROM accounts WHERE username = ?", (username,))
@@ -248,7 +2516,7 @@ def get_account(username):
 
             # Return account balance if found
             if account:
-                return jsonify({"balance": account[0]}), 200
+                return jsonify({"balance": from_micros(account[0])}), 200
             else:
                 # Return 404 if account not found
                 return jsonify({"error": "Account not found."}), 404
@@ -257,32 +2525,42 @@ def get_account(username):
         return jsonify({"error": str(e)}), 500
 
 @app.route('/deposit', methods=['POST'])
+@idempotent
 def deposit():
     """Deposit virtual funds into user account"""
     try:
         data = request.json
         username = data.get('username')  # Extract username from request
-        amount = float(data.get('amount', 0))  # Extract and convert amount
+        amount = to_micros(data.get('amount', 0))  # Extract and convert amount to micro-units
 
         if amount <= 0:
             # Validate deposit amount
             return jsonify({"message": "Deposit amount must be greater than zero."}), 400
 
-        with sqlite3.connect(DATABASE_PATH) as conn:
+        with user_transaction(username) as conn:
             cursor = conn.cursor()
             # Update user balance in database
-            cursor.execute("UPDATE accounts SET balance = balance + ? WHERE username = ?", (amount, username))
+            cursor.execute(
+                "UPDATE accounts SET balance = balance + ? WHERE username = ? AND balance <= ?",
+                (amount, username, MAX_BALANCE - amount)
+            )
             if cursor.rowcount == 0:
-                # Handle case where account is not found
-                return jsonify({"message": "Account not found."}), 404
-
+                cursor.execute("SELECT 1 FROM accounts WHERE username = ?", (username,))
+                if cursor.fetchone() is None:
+                    # Handle case where account is not found
+                    return jsonify({"message": "Account not found."}), 404
+                return jsonify({"message": "Deposit would exceed the maximum balance."}), 400
+
+            record_event(cursor, username, 'deposit', amount)
+            state = read_account_state(cursor, username)
             conn.commit()  # Commit transaction
+            update_valuations(state)
             
             # Log the deposit transaction
-            log_transaction(username, 'deposit', amount)
+            log_transaction(username, 'deposit', from_micros(amount))
             
             # Return success message
-            return jsonify({"message": f"Deposited ${amount:.2f}."}), 200
+            return jsonify({"message": f"Deposited ${from_micros(amount):.2f}."}), 200
     except ValueError:
         # Handle invalid amount errors
         return jsonify({"message": "Invalid deposit amount."}), 400
@@ -291,32 +2569,46 @@ def deposit():
         return jsonify({"error": str(e)}), 500
 
 @app.route('/withdraw', methods=['POST'])
+@idempotent
 def withdraw():
     """Withdraw funds from user account"""
     try:
         data = request.json  # Get JSON data from the request
         username = data.get('username')  # Extract username
-        amount = float(data.get('amount', 0))  # Extract and convert amount
+        amount = to_micros(data.get('amount', 0))  # Extract and convert amount to micro-units
+
+        if amount <= 0:
+            # Validate withdrawal amount
+            return jsonify({"message": "Withdrawal amount must be greater than zero."}), 400
 
-        with sqlite3.connect(DATABASE_PATH) as conn:
+        with user_transaction(username) as conn:
             cursor = conn.cursor()
 
             # Retrieve user's current balance
             cursor.execute("SELECT balance FROM accounts WHERE username = ?", (username,))
-            balance = cursor.fetchone()[0]
+            account = cursor.fetchone()
+            if account is None:
+                return jsonify({"message": "Account not found."}), 404
+            balance = account[0]
 
             if balance >= amount:
                 # Deduct amount from balance if sufficient
-                cursor.execute("UPDATE accounts SET balance = balance - ? WHERE username = ?", (amount, username))
+                cursor.execute(
+                    "UPDATE accounts SET balance = balance - ? WHERE username = ? AND balance >= ?",
+                    (amount, username, amount)
+                )
+                record_event(cursor, username, 'withdraw', -amount)
+                state = read_account_state(cursor, username)
                 conn.commit()  # Commit changes to the database
+                update_valuations(state)
                 
                 # Log the withdrawal transaction
-                log_transaction(username, 'withdraw', amount)
+                log_transaction(username, 'withdraw', from_micros(amount))
 
                 # Return success message with updated balance
                 return jsonify({
-                    "message": f"Withdrew ${amount:.2f}.", 
-                    "current_balance": balance - amount
+                    "message": f"Withdrew ${from_micros(amount):.2f}.", 
+                    "current_balance": from_micros(balance - amount)
                 }), 200
             # Return error if funds are insufficient
             return jsonify({"message": "Insufficient funds."}), 400
@@ -331,6 +2623,12 @@ def withdraw():
 def get_market_data():
     """Retrieve current market data"""
     try:
+        # With several workers, serve the leader's published tick as is
+        if market_snapshot is not None:
+            snapshot = market_snapshot.read()
+            if snapshot is not None:
+                return Response(snapshot[1], mimetype='application/json'), 200
+
         # Update market data before fetching (if required)
         market_data = update_market_data()
         
@@ -348,48 +2646,16 @@ def add_asset():
         data = request.json
         username = data.get('username')
         asset_name = data.get('asset_name')
-        quantity = float(data.get('quantity', 0))
-
-        with sqlite3.connect(DATABASE_PATH) as conn:
-            cursor = conn.cursor()
-
-            # Check if asset exists
-            cursor.execute("SELECT current_price FROM assets WHERE name = ?", (asset_name,))
-            asset_data = cursor.fetchone()
-            if not asset_data:
-                return jsonify({"message": "Asset not found."}), 404
-
-            current_price = asset_data[0]
-            total_cost = current_price * quantity
-
-            # Check user's balance
-            cursor.execute("SELECT balance FROM accounts WHERE username = ?", (username,))
-            balance = cursor.fetchone()[0]
-            if balance < total_cost:
-                return jsonify({"message": "Insufficient funds."}), 400
-
-            # Deduct the cost from the user's balance
-            cursor.execute("UPDATE accounts SET balance = balance - ? WHERE username = ?", (total_cost, username))
-            conn.commit()
+        quantity = to_micros(data.get('quantity', 0))
 
-            # Update portfolio
-            cursor.execute(""" 
-                INSERT INTO portfolios (username, asset_name, quantity, avg_purchase_price)
-                VALUES (?, ?, ?, ?)
-                ON CONFLICT(username, asset_name)
-                DO UPDATE SET 
-                    quantity = quantity + ?, 
-                    avg_purchase_price = (avg_purchase_price * quantity + ? * ?) / (quantity + ?)
-            """, (username, asset_name, quantity, current_price, quantity, current_price, quantity, quantity))
-            conn.commit()
+        # Validate quantity
+        if quantity <= 0:
+            return jsonify({"message": "Quantity must be greater than zero."}), 400
 
-            # Log the transaction
-            log_transaction(username, 'buy', total_cost, asset_name)
+        # Adding an asset buys it at the current price
+        body, status_code = execute_trade('buy', username, asset_name, quantity)
 
-        return jsonify({
-            "message": f"Purchased {quantity} units of {asset_name} for ${total_cost:.2f}.",
-            "current_balance": balance - total_cost
-        }), 200
+        return jsonify(body), status_code
     except ValueError:
         return jsonify({"message": "Invalid quantity."}), 400
     except Exception as e:
@@ -402,10 +2668,14 @@ def remove_asset():
         data = request.json
         username = data.get('username')
         asset_name = data.get('asset_name')
-        quantity = float(data.get('quantity', 0))
+        quantity = to_micros(data.get('quantity', 0))
+
+        # Validate quantity
+        if quantity <= 0:
+            return jsonify({"message": "Quantity must be greater than zero."}), 400
 
         # Check if asset exists in user's portfolio
-        with sqlite3.connect(DATABASE_PATH) as conn:
+        with user_transaction(username) as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT quantity FROM portfolios WHERE username = ? AND asset_name = ?", (username, asset_name))
             current_quantity = cursor.fetchone()
@@ -426,11 +2696,15 @@ def remove_asset():
                 cursor.execute("UPDATE portfolios SET quantity = quantity - ? WHERE username = ? AND asset_name = ?", (quantity, username, asset_name))
             
             # Commit changes and log transaction
+            consume_lots(cursor, username, asset_name, quantity, current_quantity == quantity)
+            record_event(cursor, username, 'remove_asset', 0, asset_name, -quantity)
+            state = read_account_state(cursor, username, asset_name)
             conn.commit()
-            log_transaction(username, 'remove_asset', quantity, asset_name)
+            update_valuations(state)
+            log_transaction(username, 'remove_asset', from_micros(quantity), asset_name)
 
         # Return success message
-        return jsonify({"message": f"Removed {quantity} units of {asset_name} from portfolio."}), 200
+        return jsonify({"message": f"Removed {from_micros(quantity)} units of {asset_name} from portfolio."}), 200
     except ValueError:
         # Invalid quantity
         return jsonify({"message": "Invalid quantity."}), 400
@@ -445,7 +2719,15 @@ def view_portfolio():
         data = request.json
         username = data.get('username')
 
-        with sqlite3.connect(DATABASE_PATH) as conn:
+        # Serve from the in-memory valuation cache when available
+        if valuations is not None:
+            sync_valuations()
+            portfolio = valuations.portfolio(username)
+            cache_requests.inc('valuation', 'miss' if portfolio is None else 'hit')
+            if portfolio is not None:
+                return jsonify(portfolio), 200
+
+        with connect_db(DATABASE_PATH) as conn:
             cursor = conn.cursor()
 
             # Retrieve user's portfolio holdings
@@ -457,16 +2739,16 @@ def view_portfolio():
             for asset_name, quantity, avg_purchase_price in user_portfolio:
                 # Get current market price for each asset
                 cursor.execute("SELECT current_price FROM assets WHERE name = ?", (asset_name,))
-                current_price = cursor.fetchone()[0]
-                # Calculate total value of each holding
-                value = current_price * quantity
+                current_price = to_price(cursor.fetchone()[0])
+                # Calculate total value of each holding, as the valuation cache does
+                value = position_value(quantity, current_price)
                 # Compile holding details, including profit/loss percentage
                 holdings.append({
                     "asset": asset_name,
-                    "quantity": quantity,
-                    "avg_purchase_price": avg_purchase_price,
-                    "current_price": current_price,
-                    "value": value,
+                    "quantity": from_micros(quantity),
+                    "avg_purchase_price": from_price(avg_purchase_price),
+                    "current_price": from_price(current_price),
+                    "value": from_micros(value),
                     "profit_loss_percentage": ((current_price - avg_purchase_price) / avg_purchase_price * 100) if avg_purchase_price > 0 else 0
                 })
                 total_value += value
@@ -478,67 +2760,264 @@ def view_portfolio():
         # Return portfolio summary, including net worth
         return jsonify({
             "holdings": holdings, 
-            "total_portfolio_value": total_value,
-            "account_balance": account_balance,
-            "total_net_worth": total_value + account_balance
+            "total_portfolio_value": from_micros(total_value),
+            "account_balance": from_micros(account_balance),
+            "total_net_worth": from_micros(total_value + account_balance)
         }), 200
     except Exception as e:
         # Handle any errors that occur
         return jsonify({"error": str(e)}), 500
 
-@app.route('/trade/buy', methods=['POST'])
-def buy_asset():
-    """Buy an asset using virtual money"""
+@app.route('/portfolio/net_worth', methods=['POST'])
+def get_net_worth():
+    """Retrieve a user's cash balance, holdings value and net worth"""
     try:
-        # Extract data from request
         data = request.json
         username = data.get('username')
-        asset_name = data.get('asset_name')
-        quantity = float(data.get('quantity', 0))
 
-        # Validate quantity
-        if quantity <= 0:
-            return jsonify({"message": "Quantity must be greater than zero."}), 400
+        # Served from memory when the valuation cache is enabled
+        if valuations is not None:
+            sync_valuations()
+            net_worth = valuations.net_worth(username)
+            cache_requests.inc('valuation', 'miss' if net_worth is None else 'hit')
+            if net_worth is None:
+                return jsonify({"message": "Account not found."}), 404
+            balance, holdings_value, total = net_worth
+        else:
+            with connect_db(DATABASE_PATH) as conn:
+                cursor = conn.cursor()
+                cursor.execute("SELECT balance FROM accounts WHERE username = ?", (username,))
+                account = cursor.fetchone()
+                if account is None:
+                    return jsonify({"message": "Account not found."}), 404
+
+                # Value every holding at the current price in one query
+                register_value_position(conn)
+                cursor.execute("""
+                    SELECT COALESCE(SUM(value_position(p.quantity, a.current_price)), 0)
+                    FROM portfolios p JOIN assets a ON a.name = p.asset_name
+                    WHERE p.username = ?
+                """, (username,))
+                holdings = cursor.fetchone()[0]
+                balance = from_micros(account[0])
+                holdings_value = from_micros(holdings)
+                total = from_micros(account[0] + holdings)
+
+        return jsonify({
+            "account_balance": balance,
+            "total_portfolio_value": holdings_value,
+            "total_net_worth": total
+        }), 200
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/leaderboard', methods=['GET'])
+def get_leaderboard():
+    """Rank accounts by net worth
+
+    Query parameters: ``limit`` (top N, default 10) and optionally
+    ``username`` to also return that user's rank.
+    """
+    try:
+        if valuations is None:
+            return jsonify({"message": "Leaderboard requires the valuation cache."}), 503
+        sync_valuations()
+
+        limit = min(int(request.args.get('limit', 10)), LEADERBOARD_MAX_LIMIT)
+        if limit <= 0:
+            return jsonify({"message": "Limit must be greater than zero."}), 400
+
+        response = {
+            "leaderboard": [
+                {"rank": rank, "username": username, "net_worth": net_worth}
+                for rank, username, net_worth in leaderboard.top(limit)
+            ],
+            "total_accounts": len(leaderboard)
+        }
 
-        # Connect to database
-        with sqlite3.connect(DATABASE_PATH) as conn:
+        # Optionally include the requesting user's own position
+        username = request.args.get('username')
+        if username:
+            position = leaderboard.rank(username)
+            if position is None:
+                return jsonify({"message": "Account not found."}), 404
+            response["user"] = {"rank": position[0], "username": username, "net_worth": position[1]}
+
+        return jsonify(response), 200
+    except ValueError:
+        return jsonify({"message": "Invalid limit."}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/portfolio/history', methods=['POST'])
+def get_portfolio_history():
+    """Return a user's equity curve from the periodic portfolio snapshots
+
+    Body: ``username`` plus optional ``from``/``to`` (unix seconds) and
+    ``max_points`` to downsample long ranges.
+    """
+    try:
+        data = request.json
+        username = data.get('username')
+        start = int(data.get('from', 0))
+        end = int(data.get('to', time.time()))
+        max_points = min(int(data.get('max_points', HISTORY_MAX_POINTS)), HISTORY_MAX_POINTS)
+        if max_points <= 0:
+            return jsonify({"message": "max_points must be greater than zero."}), 400
+
+        with connect_db(DATABASE_PATH) as conn:
             cursor = conn.cursor()
+            # Primary-key range scan over the user's snapshots
+            cursor.execute("""
+                SELECT taken_at, balance, holdings_value FROM portfolio_snapshots
+                WHERE username = ? AND taken_at BETWEEN ? AND ?
+                ORDER BY taken_at ASC
+            """, (username, start, end))
+            rows = cursor.fetchall()
+
+        if not rows:
+            return jsonify({"message": "No portfolio history found."}), 404
+
+        snapshots = np.array(rows, dtype=np.int64)[downsample_indices(len(rows), max_points)]
+        history = [
+            {
+                "timestamp": datetime.fromtimestamp(taken_at, timezone.utc).strftime('%Y-%m-%d %H:%M:%S'),
+                "account_balance": from_micros(balance),
+                "total_portfolio_value": from_micros(holdings_value),
+                "total_net_worth": from_micros(balance + holdings_value)
+            }
+            for taken_at, balance, holdings_value in snapshots.tolist()
+        ]
+        return jsonify({"username": username, "history": history, "total_snapshots": len(rows)}), 200
+    except ValueError:
+        return jsonify({"message": "Invalid history range."}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
 
-            # Retrieve asset's current price
-            cursor.execute("SELECT current_price FROM assets WHERE name = ?", (asset_name,))
-            asset_data = cursor.fetchone()
-            if not asset_data:
-                return jsonify({"message": "Asset not found."}), 404
+@app.route('/ledger/rebuild', methods=['POST'])
+def rebuild_account_state():
+    """Reconstruct an account from the event ledger
 
-            current_price = asset_data[0]
-            total_cost = current_price * quantity
+    Body: ``username`` and optionally ``seq`` (event sequence number) or
+    ``at`` (unix time). Without either, the current state is rebuilt and
+    compared with the live tables.
+    """
+    try:
+        data = request.json
+        username = data.get('username')
+        seq = int(data['seq']) if data.get('seq') is not None else None
+        at = float(data['at']) if data.get('at') is not None else None
 
-            # Check user's balance
+        with connect_db(DATABASE_PATH, timeout=DB_TIMEOUT) as conn:
+            cursor = conn.cursor()
+            # One read transaction, so the live state and the log agree
+            cursor.execute("BEGIN")
             cursor.execute("SELECT balance FROM accounts WHERE username = ?", (username,))
-            balance = cursor.fetchone()[0]
-            if balance < total_cost:
-                return jsonify({"message": "Insufficient funds."}), 400
+            account = cursor.fetchone()
+            if account is None:
+                return jsonify({"message": "Account not found."}), 404
+
+            rebuilt_seq, balance, positions = rebuild_account(cursor, username, seq, at)
+            response = {
+                "username": username,
+                "seq": rebuilt_seq,
+                "balance": from_micros(balance),
+                "positions": [
+                    {"asset": asset_name, "quantity": from_micros(quantity), "avg_purchase_price": from_price(avg_price)}
+                    for asset_name, (quantity, avg_price) in sorted(positions.items())
+                ]
+            }
+
+            if seq is None and at is None:
+                # Audit: the replayed state must equal the mutable tables
+                cursor.execute("SELECT asset_name, quantity, avg_purchase_price FROM portfolios WHERE username = ?", (username,))
+                live_positions = {asset_name: [quantity, avg_price] for asset_name, quantity, avg_price in cursor.fetchall()}
+                response["matches_live_state"] = balance == account[0] and positions == live_positions
+
+        return jsonify(response), 200
+    except (ValueError, TypeError):
+        return jsonify({"message": "Invalid seq or time."}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
 
-            # Deduct cost and update portfolio
-            cursor.execute("UPDATE accounts SET balance = balance - ? WHERE username = ?", (total_cost, username))
+@app.route('/portfolio/pnl', methods=['POST'])
+def get_portfolio_pnl():
+    """Report realized and unrealized P&L per position from the running totals"""
+    try:
+        data = request.json
+        username = data.get('username')
+
+        with connect_db(DATABASE_PATH) as conn:
+            cursor = conn.cursor()
+            # One query over open positions and closed ones that still carry realized P&L
             cursor.execute("""
-                INSERT INTO portfolios (username, asset_name, quantity, avg_purchase_price)
-                VALUES (?, ?, ?, ?)
-                ON CONFLICT(username, asset_name)
-                DO UPDATE SET
-                    quantity = quantity + ?,
-                    avg_purchase_price = (avg_purchase_price * quantity + ? * ?) / (quantity + ?)
-            """, (username, asset_name, quantity, current_price, quantity, current_price, quantity, quantity))
-            conn.commit()
+                SELECT n.asset_name, COALESCE(p.quantity, 0), COALESCE(p.avg_purchase_price, 0),
+                       n.realized_pnl, n.fifo_cost_basis, a.current_price
+                FROM position_pnl n
+                LEFT JOIN portfolios p ON p.username = n.username AND p.asset_name = n.asset_name
+                LEFT JOIN assets a ON a.name = n.asset_name
+                WHERE n.username = ?
+                ORDER BY n.asset_name
+            """, (username,))
+            rows = cursor.fetchall()
 
-            # Log transaction
-            log_transaction(username, 'buy', total_cost, asset_name)
+        positions = []
+        total_realized = total_unrealized = total_cost_basis = 0
+        for asset_name, quantity, avg_purchase_price, realized_pnl, fifo_cost_basis, current_price in rows:
+            if COST_BASIS_METHOD == 'fifo':
+                cost_basis = fifo_cost_basis
+            else:
+                cost_basis = notional(avg_purchase_price, quantity)
+            market_value = notional(to_price(current_price), quantity) if current_price is not None else cost_basis
+            unrealized_pnl = market_value - cost_basis
+
+            positions.append({
+                "asset": asset_name,
+                "quantity": from_micros(quantity),
+                "cost_basis": from_micros(cost_basis),
+                "market_value": from_micros(market_value),
+                "unrealized_pnl": from_micros(unrealized_pnl),
+                "realized_pnl": from_micros(realized_pnl)
+            })
+            total_realized += realized_pnl
+            total_unrealized += unrealized_pnl
+            total_cost_basis += cost_basis
 
-        # Respond with purchase confirmation
         return jsonify({
-            "message": f"Purchased {quantity} units of {asset_name} for ${total_cost:.2f}.",
-            "current_balance": balance - total_cost
+            "cost_basis_method": COST_BASIS_METHOD,
+            "positions": positions,
+            "total_cost_basis": from_micros(total_cost_basis),
+            "total_realized_pnl": from_micros(total_realized),
+            "total_unrealized_pnl": from_micros(total_unrealized),
+            "total_pnl": from_micros(total_realized + total_unrealized)
         }), 200
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/trade/buy', methods=['POST'])
+@idempotent
+def buy_asset():
+    """Buy an asset using virtual money"""
+    try:
+        # Extract data from request
+        data = request.json
+        username = data.get('username')
+        asset_name = data.get('asset_name')
+        quantity = to_micros(data.get('quantity', 0))
+
+        # Validate quantity
+        if quantity <= 0:
+            return jsonify({"message": "Quantity must be greater than zero."}), 400
+
+        # Queue the order instead of executing it on the request thread
+        if order_intake is not None:
+            return order_intake.submit(username, 'buy', asset_name, quantity)
+
+        # Execute the purchase in a single write transaction
+        body, status_code = execute_trade('buy', username, asset_name, quantity)
+
+        # Respond with purchase confirmation
+        return jsonify(body), status_code
     except ValueError:
         # Handle invalid quantity
         return jsonify({"message": "Invalid quantity."}), 400
@@ -547,68 +3026,52 @@ def buy_asset():
         return jsonify({"error": str(e)}), 500
 
 @app.route('/trade/sell', methods=['POST'])
+@idempotent
 def sell_asset():
     """Sell an asset and gain virtual money"""
     try:
         data = request.json
         username = data.get('username')
         asset_name = data.get('asset_name')
-        quantity = float(data.get('quantity', 0))
-
-        with sqlite3.connect(DATABASE_PATH) as conn:
-            cursor = conn.cursor()
+        quantity = to_micros(data.get('quantity', 0))
 
-            # Validate user's portfolio
-            cursor.execute("SELECT quantity, avg_purchase_price FROM portfolios WHERE username = ? AND asset_name = ?", (username, asset_name))
-            portfolio_data = cursor.fetchone()
+        # Validate quantity
+        if quantity <= 0:
+            return jsonify({"message": "Quantity must be greater than zero."}), 400
 
-            if portfolio_data is None:
-                return jsonify({"message": "Asset not found in portfolio."}), 404
+        # Queue the order instead of executing it on the request thread
+        if order_intake is not None:
+            return order_intake.submit(username, 'sell', asset_name, quantity)
 
-            current_quantity, avg_purchase_price = portfolio_data
-            if current_quantity < quantity:
-                return jsonify({"message": "Insufficient quantity to sell."}), 400
+        # Execute the sale in a single write transaction
+        body, status_code = execute_trade('sell', username, asset_name, quantity)
 
-            # Fetch current market price
-            cursor.execute("SELECT current_price FROM assets WHERE name = ?", (asset_name,))
-            current_price = cursor.fetchone()[0]
-            total_revenue = current_price * quantity
+        return jsonify(body), status_code
 
-            # Calculate profit/loss
-            total_cost = avg_purchase_price * quantity
-            profit_loss = total_revenue - total_cost
+    except ValueError:
+        return jsonify({"message": "Invalid quantity."}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
 
-            # Update user's balance
-            cursor.execute("UPDATE accounts SET balance = balance + ? WHERE username = ?", (total_revenue, username))
-            conn.commit()
+@app.route('/orders/<order_id>', methods=['GET'])
+def get_order(order_id):
+    """Retrieve the status of a queued order
 
-            # Update portfolio
-            if current_quantity == quantity:
-                # Remove the entire asset if selling all quantity
-                cursor.execute("DELETE FROM portfolios WHERE username = ? AND asset_name = ?", (username, asset_name))
-            else:
-                # Update remaining quantity
-                cursor.execute(""" 
-                    UPDATE portfolios 
-                    SET quantity = quantity - ?, 
-                    avg_purchase_price = (avg_purchase_price * quantity - ? * avg_purchase_price) / (quantity - ?)
-                    WHERE username = ? AND asset_name = ?
-                """, (quantity, quantity, quantity, username, asset_name))
-            
-            conn.commit()
+    Pass ?wait=<seconds> (at most ORDER_MAX_WAIT) to long-poll until the
+    order is no longer pending.
+    """
+    try:
+        wait = min(float(request.args.get('wait', 0)), ORDER_MAX_WAIT)
+        order = find_order(order_id)
+        if order is None or order.get('username') != g.username:
+            return jsonify({"message": "Order not found."}), 404
 
-            # Log transaction
-            log_transaction(username, 'sell', total_revenue, asset_name)
-
-        return jsonify({
-            "message": f"Sold {quantity} units of {asset_name} at ${current_price:.2f} each.", 
-            "total_revenue": total_revenue,
-            "profit_loss": profit_loss,
-            "profit_loss_percentage": (profit_loss / total_cost) * 100 if total_cost > 0 else 0
-        }), 200
+        if order['status'] == 'pending' and wait > 0 and order_intake is not None:
+            order = order_intake.wait(order_id, wait) or find_order(order_id)
 
+        return jsonify(order), 200
     except ValueError:
-        return jsonify({"message": "Invalid quantity."}), 400
+        return jsonify({"message": "Invalid wait time."}), 400
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -619,7 +3082,7 @@ def get_transaction_history():
         data = request.json  # Get JSON data from the request
         username = data.get('username')  # Extract username
 
-        with sqlite3.connect(DATABASE_PATH) as conn:
+        with connect_db(DATABASE_PATH) as conn:
             cursor = conn.cursor()
             # Query to fetch the last 50 transactions for the user
             cursor.execute(""" 
@@ -656,7 +3119,7 @@ def get_historical_prices(asset_name):
     """Retrieve historical prices for a specific asset"""
     try:
         # Connect to the database
-        with sqlite3.connect(DATABASE_PATH) as conn:
+        with connect_db(DATABASE_PATH) as conn:
             # Create a database cursor
             cursor = conn.cursor()
 
@@ -694,7 +3157,7 @@ def analyze_trend(asset_name):
     404 error if no historical data is found for the given asset.
     """
     try:
-        with sqlite3.connect(DATABASE_PATH) as conn:
+        with connect_db(DATABASE_PATH) as conn:
             cursor = conn.cursor()
             # Fetch historical prices sorted by timestamp in ascending order
             cursor.execute("SELECT price, timestamp FROM historical_prices WHERE asset_name = ? ORDER BY timestamp ASC", (asset_name,))
@@ -717,18 +3180,562 @@ def analyze_trend(asset_name):
         # Handle any exceptions and return error message
         return jsonify({"error": str(e)}), 500
 
+@app.route('/prices/matrix', methods=['GET'])
+def get_price_matrix():
+    """Time x asset price matrix aligned on a common grid, forward-filled
+
+    Query: ``assets`` (comma separated), optional ``from``/``to`` (unix
+    seconds), ``interval`` (grid step in seconds; by default every
+    timestamp any of the assets was observed at) and ``format`` ('json'
+    or 'npz'). The npz body holds ``timestamps``, ``assets`` and a
+    column-major ``prices`` matrix, readable with numpy.load().
+    """
+    try:
+        assets = [name for name in request.args.get('assets', '').split(',') if name]
+        start = request.args.get('from', type=int)
+        end = request.args.get('to', default=int(time.time()), type=int)
+        interval = request.args.get('interval', type=int)
+        output = request.args.get('format', 'json')
+        if not assets or len(assets) > PRICE_MATRIX_MAX_ASSETS or len(set(assets)) != len(assets):
+            return jsonify({"message": f"Give between 1 and {PRICE_MATRIX_MAX_ASSETS} distinct assets."}), 400
+        if interval is not None and interval <= 0:
+            return jsonify({"message": "interval must be greater than zero."}), 400
+        if output not in ('json', 'npz'):
+            return jsonify({"message": "format must be 'json' or 'npz'."}), 400
+
+        def db_time(timestamp):
+            return datetime.fromtimestamp(timestamp, timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+        lower = db_time(start) if start is not None else ''
+        upper = db_time(end)
+
+        # One statement over the (asset_name, timestamp) primary key; each
+        # asset's range starts at its last price at or before 'from' so the
+        # first grid rows can be forward-filled. Rows are sorted below rather
+        # than with ORDER BY, which would spill them into a temporary B-tree
+        with connect_db(DATABASE_PATH) as conn:
+            cursor = conn.cursor()
+            cursor.execute(f"""
+                WITH wanted(slot, name) AS (VALUES {', '.join('(?, ?)' for _ in assets)}),
+                bounds AS (
+                    SELECT slot, name, COALESCE((
+                        SELECT MAX(p.timestamp) FROM historical_prices p
+                        WHERE p.asset_name = wanted.name AND p.timestamp <= ?), ?) AS lower
+                    FROM wanted
+                )
+                SELECT b.slot, CAST(strftime('%s', h.timestamp) AS INTEGER), h.price
+                FROM bounds b JOIN historical_prices h
+                  ON h.asset_name = b.name AND h.timestamp >= b.lower AND h.timestamp <= ?
+            """, [value for column, name in enumerate(assets) for value in (column, name)] + [lower, lower, upper])
+            rows = cursor.fetchall()
+
+        # All three columns are numeric: convert in one pass, then order by (asset, time)
+        table = np.array(rows, dtype=np.float64).reshape(-1, 3)
+        table = table[np.lexsort((table[:, 1], table[:, 0]))]
+        columns, timestamps, prices = table[:, 0].astype(np.int64), table[:, 1].astype(np.int64), table[:, 2]
+        first = start if start is not None else (int(timestamps.min()) if len(timestamps) else end)
+
+        # Grid: fixed steps, or every observed timestamp inside the range
+        if interval is not None:
+            if (end - first) // interval + 1 > PRICE_MATRIX_MAX_ROWS:
+                return jsonify({"message": f"At most {PRICE_MATRIX_MAX_ROWS} rows; use a larger interval."}), 400
+            grid = np.arange(first, end + 1, interval, dtype=np.int64)
+        else:
+            grid = np.unique(timestamps[timestamps >= first])
+            if len(grid) > PRICE_MATRIX_MAX_ROWS:
+                return jsonify({"message": f"At most {PRICE_MATRIX_MAX_ROWS} rows; set an interval."}), 400
+
+        matrix = pivot_prices(columns, timestamps, prices, len(assets), grid)
+
+        if output == 'npz':
+            buffer = io.BytesIO()
+            np.savez(buffer, timestamps=grid, assets=np.array(assets), prices=matrix)
+            response = make_response(buffer.getvalue())
+            response.headers['Content-Type'] = 'application/octet-stream'
+            response.headers['Content-Disposition'] = 'attachment; filename=prices.npz'
+            return response, 200
+
+        return jsonify({
+            "assets": assets,
+            "timestamps": grid.tolist(),
+            "prices": [[value if value == value else None for value in row] for row in matrix.tolist()]
+        }), 200
+    except ValueError:
+        return jsonify({"message": "Invalid price matrix request."}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/analytics/risk', methods=['POST'])
+def get_risk_analytics():
+    """Correlation, volatility, VaR and drawdown of a user's current holdings
+
+    Body: ``username`` plus optional ``window`` (price bars of history),
+    ``confidence`` (VaR level, default 0.95) and ``horizon`` (VaR horizon
+    in bars, default 1). Holdings are valued as if held over the whole
+    window.
+    """
+    try:
+        # Drop risk statistics cached before the leader's latest tick
+        load_market_snapshot()
+        data = request.json
+        username = data.get('username')
+        window = int(data.get('window', RISK_DEFAULT_WINDOW))
+        confidence = float(data.get('confidence', 0.95))
+        horizon = int(data.get('horizon', 1))
+        if not 2 <= window <= RISK_MAX_WINDOW:
+            return jsonify({"message": f"window must be between 2 and {RISK_MAX_WINDOW}."}), 400
+        if not 0 < confidence < 1:
+            return jsonify({"message": "confidence must be between 0 and 1."}), 400
+        if not 1 <= horizon < window:
+            return jsonify({"message": "horizon must be at least 1 and smaller than window."}), 400
+
+        with connect_db(DATABASE_PATH) as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT asset_name, quantity FROM portfolios WHERE username = ? ORDER BY asset_name",
+                (username,)
+            )
+            holdings = cursor.fetchall()
+        if not holdings:
+            return jsonify({"message": "No holdings to analyze."}), 404
+
+        # Statistics depend only on the asset set and window, not on the quantities
+        assets = [asset_name for asset_name, _ in holdings]
+        key = (tuple(assets), window)
+        stats, generation = risk_cache.get(key)
+        cached = stats is not None
+        cache_requests.inc('risk', 'hit' if cached else 'miss')
+        if stats is None:
+            timestamps, prices = load_prices(DATABASE_PATH, assets, BACKTEST_CACHE_DIR)
+            stats = window_statistics(timestamps, prices, window)
+            if stats is None:
+                return jsonify({"message": "Not enough price history for these assets."}), 404
+            risk_cache.put(key, stats, generation)
+
+        quantities = np.array([from_micros(quantity) for _, quantity in holdings])
+        risk = portfolio_risk(stats, quantities, confidence, horizon)
+
+        def finite(matrix):
+            # NaN (e.g. correlation of a constant price) is not valid JSON
+            return [[value if np.isfinite(value) else None for value in row] for row in matrix.tolist()]
+
+        return jsonify({
+            "assets": assets,
+            "weights": risk["weights"].tolist(),
+            "covariance": finite(stats["covariance"]),
+            "correlation": finite(stats["correlation"]),
+            "portfolio_value": risk["value"],
+            "volatility": risk["volatility"],
+            "annualized_volatility": risk["annualized_volatility"],
+            "value_at_risk": risk["var"],
+            "value_at_risk_percentage": risk["var_return"] * 100 if risk["var_return"] is not None else None,
+            "max_drawdown": risk["max_drawdown"],
+            "confidence": confidence,
+            "horizon": horizon,
+            "bars": len(stats["returns"]),
+            "bar_seconds": stats["bar_seconds"],
+            "cached": cached
+        }), 200
+    except ValueError:
+        return jsonify({"message": "Invalid risk analytics request."}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/backtest', methods=['POST'])
+def backtest_strategy():
+    """Backtest a trading strategy over the stored historical prices
+
+    Body: ``assets`` (list of asset names), ``strategy`` ('sma_crossover',
+    'momentum' or 'rebalance'), optional ``params`` for the strategy,
+    ``fee``/``slippage`` as fractions of traded value and ``max_points``
+    for the returned equity curve.
+    """
+    try:
+        data = request.json
+        assets = data.get('assets') or [data.get('asset_name')]
+        strategy = data.get('strategy', 'sma_crossover')
+        params = data.get('params') or {}
+        fee = float(data.get('fee', 0.001))
+        slippage = float(data.get('slippage', 0.0005))
+        max_points = min(int(data.get('max_points', HISTORY_MAX_POINTS)), HISTORY_MAX_POINTS)
+        if not all(isinstance(asset, str) for asset in assets) or not isinstance(params, dict):
+            return jsonify({"message": "Invalid backtest request."}), 400
+        if len(assets) > BACKTEST_MAX_ASSETS:
+            return jsonify({"message": f"At most {BACKTEST_MAX_ASSETS} assets per backtest."}), 400
+        if max_points <= 0:
+            return jsonify({"message": "max_points must be greater than zero."}), 400
+
+        timestamps, prices = load_prices(DATABASE_PATH, assets, BACKTEST_CACHE_DIR)
+        if len(timestamps) == 0:
+            return jsonify({"message": "No historical data found for these assets."}), 404
+
+        start = time.perf_counter()
+        summary, equity = run_backtest(timestamps, prices, assets, strategy, params, fee, slippage)
+        logger.info(f"Backtest {strategy} over {len(assets)} assets x {len(timestamps)} bars took {time.perf_counter() - start:.3f}s")
+
+        indices = downsample_indices(len(equity), max_points)
+        summary["equity_curve"] = [
+            {"timestamp": int(timestamp), "equity": float(value)}
+            for timestamp, value in zip(timestamps[indices], equity[indices])
+        ]
+        return jsonify(summary), 200
+    except ValueError as e:
+        # Unknown strategy, bad parameters or too little data
+        return jsonify({"message": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/backtest/sweep', methods=['POST'])
+def sweep_strategy():
+    """Backtest a grid of strategy parameters in parallel, streaming ranked results
+
+    Body as for /backtest, with ``grid`` ({param: [values]}) instead of
+    ``params``, plus optional ``metric`` to rank by and ``top``. The
+    response is newline-delimited JSON: one line per finished combination
+    (with the current best), then a final line with the top ranking.
+    """
+    try:
+        data = request.json
+        assets = data.get('assets') or [data.get('asset_name')]
+        strategy = data.get('strategy', 'sma_crossover')
+        grid = data.get('grid')
+        fee = float(data.get('fee', 0.001))
+        slippage = float(data.get('slippage', 0.0005))
+        metric = data.get('metric', 'sharpe_ratio')
+        top = int(data.get('top', 10))
+        if not all(isinstance(asset, str) for asset in assets):
+            return jsonify({"message": "Invalid sweep request."}), 400
+        if len(assets) > BACKTEST_MAX_ASSETS:
+            return jsonify({"message": f"At most {BACKTEST_MAX_ASSETS} assets per backtest."}), 400
+        if metric not in RANK_METRICS:
+            return jsonify({"message": f"metric must be one of {', '.join(RANK_METRICS)}."}), 400
+        total = len(parameter_grid(grid))
+        if total > SWEEP_MAX_COMBINATIONS:
+            return jsonify({"message": f"At most {SWEEP_MAX_COMBINATIONS} parameter combinations per sweep."}), 400
+
+        timestamps, prices = load_prices(DATABASE_PATH, assets, BACKTEST_CACHE_DIR)
+        if len(timestamps) == 0:
+            return jsonify({"message": "No historical data found for these assets."}), 404
+
+        def generate():
+            start = time.perf_counter()
+            completed = 0
+            for kind, summary, ranking in run_sweep(timestamps, prices, assets, strategy, grid, fee, slippage,
+                                                    SWEEP_WORKERS, metric, top):
+                if kind == 'result':
+                    completed += 1
+                    line = {"completed": completed, "total": total, "result": summary,
+                            "best": ranking[0] if ranking else None}
+                else:
+                    logger.info(f"Sweep of {total} {strategy} combinations took {time.perf_counter() - start:.3f}s")
+                    line = {"completed": completed, "total": total, "metric": metric, "ranking": ranking}
+                yield json.dumps(line) + "\n"
+
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+    except ValueError as e:
+        # Malformed grid or parameters
+        return jsonify({"message": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+def _kdf_jobs():
+    stats = kdf_pool.stats()
+    return [(("completed",), stats["completed"]), (("rejected",), stats["rejected"])]
+
+def _kdf_latency():
+    stats = kdf_pool.stats()
+    return [((phase, q / 100), stats[f"{phase}_p{q}"]) for phase in ("wait", "duration") for q in (50, 99)]
+
+def _cache_entries():
+    return [(("session",), len(session_cache)), (("idempotency",), len(idempotency_cache)),
+            (("risk",), len(risk_cache.entries)), (("rate_limit",), len(rate_limiter.buckets))]
+
+registry.gauge('kdf_jobs_total', 'Password hashing jobs by outcome', _kdf_jobs, ('result',), kind='counter')
+registry.gauge('kdf_job_seconds', 'Recent password hashing queue wait and duration', _kdf_latency, ('phase', 'quantile'))
+registry.gauge('cache_entries', 'Entries held by in-memory caches', _cache_entries, ('cache',))
+registry.gauge('valuation_cache_accounts', 'Accounts in the valuation cache',
+               lambda: len(valuations.usernames) if valuations is not None else None)
+registry.gauge('order_queue_depth', 'Orders waiting for an order worker',
+               lambda: sum(q.qsize() for q in order_intake.queues) if order_intake is not None else 0)
+registry.gauge('ledger_queue_depth', 'Ledger rows waiting for the write-behind writer',
+               lambda: ledger_writer.queue.qsize() if ledger_writer is not None else 0)
+if log_pipeline is not None:
+    registry.gauge('log_queue_depth', 'Log records waiting for the listener thread', log_pipeline.queue_depth)
+    registry.gauge('log_records_dropped_total', 'Log records dropped because the log queue was full',
+                   lambda: log_pipeline.handler.dropped, kind='counter')
+    registry.gauge('log_records_suppressed_total', 'Log records dropped by per-call-site sampling',
+                   lambda: log_pipeline.sampler.suppressed if log_pipeline.sampler is not None else 0, kind='counter')
+registry.gauge('market_data_last_fetch_timestamp_seconds', 'Time of the last successful market data API call',
+               lambda: last_update_time or None)
+
+def bearer_token_matches(expected):
+    """Whether the request's Authorization header carries the bearer token `expected`"""
+    scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+    return scheme.lower() == 'bearer' and hmac.compare_digest(token.strip().encode(), expected.encode())
+
+def require_admin(view):
+    """Restrict a route to requests carrying ADMIN_TOKEN (all are refused when it is unset)"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not ADMIN_TOKEN:
+            return jsonify({"message": "Admin endpoints are disabled; set ADMIN_TOKEN."}), 403
+        if not bearer_token_matches(ADMIN_TOKEN):
+            return jsonify({"message": "Authentication required."}), 401
+        return view(*args, **kwargs)
+    return wrapper
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Expose the server's metrics in the Prometheus text format
+
+    Metrics are kept per process: with several workers each scrape
+    reports the worker that answered it.
+    """
+    if METRICS_TOKEN and not bearer_token_matches(METRICS_TOKEN):
+        return jsonify({"message": "Authentication required."}), 401
+    return Response(registry.expose(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/admin/queries', methods=['GET'])
+@require_admin
+def get_query_stats():
+    """Report the statements run by this process, aggregated per SQL fingerprint
+
+    Query parameters: sort (total, max, mean, count or slow; default
+    total) and limit (default 50).
+    """
+    try:
+        sort = request.args.get('sort', 'total')
+        limit = int(request.args.get('limit', 50))
+        if sort not in ('total', 'max', 'mean', 'count', 'slow'):
+            return jsonify({"message": "sort must be one of total, max, mean, count, slow."}), 400
+        if limit < 1:
+            raise ValueError("limit must be positive")
+        return jsonify({
+            "pid": os.getpid(),
+            "since": query_stats.since,
+            "slow_query_ms": SLOW_QUERY_MS,
+            "queries": query_stats.top(sort, limit),
+        }), 200
+    except ValueError:
+        return jsonify({"message": "Invalid limit."}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/admin/queries', methods=['DELETE'])
+@require_admin
+def reset_query_stats():
+    """Clear this process's query statistics"""
+    query_stats.reset()
+    return jsonify({"message": "Query statistics reset."}), 200
+
+@app.route('/admin/profile', methods=['GET'])
+@require_admin
+def get_profile():
+    """Report the profiler's state and, per endpoint, the functions with the most self time (?top=)"""
+    try:
+        top = int(request.args.get('top', 10))
+        if top < 1:
+            raise ValueError("top must be positive")
+        return jsonify({"pid": os.getpid(), **profiler.summary(top)}), 200
+    except ValueError:
+        return jsonify({"message": "Invalid top."}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/admin/profile', methods=['POST'])
+@require_admin
+def start_profile():
+    """Start profiling this process's requests, discarding the previous profile
+
+    Body: sample_rate (fraction of requests, default 0.01), optional
+    endpoints (names of the route handlers to profile) and interval_ms
+    (stack sampling period, default 5).
+    """
+    try:
+        data = request.get_json(silent=True) or {}
+        endpoints = data.get('endpoints')
+        if endpoints is not None and not (isinstance(endpoints, list) and all(isinstance(name, str) for name in endpoints)):
+            return jsonify({"message": "endpoints must be a list of endpoint names."}), 400
+        profiler.start(float(data.get('sample_rate', 0.01)), endpoints, float(data.get('interval_ms', 5)) / 1000)
+        logger.info(f"Profiling {profiler.sample_rate:.2%} of requests to {', '.join(endpoints) if endpoints else 'all endpoints'}")
+        return jsonify({"message": "Profiling started.", "pid": os.getpid()}), 200
+    except (TypeError, ValueError) as e:
+        return jsonify({"message": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/admin/profile', methods=['DELETE'])
+@require_admin
+def stop_profile():
+    """Stop profiling; the collected profile can still be downloaded"""
+    profiler.stop()
+    return jsonify({"message": "Profiling stopped.", "pid": os.getpid()}), 200
+
+@app.route('/admin/profile/download', methods=['GET'])
+@require_admin
+def download_profile():
+    """Download the profile of one endpoint (?endpoint=) or of all of them
+
+    format=pstats (default) is cProfile's statistics file, for pstats or
+    snakeviz; format=collapsed is the sampled stacks, one
+    "frame;frame;... count" line each, for flamegraph.pl or speedscope.
+    """
+    endpoint = request.args.get('endpoint')
+    output = request.args.get('format', 'pstats')
+    if endpoint is not None and endpoint not in app.view_functions and endpoint != 'unmatched':
+        return jsonify({"message": "Unknown endpoint."}), 400
+    suffix = f"-{endpoint}" if endpoint else ""
+    if output == 'pstats':
+        data = profiler.pstats_data(endpoint)
+        mimetype, filename = 'application/octet-stream', f"profile{suffix}.prof"
+    elif output == 'collapsed':
+        data = profiler.collapsed_stacks(endpoint)
+        mimetype, filename = 'text/plain', f"profile{suffix}.folded"
+    else:
+        return jsonify({"message": "format must be pstats or collapsed."}), 400
+    if not data:
+        return jsonify({"message": "No profile collected yet."}), 404
+    response = Response(data, mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
+
+
+# Application factory and multi-process serving
+def acquire_file_lock(path, blocking=True):
+    """Take an exclusive lock shared by all processes on this host
+
+    Returns the open lock file, which holds the lock until it is closed
+    or the process dies, or None when not blocking and it is taken.
+    """
+    lock_file = open(path, 'a')
+    if fcntl is None:
+        return lock_file
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock_file.close()
+        return None
+    return lock_file
+
+def start_leader_services(start_refresher=start_market_refresher):
+    """Start the jobs exactly one process may run: market data polling or replay, and snapshots"""
+    logger.info(f"Process {os.getpid()} is the leader: running the market refresher and snapshot jobs")
+    start_snapshot_job()
+    start_market_replay()
+    start_refresher()
+
+def _await_leadership(start_refresher):
+    global leader_lock
+    leader_lock = acquire_file_lock(LEADER_LOCK_FILE)
+    start_leader_services(start_refresher)
+
+def elect_leader(start_refresher=start_market_refresher):
+    """Run the leader-only services here if no other process holds LEADER_LOCK_FILE
+
+    Otherwise a background thread blocks on the lock, so a surviving
+    worker takes over as soon as the leader exits or crashes.
+    """
+    global leader_lock
+    leader_lock = acquire_file_lock(LEADER_LOCK_FILE, blocking=False)
+    if leader_lock is not None:
+        start_leader_services(start_refresher)
+    else:
+        threading.Thread(target=_await_leadership, args=(start_refresher,), name='leader-election', daemon=True).start()
+
+def serving_multiprocess():
+    """Whether other processes may serve the same database as this one
+
+    True with WEB_CONCURRENCY > 1, and under gunicorn whatever its worker
+    count: `gunicorn -w 4` does not set WEB_CONCURRENCY, and the master
+    forks replacement workers (and extra ones on TTIN) at any time. The
+    gunicorn master sets SERVER_SOFTWARE, which its workers inherit.
+    """
+    return WORKERS > 1 or os.environ.get('SERVER_SOFTWARE', '').startswith('gunicorn/')
+
+def create_app(start_refresher=start_market_refresher, request_threads=WORKER_THREADS):
+    """Application factory: initialize the database and start this process's services
+
+    Called once in every worker process (e.g. gunicorn "server:create_app()").
+    Schema creation and migrations run under a cross-process lock, and
+    only the elected leader polls market data and takes snapshots; the
+    other workers read the ticks it publishes. start_refresher starts the
+    leader's market data polling (server_async passes an asyncio one).
+    request_threads is the number of threads running request handlers
+    (server_async passes its DB worker pool size); logins waiting on the
+    KDF pool may hold at most half of them, unless KDF_MAX_PENDING is set.
+    """
+    global app_started, multiprocess
+    if app_started:
+        return app
+    multiprocess = serving_multiprocess()
+    if multiprocess and not SESSION_SECRET and os.getpid() == session_key_pid:
+        # The random key was generated in this worker, so tokens would only work on it
+        # (serve_production() imports this module in the master, so its workers share one)
+        raise RuntimeError("Set SESSION_SECRET to serve the app from several processes")
+    app_started = True
+
+    # Keep request threads for other routes during a login storm
+    kdf_pool.set_limit(KDF_MAX_PENDING or request_threads // 2)
+
+    # Ensure the database is initialized
+    init_lock = acquire_file_lock(INIT_LOCK_FILE)
+    try:
+        init_db()
+    finally:
+        init_lock.close()
+
+    # Load the in-memory valuation cache (if enabled)
+    load_valuations()
+
+    # Map the market snapshot shared by the workers (if several)
+    open_market_snapshot()
+
+    # Start the group-commit ledger writer (if enabled)
+    start_ledger_writer()
+
+    # Start the asynchronous order intake workers (if enabled)
+    start_order_intake()
+
+    # Market data refresh, replay and periodic snapshots run in one process only
+    elect_leader(start_refresher)
+
+    # Profile from the start in every worker (if configured)
+    if PROFILE_SAMPLE_RATE > 0:
+        profiler.start(PROFILE_SAMPLE_RATE)
+    return app
+
+def serve_production():
+    """Serve the app from WORKERS gunicorn processes with WORKER_THREADS threads each"""
+    from gunicorn.app.base import BaseApplication  # only needed in production mode
+
+    class ProductionServer(BaseApplication):
+        def load_config(self):
+            self.cfg.set('bind', SERVER_BIND)
+            self.cfg.set('workers', WORKERS)
+            self.cfg.set('worker_class', 'gthread')
+            self.cfg.set('threads', WORKER_THREADS)
+
+        def load(self):
+            # Runs in each worker after the fork (session_key is inherited from here)
+            return create_app()
+
+    logger.info(f"Serving on {SERVER_BIND} with {WORKERS} workers x {WORKER_THREADS} threads")
+    ProductionServer().run()
+
 
 # Main application initialization and startup
 if __name__ == "__main__":
-    # Ensure the database is initialized
-    init_db()
-    
-    # Update market data on startup
-    update_market_data()
-    
-    # Start the Flask application
-    app.run(
-        host="127.0.0.1", 
-        port=5000, 
-        debug=True
-    )
+    if PRODUCTION:
+        serve_production()
+    else:
+        # The debug reloader runs this file again in a child process that
+        # serves requests; only that one starts the background services
+        if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+            create_app()
+
+        # Start the Flask development server
+        app.run(
+            host="127.0.0.1", 
+            port=5000, 
+            debug=True
+        )
@@ -0,0 +1,245 @@
+import asyncio
+import io
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+from aiohttp import web
+
+import server
+from server import app, logger
+
+# Configuration
+# Threads running the synchronous route handlers (and so SQLite); this bounds
+# concurrent database work, not the number of open connections
+ASYNC_DB_WORKERS = int(os.environ.get('ASYNC_DB_WORKERS', 16))
+UPSTREAM_TIMEOUT = 10  # seconds per market data API call
+
+# Hop-by-hop and length headers are set by aiohttp itself
+SKIPPED_HEADERS = {'content-length', 'connection', 'keep-alive', 'transfer-encoding'}
+
+# Executor the handlers run on, and the event loop, set up by startup()
+db_executor = None
+loop = None
+
+# Long-polls of /orders/<id>?wait=: order id -> futures resolved when it completes
+order_waiters = {}
+
+
+# WSGI bridge: every route is served by the Flask app in server.py, so the
+# session, rate limit and validation logic is shared with the threaded server
+def _wsgi_environ(request, body, query_string=None):
+    """Build the WSGI environ of an aiohttp request"""
+    host, port = (request.transport.get_extra_info('sockname') or ('127.0.0.1', 0))[:2]
+    peer = request.transport.get_extra_info('peername')
+    environ = {
+        'REQUEST_METHOD': request.method,
+        'SCRIPT_NAME': '',
+        # WSGI paths are the URL-decoded bytes as latin-1
+        'PATH_INFO': request.path.encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': request.query_string if query_string is None else query_string,
+        'SERVER_NAME': str(host),
+        'SERVER_PORT': str(port),
+        'SERVER_PROTOCOL': f"HTTP/{request.version.major}.{request.version.minor}",
+        'REMOTE_ADDR': peer[0] if peer else '',
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': request.scheme,
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for name, value in request.headers.items():
+        key = name.upper().replace('-', '_')
+        if key == 'CONTENT_TYPE':
+            environ[key] = value
+        elif key != 'CONTENT_LENGTH':
+            key = 'HTTP_' + key
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+def _call_app(environ):
+    """Run the Flask app on a DB executor thread; returns (status, headers, body)
+
+    A body with a Content-Length is read in full here. A streamed one
+    (no length, e.g. /backtest/sweep) comes back as its iterator, which
+    _stream() then drains on a single thread.
+    """
+    started = []
+
+    def start_response(status, headers, exc_info=None):
+        started[:] = [status, headers]
+
+    body = app(environ, start_response)
+    status, headers = started
+    if any(name.lower() == 'content-length' for name, _ in headers):
+        try:
+            return status, headers, b''.join(body)
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+    return status, headers, body
+
+def _stream(body, chunks, cancelled):
+    """Iterate a streamed WSGI body, handing each chunk to the event loop
+
+    Runs on one thread from start to end, as Flask's stream_with_context
+    must be entered and left on the same thread.
+    """
+    try:
+        for chunk in body:
+            if cancelled.is_set():
+                break
+            if chunk:
+                loop.call_soon_threadsafe(chunks.put_nowait, chunk)
+    except Exception as e:
+        logger.error(f"Streamed response failed: {e}")
+    finally:
+        if hasattr(body, 'close'):
+            body.close()
+        loop.call_soon_threadsafe(chunks.put_nowait, None)
+
+async def dispatch(request, query_string=None):
+    """Serve a request with the Flask route handler, run on the DB executor"""
+    body = await request.read()
+    environ = _wsgi_environ(request, body, query_string)
+    status, headers, content = await loop.run_in_executor(db_executor, _call_app, environ)
+
+    code, _, reason = status.partition(' ')
+    headers = [(name, value) for name, value in headers if name.lower() not in SKIPPED_HEADERS]
+    if isinstance(content, bytes):
+        response = web.Response(status=int(code), reason=reason, body=content)
+        response.headers.extend(headers)
+        return response
+
+    response = web.StreamResponse(status=int(code), reason=reason)
+    response.headers.extend(headers)
+    chunks = asyncio.Queue()
+    cancelled = threading.Event()
+    # A dedicated thread: a long stream must not hold one of the DB workers
+    threading.Thread(target=_stream, args=(content, chunks, cancelled), name='response-stream', daemon=True).start()
+    try:
+        await response.prepare(request)
+        while (chunk := await chunks.get()) is not None:
+            await response.write(chunk)
+        await response.write_eof()
+    finally:
+        # Client gone mid-stream: stop the producer (it closes the generator)
+        cancelled.set()
+    return response
+
+
+# Native async routes
+async def get_order(request):
+    """GET /orders/<id>: the ?wait= long-poll waits on the event loop, not on a DB thread"""
+    wait = request.query.get('wait')
+    if server.order_intake is None or not wait:
+        return await dispatch(request)
+    try:
+        wait = min(float(wait), server.ORDER_MAX_WAIT)
+    except ValueError:
+        return await dispatch(request)  # the route handler answers 400
+
+    # Register before looking the order up, so a fill in between is not missed
+    order_id = request.match_info['order_id']
+    waiter = loop.create_future()
+    order_waiters.setdefault(order_id, []).append(waiter)
+    try:
+        # Authentication, ownership and the current status come from the route handler
+        response = await dispatch(request, query_string='')
+        if response.status == 200 and json.loads(response.body)['status'] == 'pending' and wait > 0:
+            try:
+                await asyncio.wait_for(waiter, wait)
+            except asyncio.TimeoutError:
+                pass
+            response = await dispatch(request, query_string='')
+        return response
+    finally:
+        waiters = order_waiters.get(order_id, [])
+        if waiter in waiters:
+            waiters.remove(waiter)
+            if not waiters:
+                del order_waiters[order_id]
+
+def _wake_order_waiters(order_ids):
+    for order_id in order_ids:
+        for waiter in order_waiters.pop(order_id, ()):
+            if not waiter.done():
+                waiter.set_result(None)
+
+def _orders_completed(order_ids):
+    """OrderIntake listener, called on an order worker thread"""
+    loop.call_soon_threadsafe(_wake_order_waiters, order_ids)
+
+
+# Market data
+def _store_tick(market_data, timestamp):
+    """Ingest a fetched tick (on the DB executor)"""
+    server.last_update_time = timestamp
+    server.ingest_market_data(market_data, timestamp)
+    server.record_market_data(market_data, timestamp)
+
+async def refresh_market_data():
+    """Poll the market data API with a non-blocking client every MARKET_REFRESH_INTERVAL"""
+    timeout = aiohttp.ClientTimeout(total=UPSTREAM_TIMEOUT)
+    async with aiohttp.ClientSession(timeout=timeout, headers={"accept": "application/json"}) as session:
+        while True:
+            current_time = time.time()
+            started = time.perf_counter()
+            market_data = None
+            try:
+                async with session.get(server.CRYPTO_API_URL, params={"vs_currency": "usd"}) as response:
+                    response.raise_for_status()
+                    market_data = await response.json()
+            except Exception as e:
+                logger.error(f"Error updating market data: {e}")
+            server.market_fetch_latency.observe(time.perf_counter() - started, 'ok' if market_data is not None else 'error')
+
+            if market_data is not None:
+                try:
+                    await loop.run_in_executor(db_executor, _store_tick, market_data, current_time)
+                except Exception as e:
+                    logger.error(f"Error updating market data: {e}")
+            await asyncio.sleep(server.MARKET_REFRESH_INTERVAL)
+
+def start_refresher():
+    """Start the leader's market data polling as a task on the event loop (callable from any thread)"""
+    if server.market_replay is None and server.market_refresher is None:
+        server.market_refresher = asyncio.run_coroutine_threadsafe(refresh_market_data(), loop)
+    return server.market_refresher
+
+
+async def startup(application):
+    global db_executor, loop
+    loop = asyncio.get_running_loop()
+    db_executor = ThreadPoolExecutor(ASYNC_DB_WORKERS, thread_name_prefix='db')
+    # Database initialization blocks, so it runs off the loop as well
+    await loop.run_in_executor(db_executor, server.create_app, start_refresher, ASYNC_DB_WORKERS)
+    if server.order_intake is not None:
+        server.order_intake.add_listener(_orders_completed)
+    logger.info(f"Async server ready ({ASYNC_DB_WORKERS} DB worker threads)")
+
+async def cleanup(application):
+    if server.market_refresher is not None and hasattr(server.market_refresher, 'cancel'):
+        server.market_refresher.cancel()
+    db_executor.shutdown(wait=False)
+
+def build_app():
+    """Create the aiohttp application serving every route of server.py"""
+    application = web.Application()
+    application.router.add_get('/orders/{order_id}', get_order)
+    application.router.add_route('*', '/{path:.*}', dispatch)
+    application.on_startup.append(startup)
+    application.on_cleanup.append(cleanup)
+    return application
+
+
+if __name__ == "__main__":
+    host, _, port = server.SERVER_BIND.rpartition(':')
+    web.run_app(build_app(), host=host, port=int(port), access_log=None)
@@ -0,0 +1,137 @@
+import heapq
+import itertools
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+
+from backtest import run_backtest
+
+# Metrics a sweep can rank by; higher is better for all of them
+# (max_drawdown is negative, so the shallowest drawdown ranks first)
+RANK_METRICS = ('sharpe_ratio', 'total_return', 'annualized_return', 'max_drawdown')
+
+# Parameter combinations sent to a worker per task
+CHUNK_SIZE = 8
+
+# Price history attached by each worker process, see _attach_worker()
+_worker_data = None
+
+
+def parameter_grid(grid):
+    """Expand {param: [values]} into a list of parameter dicts (Cartesian product)"""
+    if not isinstance(grid, dict) or not grid:
+        raise ValueError("grid must map parameter names to lists of values.")
+    names = sorted(grid)
+    values = [grid[name] if isinstance(grid[name], list) else [grid[name]] for name in names]
+    return [dict(zip(names, combination)) for combination in itertools.product(*values)]
+
+
+class SharedPrices:
+    """Timestamps and price matrix copied once into shared memory
+
+    Workers map the same pages instead of receiving a pickled copy of the
+    series with every task; only the small spec() tuple is sent, once per
+    worker. Use as a context manager so the segments are unlinked.
+    """
+
+    def __init__(self, timestamps, prices):
+        self.blocks = []
+        self.arrays = {}
+        for key, array in (('timestamps', timestamps), ('prices', prices)):
+            order = 'F' if array.flags.f_contiguous and not array.flags.c_contiguous else 'C'
+            block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            view = np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf, order=order)
+            view[...] = array
+            self.blocks.append(block)
+            self.arrays[key] = (block.name, array.shape, array.dtype.str, order)
+
+    def spec(self):
+        return self.arrays
+
+    def close(self):
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+        self.blocks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _attach_worker(spec, asset_names):
+    """Pool initializer: map the shared price arrays into this worker"""
+    global _worker_data
+    blocks = []
+    arrays = {}
+    for key, (name, shape, dtype, order) in spec.items():
+        block = shared_memory.SharedMemory(name=name)
+        blocks.append(block)  # keep the mapping alive for the worker's lifetime
+        arrays[key] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf, order=order)
+        arrays[key].flags.writeable = False
+    _worker_data = (blocks, arrays, asset_names)
+
+def _evaluate_chunk(strategy, combinations, fee, slippage):
+    """Backtest each parameter combination on the shared prices (runs in a worker)"""
+    _, arrays, asset_names = _worker_data
+    results = []
+    for params in combinations:
+        try:
+            summary, _ = run_backtest(arrays['timestamps'], arrays['prices'], asset_names,
+                                      strategy, params, fee, slippage)
+            summary.pop('assets', None)
+            results.append(summary)
+        except ValueError as e:
+            # Invalid combination (e.g. fast >= slow): report it, keep sweeping
+            results.append({"params": params, "error": str(e)})
+    return results
+
+
+def run_sweep(timestamps, prices, asset_names, strategy, grid, fee=0.001, slippage=0.0005,
+              workers=1, metric='sharpe_ratio', top=10):
+    """Backtest every combination in grid across a process pool
+
+    A generator: yields ('result', summary, ranking) as each combination
+    finishes, in completion order, where ranking is the current top
+    results by metric; then ('done', None, final ranking). Results whose
+    metric is undefined (None) are streamed but not ranked.
+    """
+    if metric not in RANK_METRICS:
+        raise ValueError(f"metric must be one of {', '.join(RANK_METRICS)}.")
+    combinations = parameter_grid(grid)
+    workers = max(1, min(int(workers), len(combinations)))
+    top = max(1, int(top))
+
+    # Running top-N as a min-heap of (metric, sequence, summary)
+    best = []
+    sequence = itertools.count()
+
+    def ranking():
+        return [summary for _, _, summary in sorted(best, key=lambda entry: (-entry[0], entry[1]))]
+
+    with SharedPrices(timestamps, prices) as shared, ProcessPoolExecutor(
+            max_workers=workers, initializer=_attach_worker,
+            initargs=(shared.spec(), list(asset_names))) as executor:
+        futures = [
+            executor.submit(_evaluate_chunk, strategy, combinations[start:start + CHUNK_SIZE], fee, slippage)
+            for start in range(0, len(combinations), CHUNK_SIZE)
+        ]
+        try:
+            for future in as_completed(futures):
+                for summary in future.result():
+                    # Undefined metrics (None, e.g. a NaN Sharpe ratio) cannot be ranked
+                    if 'error' not in summary and summary[metric] is not None:
+                        entry = (summary[metric], next(sequence), summary)
+                        if len(best) < top:
+                            heapq.heappush(best, entry)
+                        elif entry[0] > best[0][0]:
+                            heapq.heapreplace(best, entry)
+                    yield 'result', summary, ranking()
+        finally:
+            # Stop queued chunks if the consumer goes away mid-sweep
+            for future in futures:
+                future.cancel()
+
+    yield 'done', None, ranking()
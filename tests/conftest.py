@@ -0,0 +1,51 @@
+import os
+import sqlite3
+import sys
+import time
+
+import pytest
+
+# Importing server configures logging: keep it on the console, out of the checkout
+os.environ.setdefault('LOG_FILE', '')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server  # noqa: E402
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    """A freshly initialized database that the server module uses"""
+    path = str(tmp_path / 'database.db')
+    monkeypatch.setattr(server, 'DATABASE_PATH', path)
+    server.init_db()
+    return path
+
+
+@pytest.fixture
+def client(database, monkeypatch):
+    """Test client without rate limits, trading at the prices stored in assets"""
+    monkeypatch.setattr(server, 'RATE_LIMITING', False)
+    monkeypatch.setattr(server, 'last_update_time', time.time() + 1e9)
+    return server.app.test_client()
+
+
+@pytest.fixture
+def add_asset(database):
+    """Insert an asset at a price: add_asset(name, price)"""
+    def add(name, price):
+        with sqlite3.connect(database) as conn:
+            conn.execute(
+                "INSERT INTO assets (name, symbol, current_price, market_cap) VALUES (?, ?, ?, 1)",
+                (name, name.lower(), price)
+            )
+    return add
+
+
+@pytest.fixture
+def login(client):
+    """Create an account and log in: login(username) returns its auth headers"""
+    def log_in(username):
+        client.post('/create_account', json={'username': username, 'password': 'pw', 'email': f"{username}@example.com"})
+        token = client.post('/login', json={'username': username, 'password': 'pw'}).json['token']
+        return {'Authorization': f"Bearer {token}"}
+    return log_in
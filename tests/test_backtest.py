@@ -0,0 +1,59 @@
+import os
+import sqlite3
+import threading
+
+import numpy as np
+
+import backtest
+
+THREADS = 8
+ROUNDS = 20
+BARS = 500
+
+
+def test_concurrent_loads_share_the_cache(database, tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    with sqlite3.connect(database) as conn:
+        conn.executemany(
+            "INSERT INTO historical_prices (asset_name, price, timestamp) VALUES ('Bitcoin', ?, datetime(?, 'unixepoch'))",
+            [(100.0 + bar, 1_700_000_000 + 60 * bar) for bar in range(BARS)]
+        )
+
+    errors = []
+    barrier = threading.Barrier(THREADS + 1)
+
+    def load():
+        with sqlite3.connect(database) as conn:
+            cursor = conn.cursor()
+            barrier.wait()
+            for _ in range(ROUNDS):
+                try:
+                    timestamps, prices = backtest.load_series(cursor, 'Bitcoin', cache_dir)
+                    # Every load sees a consistent prefix of the growing history
+                    assert len(timestamps) == len(prices) >= BARS
+                    assert np.array_equal(prices, 100.0 + np.arange(len(prices)))
+                except Exception as e:
+                    errors.append(e)
+
+    def tick():
+        # New bars keep arriving, so the threads miss the cache and rewrite it
+        with sqlite3.connect(database) as conn:
+            barrier.wait()
+            for bar in range(BARS, BARS + ROUNDS):
+                conn.execute(
+                    "INSERT INTO historical_prices (asset_name, price, timestamp) VALUES ('Bitcoin', ?, datetime(?, 'unixepoch'))",
+                    (100.0 + bar, 1_700_000_000 + 60 * bar)
+                )
+                conn.commit()
+
+    threads = [threading.Thread(target=load) for _ in range(THREADS)] + [threading.Thread(target=tick)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert os.listdir(cache_dir) == ['Bitcoin.npz']
+    with sqlite3.connect(database) as conn:
+        timestamps, prices = backtest.load_series(conn.cursor(), 'Bitcoin', cache_dir)
+    assert len(prices) == BARS + ROUNDS
@@ -0,0 +1,99 @@
+import sqlite3
+
+import pytest
+
+import server
+
+# Three lots: 2 @ $10, 3 @ $20, 5 @ $30 (average cost $23)
+LOTS = [(2, 10.0), (3, 20.0), (5, 30.0)]
+SALE_PRICE = 25.0
+
+
+@pytest.fixture
+def trader(database, client, add_asset, login):
+    """alice's auth headers, after buying LOTS of Bitcoin"""
+    add_asset('Bitcoin', LOTS[0][1])
+    headers = login('alice')
+    for quantity, price in LOTS:
+        set_price(database, price)
+        assert buy_or_sell(client, headers, '/trade/buy', quantity).status_code == 200
+    set_price(database, SALE_PRICE)
+    return headers
+
+
+def set_price(database, price):
+    with sqlite3.connect(database) as conn:
+        conn.execute("UPDATE assets SET current_price = ? WHERE name = 'Bitcoin'", (price,))
+
+def buy_or_sell(client, headers, endpoint, quantity):
+    return client.post(endpoint, json={'username': 'alice', 'asset_name': 'Bitcoin', 'quantity': quantity}, headers=headers)
+
+def open_lots(database):
+    with sqlite3.connect(database) as conn:
+        return conn.execute("SELECT quantity, price FROM position_lots WHERE username = 'alice' ORDER BY id").fetchall()
+
+def pnl(client, headers):
+    return client.post('/portfolio/pnl', json={'username': 'alice'}, headers=headers).json
+
+
+def test_fifo_partial_sell_consumes_the_oldest_lots(database, client, trader, monkeypatch):
+    monkeypatch.setattr(server, 'COST_BASIS_METHOD', 'fifo')
+    # 4 units: all of the $10 lot and 2 of the $20 lot, costing $60
+    sold = buy_or_sell(client, trader, '/trade/sell', 4)
+    assert sold.status_code == 200
+    assert sold.json['total_revenue'] == 100.0
+    assert sold.json['profit_loss'] == 40.0
+
+    assert open_lots(database) == [(server.to_micros(1), server.to_price(20)), (server.to_micros(5), server.to_price(30))]
+    report = pnl(client, trader)
+    assert report['cost_basis_method'] == 'fifo'
+    assert report['positions'] == [{
+        'asset': 'Bitcoin', 'quantity': 6.0, 'cost_basis': 170.0, 'market_value': 150.0,
+        'unrealized_pnl': -20.0, 'realized_pnl': 40.0,
+    }]
+
+
+def test_fifo_sell_ending_on_a_lot_boundary(database, client, trader, monkeypatch):
+    monkeypatch.setattr(server, 'COST_BASIS_METHOD', 'fifo')
+    # Exactly the first two lots: 2 @ $10 + 3 @ $20
+    sold = buy_or_sell(client, trader, '/trade/sell', 5)
+    assert sold.json['profit_loss'] == 125.0 - 80.0
+    assert open_lots(database) == [(server.to_micros(5), server.to_price(30))]
+
+
+@pytest.mark.parametrize('method', ['fifo', 'average'])
+def test_selling_the_whole_position_closes_every_lot(database, client, trader, monkeypatch, method):
+    monkeypatch.setattr(server, 'COST_BASIS_METHOD', method)
+    assert buy_or_sell(client, trader, '/trade/sell', 4).status_code == 200
+    assert buy_or_sell(client, trader, '/trade/sell', 6).status_code == 200
+
+    assert open_lots(database) == []
+    with sqlite3.connect(database) as conn:
+        assert conn.execute("SELECT COUNT(*) FROM portfolios WHERE username = 'alice'").fetchone() == (0,)
+    # Whatever the method, a closed position has realized revenue minus everything paid
+    report = pnl(client, trader)
+    assert report['positions'] == [{
+        'asset': 'Bitcoin', 'quantity': 0.0, 'cost_basis': 0.0, 'market_value': 0.0,
+        'unrealized_pnl': 0.0, 'realized_pnl': 250.0 - 230.0,
+    }]
+    assert report['total_pnl'] == 20.0
+
+
+def test_average_cost_sells_at_the_weighted_average(database, client, trader, monkeypatch):
+    monkeypatch.setattr(server, 'COST_BASIS_METHOD', 'average')
+    with sqlite3.connect(database) as conn:
+        assert conn.execute("SELECT avg_purchase_price FROM portfolios WHERE username = 'alice'").fetchone() == (server.to_price(23),)
+
+    # 4 units at the $23 average, whichever lots they came from
+    sold = buy_or_sell(client, trader, '/trade/sell', 4)
+    assert sold.json['profit_loss'] == 100.0 - 92.0
+    assert sold.json['profit_loss_percentage'] == pytest.approx(8 / 92 * 100)
+
+    report = pnl(client, trader)
+    assert report['cost_basis_method'] == 'average'
+    assert report['positions'] == [{
+        'asset': 'Bitcoin', 'quantity': 6.0, 'cost_basis': 138.0, 'market_value': 150.0,
+        'unrealized_pnl': 12.0, 'realized_pnl': 8.0,
+    }]
+    # The lots still track FIFO cost, should the method be switched later
+    assert open_lots(database) == [(server.to_micros(1), server.to_price(20)), (server.to_micros(5), server.to_price(30))]
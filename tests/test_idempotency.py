@@ -0,0 +1,118 @@
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import pytest
+
+import server
+
+
+@pytest.fixture(autouse=True)
+def idempotency_cache(monkeypatch):
+    """An empty in-memory LRU, so tests do not replay each other's keys"""
+    monkeypatch.setattr(server, 'idempotency_cache', OrderedDict())
+
+
+def deposit(client, headers, username, key, amount=10):
+    return client.post('/deposit', json={'username': username, 'amount': amount},
+                       headers={**headers, 'Idempotency-Key': key})
+
+def balance(database, username):
+    with sqlite3.connect(database) as conn:
+        return conn.execute("SELECT balance FROM accounts WHERE username = ?", (username,)).fetchone()[0]
+
+
+def test_duplicate_replays_the_stored_response(database, client, login):
+    headers = login('alice')
+    first = deposit(client, headers, 'alice', 'key-1')
+    second = deposit(client, headers, 'alice', 'key-1')
+
+    assert first.status_code == second.status_code == 200
+    assert second.get_data() == first.get_data()
+    assert second.headers['Idempotent-Replayed'] == 'true'
+    assert balance(database, 'alice') == server.to_micros(1010)
+
+    # Another endpoint may not reuse the key
+    withdrawal = client.post('/withdraw', json={'username': 'alice', 'amount': 10},
+                             headers={**headers, 'Idempotency-Key': 'key-1'})
+    assert withdrawal.status_code == 422
+
+
+def test_concurrent_duplicate_gets_409(database, client, login, monkeypatch):
+    headers = login('alice')
+    started, release = threading.Event(), threading.Event()
+    to_micros = server.to_micros
+
+    def slow_to_micros(value):
+        # Holds the first request inside the handler while the duplicate arrives
+        if not started.is_set():
+            started.set()
+            release.wait(10)
+        return to_micros(value)
+    monkeypatch.setattr(server, 'to_micros', slow_to_micros)
+
+    first = []
+    thread = threading.Thread(target=lambda: first.append(deposit(server.app.test_client(), headers, 'alice', 'key-1')))
+    thread.start()
+    assert started.wait(10)
+    duplicate = deposit(client, headers, 'alice', 'key-1')
+    release.set()
+    thread.join()
+
+    assert duplicate.status_code == 409
+    assert first[0].status_code == 200
+    assert balance(database, 'alice') == to_micros(1010)
+    assert deposit(client, headers, 'alice', 'key-1').headers['Idempotent-Replayed'] == 'true'
+
+
+def test_keys_are_scoped_to_their_user(database, client, login):
+    alice, bob = login('alice'), login('bob')
+    assert deposit(client, alice, 'alice', 'shared', amount=10).status_code == 200
+    bobs = deposit(client, bob, 'bob', 'shared', amount=20)
+
+    assert bobs.status_code == 200 and 'Idempotent-Replayed' not in bobs.headers
+    assert balance(database, 'alice') == server.to_micros(1010)
+    assert balance(database, 'bob') == server.to_micros(1020)
+
+
+def fail(*args, **kwargs):
+    raise RuntimeError("boom")
+
+@pytest.mark.parametrize('raises', [False, True], ids=['500', 'exception'])
+def test_failed_request_releases_the_key(database, client, login, monkeypatch, raises):
+    headers = login('alice')
+    to_micros, jsonify = server.to_micros, server.jsonify
+    monkeypatch.setattr(server, 'to_micros', fail)
+    if raises:
+        # The handler's own error response fails too, so the exception escapes it
+        monkeypatch.setattr(server, 'jsonify', fail)
+    try:
+        assert deposit(client, headers, 'alice', 'key-1').status_code == 500
+    except RuntimeError:
+        assert raises
+    monkeypatch.setattr(server, 'jsonify', jsonify)
+
+    with sqlite3.connect(database) as conn:
+        assert conn.execute("SELECT COUNT(*) FROM idempotency_keys").fetchone() == (0,)
+
+    # The retry runs the handler instead of getting 409
+    monkeypatch.setattr(server, 'to_micros', to_micros)
+    retry = deposit(client, headers, 'alice', 'key-1')
+    assert retry.status_code == 200 and 'Idempotent-Replayed' not in retry.headers
+    assert balance(database, 'alice') == to_micros(1010)
+
+
+def test_abandoned_claim_expires_after_the_lease(database, client, login):
+    headers = login('alice')
+    # Claims left behind by a process that died mid-request
+    now = int(time.time())
+    with sqlite3.connect(database) as conn:
+        conn.executemany(
+            "INSERT INTO idempotency_keys (username, key, endpoint, status_code, created_at) VALUES ('alice', ?, '/deposit', 0, ?)",
+            [('stale', now - server.IDEMPOTENCY_LEASE - 1), ('live', now)]
+        )
+
+    assert deposit(client, headers, 'alice', 'live').status_code == 409
+    assert deposit(client, headers, 'alice', 'stale').status_code == 200
+    assert balance(database, 'alice') == server.to_micros(1010)
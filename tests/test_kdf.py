@@ -0,0 +1,58 @@
+import threading
+import time
+from contextlib import contextmanager
+
+import pytest
+
+import server
+
+TIMEOUT = 10
+
+
+@contextmanager
+def saturated(monkeypatch):
+    """Swap in a two-thread KDF pool holding two jobs that run until the block exits"""
+    pool = server.KdfPool(workers=2, max_pending=2)
+    monkeypatch.setattr(server, 'kdf_pool', pool)
+    release = threading.Event()
+    started = [threading.Event(), threading.Event()]
+
+    def job(started):
+        started.set()
+        release.wait(TIMEOUT)
+        return True
+
+    threads = [threading.Thread(target=pool.run, args=(job, event)) for event in started]
+    for thread in threads:
+        thread.start()
+    for event in started:
+        assert event.wait(TIMEOUT)
+    try:
+        yield pool
+    finally:
+        release.set()
+        for thread in threads:
+            thread.join()
+
+
+def test_full_pool_rejects_without_waiting(monkeypatch):
+    with saturated(monkeypatch) as pool:
+        started = time.perf_counter()
+        with pytest.raises(server.KdfOverloaded):
+            pool.run(lambda: True)
+        assert time.perf_counter() - started < 1
+    assert pool.stats()["rejected"] == 1
+    assert pool.run(lambda: True)
+
+
+def test_login_gets_503_while_the_pool_is_full(client, login, monkeypatch):
+    login('alice')
+    with saturated(monkeypatch):
+        started = time.perf_counter()
+        response = client.post('/login', json={'username': 'alice', 'password': 'pw'})
+        assert time.perf_counter() - started < 1
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '1'
+
+    # Once the storm passes, logins go through again
+    assert client.post('/login', json={'username': 'alice', 'password': 'pw'}).status_code == 200
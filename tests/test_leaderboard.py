@@ -0,0 +1,78 @@
+import numpy as np
+import pytest
+
+from leaderboard import Leaderboard
+
+ACCOUNTS = 100
+
+
+@pytest.fixture
+def board():
+    board = Leaderboard()
+    board.rebuild([f"u{i}" for i in range(ACCOUNTS)], np.arange(ACCOUNTS, dtype=np.float64))
+    return board
+
+
+def tick(moved):
+    """Net worths after a price tick that moved the first `moved` accounts"""
+    net_worths = np.arange(ACCOUNTS, dtype=np.float64)
+    net_worths[:moved] += 0.5
+    return net_worths
+
+
+@pytest.mark.parametrize('moved', [2, ACCOUNTS], ids=['sync', 'rebuild'])
+def test_update_after_net_worths_keeps_its_score(board, moved):
+    usernames = [f"u{i}" for i in range(ACCOUNTS)]
+    sequence = board.sequence
+    net_worths = tick(moved)
+    # A trade lands between computing the net worths and syncing them
+    board.update('u1', 1000.0)
+    board.sync(usernames, net_worths, sequence)
+
+    assert board.rank('u1') == (1, 1000.0)
+    assert board.rank('u0') == (ACCOUNTS, 0.5)
+
+    # The next tick, computed after the trade, brings it in line
+    net_worths = tick(moved)
+    net_worths[1] = 1000.25
+    board.sync(usernames, net_worths, board.sequence)
+    assert board.rank('u1') == (1, 1000.25)
+    assert board.dirty == {}
+
+
+def test_update_during_sync_keeps_its_score(board):
+    usernames = [f"u{i}" for i in range(ACCOUNTS)]
+    board.update('u5', 500.0)
+    sequence = board.sequence
+    net_worths = tick(0)
+    net_worths[5] = 500.0
+    net_worths[7] = 7.25
+
+    # update() runs on another thread between two of the sync's moves
+    move = board._move
+    def interleaved(username, net_worth):
+        if username == 'u5':
+            board.lock.release()
+            board.update('u7', 700.0)
+            board.lock.acquire()
+        return move(username, net_worth)
+    board._move = interleaved
+    board.sync(usernames, net_worths, sequence)
+    board._move = move
+
+    assert board.rank('u7') == (1, 700.0)
+    assert board.rank('u5') == (2, 500.0)
+    assert set(board.dirty) == {'u7'}
+
+
+def test_sync_applies_older_updates(board):
+    usernames = [f"u{i}" for i in range(ACCOUNTS)]
+    board.update('u3', 300.0)
+    sequence = board.sequence
+    # The net worths include the trade, repriced by the tick
+    net_worths = tick(0)
+    net_worths[3] = 310.0
+    board.sync(usernames, net_worths, sequence)
+
+    assert board.rank('u3') == (1, 310.0)
+    assert board.dirty == {}
@@ -0,0 +1,58 @@
+import random
+import sqlite3
+
+import server
+
+USERS = ['alice', 'bob', 'carol']
+ASSETS = {'Bitcoin': 123.456789, 'Doge': 0.0000098}
+ROUNDS = 120
+
+
+def genesis_replay(cursor, username, seq):
+    """An account's (balance, positions) replayed from its first event, ignoring snapshots"""
+    cursor.execute("""
+        SELECT username, asset_name, quantity, price, amount FROM ledger_events
+        WHERE username = ? AND seq <= ? ORDER BY seq
+    """, (username, seq))
+    return server.replay_events({username: [0, {}]}, cursor)[username]
+
+
+def test_snapshot_replay_matches_genesis_replay(database, client, add_asset, login):
+    for name, price in ASSETS.items():
+        add_asset(name, price)
+    headers = {username: login(username) for username in USERS}
+
+    rng = random.Random(7)
+    checkpoints = []
+    for round_number in range(ROUNDS):
+        username = rng.choice(USERS)
+        body = {'username': username, 'asset_name': rng.choice(list(ASSETS)),
+                'quantity': round(rng.uniform(0.1, 5), 6), 'amount': round(rng.uniform(1, 50), 2)}
+        endpoint = rng.choice(['/deposit', '/withdraw', '/trade/buy', '/trade/buy', '/trade/sell', '/portfolio/remove_asset'])
+        client.post(endpoint, json=body, headers=headers[username])
+        # Snapshot runs land between arbitrary events
+        if round_number % 17 == 0:
+            server.take_account_snapshots()
+        if round_number % 10 == 0:
+            with sqlite3.connect(database) as conn:
+                checkpoints.append(conn.execute("SELECT MAX(seq) FROM ledger_events").fetchone()[0])
+    server.take_account_snapshots()
+
+    with sqlite3.connect(database) as conn:
+        cursor = conn.cursor()
+        assert cursor.execute("SELECT COUNT(DISTINCT seq) FROM account_snapshots").fetchone()[0] > 1
+        cursor.execute("SELECT MAX(seq) FROM ledger_events")
+        checkpoints.append(cursor.fetchone()[0])
+
+        for username in USERS:
+            for seq in checkpoints:
+                _, balance, positions = server.rebuild_account(cursor, username, seq)
+                assert [balance, positions] == genesis_replay(cursor, username, seq)
+
+            # And the latest state is the live one
+            cursor.execute("SELECT balance FROM accounts WHERE username = ?", (username,))
+            live_balance = cursor.fetchone()[0]
+            cursor.execute("SELECT asset_name, quantity, avg_purchase_price FROM portfolios WHERE username = ?", (username,))
+            live_positions = {asset_name: [quantity, avg_price] for asset_name, quantity, avg_price in cursor.fetchall()}
+            _, balance, positions = server.rebuild_account(cursor, username)
+            assert (balance, positions) == (live_balance, live_positions)
@@ -0,0 +1,80 @@
+import os
+import sqlite3
+import subprocess
+import sys
+
+import pytest
+
+import server
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BATCH_SIZE = 10
+COMMITTED_BATCHES = 5
+CRASHED = 17
+
+# Runs a LedgerWriter and kills the whole process with os._exit inside the
+# writer thread while it writes batch number COMMITTED_BATCHES: either halfway
+# through the INSERTs or with every row inserted but not yet committed
+CRASHING_WRITER = """
+import os, sys
+import server
+
+path, stage, crash_batch, batch_size, crashed = sys.argv[1], sys.argv[2], *map(int, sys.argv[3:])
+committed = 0
+
+class CrashingConnection:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def executemany(self, sql, rows):
+        if committed == crash_batch and stage == 'insert':
+            self.conn.executemany(sql, rows[:len(rows) // 2])
+            os._exit(crashed)
+        return self.conn.executemany(sql, rows)
+
+    def commit(self):
+        global committed
+        if committed == crash_batch:
+            os._exit(crashed)
+        self.conn.commit()
+        committed += 1
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+connect_db = server.connect_db
+server.connect_db = lambda *args, **kwargs: CrashingConnection(connect_db(*args, **kwargs))
+
+# Each batch is submitted whole and flushed before the next, so it is one commit
+writer = server.LedgerWriter(path, flush_interval=1.0, batch_size=batch_size).start()
+for batch in range(crash_batch + 1):
+    for row in range(batch_size):
+        writer.submit((f"user{row}", 'deposit', 1, f"batch{batch}", '2026-01-01 00:00:00'))
+    writer.flush()
+"""
+
+
+@pytest.mark.parametrize('stage', ['insert', 'commit'])
+def test_crash_mid_batch_keeps_committed_batches_only(database, tmp_path, stage):
+    env = dict(os.environ, PYTHONPATH=REPO_DIR, LOG_FILE='')
+    result = subprocess.run(
+        [sys.executable, '-c', CRASHING_WRITER, database, stage, str(COMMITTED_BATCHES), str(BATCH_SIZE), str(CRASHED)],
+        cwd=tmp_path, env=env, capture_output=True, timeout=60,
+    )
+    assert result.returncode == CRASHED, result.stderr.decode()
+
+    # Opening the database rolls back the crashed transaction
+    with sqlite3.connect(database) as conn:
+        assert conn.execute("PRAGMA integrity_check").fetchone() == ('ok',)
+        rows = dict(conn.execute("SELECT asset_name, COUNT(*) FROM transactions GROUP BY asset_name").fetchall())
+    assert rows == {f"batch{batch}": BATCH_SIZE for batch in range(COMMITTED_BATCHES)}
+
+
+def test_stop_commits_queued_rows(database):
+    writer = server.LedgerWriter(database, flush_interval=0.05, batch_size=BATCH_SIZE).start()
+    for row in range(3 * BATCH_SIZE + 1):
+        writer.submit((f"user{row}", 'deposit', 1, None, '2026-01-01 00:00:00'))
+    writer.stop()
+
+    with sqlite3.connect(database) as conn:
+        assert conn.execute("SELECT COUNT(*) FROM transactions").fetchone() == (3 * BATCH_SIZE + 1,)
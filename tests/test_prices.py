@@ -0,0 +1,99 @@
+import json
+import sqlite3
+
+import pytest
+
+import server
+
+
+def test_low_priced_asset_is_charged_its_exact_price(database, client, add_asset, login):
+    add_asset('Shib', 0.0000098)
+    headers = login('alice')
+
+    bought = client.post('/trade/buy', json={'asset_name': 'Shib', 'quantity': 1000}, headers=headers)
+    assert bought.status_code == 200
+    with sqlite3.connect(database) as conn:
+        balance = conn.execute("SELECT balance FROM accounts WHERE username = 'alice'").fetchone()[0]
+        avg_price = conn.execute("SELECT avg_purchase_price FROM portfolios WHERE username = 'alice'").fetchone()[0]
+        lot_price = conn.execute("SELECT price FROM position_lots WHERE username = 'alice'").fetchone()[0]
+    # $0.0098, not the $0.01 a micro-dollar price of $0.00001 would charge
+    assert balance == server.to_micros(1000) - 9800
+    assert avg_price == lot_price == 9_800_000
+
+    sold = client.post('/trade/sell', json={'asset_name': 'Shib', 'quantity': 500}, headers=headers)
+    assert sold.status_code == 200
+    assert '$0.0000098 each' in sold.json['message']
+    assert sold.json['total_revenue'] == 0.0049
+    assert sold.json['profit_loss'] == 0
+
+
+def test_sub_micro_price_is_not_free(database, client, add_asset, login):
+    add_asset('Dust', 0.0000002)
+    headers = login('alice')
+
+    assert client.post('/trade/buy', json={'asset_name': 'Dust', 'quantity': 1000}, headers=headers).status_code == 200
+    with sqlite3.connect(database) as conn:
+        balance = conn.execute("SELECT balance FROM accounts WHERE username = 'alice'").fetchone()[0]
+    assert balance == server.to_micros(1000) - 200
+
+
+def test_notional_rounds_only_the_cash_amount():
+    assert server.to_price(0.0000098) == 9_800_000
+    assert server.notional(server.to_price(0.0000098), server.to_micros(1)) == 10
+    assert server.notional(server.to_price('12.345678'), server.to_micros('0.5')) == 6_172_839
+    assert server.format_price(server.to_price(0.0000098)) == '0.0000098'
+    assert server.format_price(server.to_price(123.456)) == '123.46'
+
+
+@pytest.mark.parametrize('price', [-1, float('nan'), float('inf'), 'abc', 10 ** 7])
+def test_to_price_rejects_invalid_prices(price):
+    with pytest.raises(ValueError):
+        server.to_price(price)
+
+
+def test_migration_rescales_micro_prices(database):
+    # A version 4 database: prices at the cash scale of 10**6 per dollar
+    with sqlite3.connect(database) as conn:
+        conn.execute("PRAGMA user_version = 4")
+        conn.execute("INSERT INTO portfolios VALUES ('alice', 'Bitcoin', 2000000, 9800000)")
+        conn.execute("INSERT INTO position_lots (username, asset_name, quantity, price) VALUES ('alice', 'Bitcoin', 2000000, 9800000)")
+        conn.execute("""
+            INSERT INTO ledger_events (username, event_type, asset_name, quantity, price, amount, created_at)
+            VALUES ('alice', 'buy', 'Bitcoin', 2000000, 9800000, -19600000, 0)
+        """)
+        conn.execute("INSERT INTO account_snapshots VALUES ('alice', 0, 5000000, ?, 0)",
+                     (json.dumps({'Bitcoin': [2000000, 9800000]}),))
+
+    server.init_db()
+
+    with sqlite3.connect(database) as conn:
+        assert conn.execute("PRAGMA user_version").fetchone() == (server.SCHEMA_VERSION,)
+        assert conn.execute("SELECT quantity, avg_purchase_price FROM portfolios").fetchone() == (2000000, 9_800_000_000_000)
+        assert conn.execute("SELECT quantity, price FROM position_lots").fetchone() == (2000000, 9_800_000_000_000)
+        assert conn.execute("SELECT quantity, price, amount FROM ledger_events").fetchone() == (2000000, 9_800_000_000_000, -19600000)
+        positions = conn.execute("SELECT positions FROM account_snapshots").fetchone()[0]
+    assert json.loads(positions) == {'Bitcoin': [2000000, 9_800_000_000_000]}
+
+
+def test_migration_from_real_columns(tmp_path, monkeypatch):
+    path = str(tmp_path / 'legacy.db')
+    with sqlite3.connect(path) as conn:
+        conn.execute("""
+            CREATE TABLE accounts (username TEXT PRIMARY KEY, password TEXT NOT NULL, email TEXT UNIQUE,
+                                   balance REAL NOT NULL DEFAULT 1000.0, created_at DATETIME DEFAULT CURRENT_TIMESTAMP)""")
+        conn.execute("""
+            CREATE TABLE portfolios (username TEXT NOT NULL, asset_name TEXT NOT NULL, quantity REAL NOT NULL DEFAULT 0,
+                                     avg_purchase_price REAL NOT NULL DEFAULT 0, PRIMARY KEY (username, asset_name))""")
+        conn.execute("INSERT INTO accounts (username, password, balance) VALUES ('alice', 'x', 500.5)")
+        conn.execute("INSERT INTO portfolios VALUES ('alice', 'Bitcoin', 2.5, 100.1)")
+    monkeypatch.setattr(server, 'DATABASE_PATH', path)
+
+    server.init_db()
+
+    with sqlite3.connect(path) as conn:
+        assert conn.execute("SELECT balance FROM accounts").fetchone() == (500_500_000,)
+        assert conn.execute("SELECT quantity, avg_purchase_price FROM portfolios").fetchone() == (2_500_000, 100_100_000_000_000)
+        assert conn.execute("SELECT quantity, price FROM position_lots").fetchone() == (2_500_000, 100_100_000_000_000)
+        assert conn.execute("SELECT fifo_cost_basis FROM position_pnl").fetchone() == (250_250_000,)
+        positions = conn.execute("SELECT positions FROM account_snapshots").fetchone()[0]
+    assert json.loads(positions) == {'Bitcoin': [2_500_000, 100_100_000_000_000]}
@@ -0,0 +1,88 @@
+import sqlite3
+import threading
+
+import server
+
+THREADS = 8
+ROUNDS = 25
+PRICE = 10.0
+BOUGHT = 10.0  # units bought up front, costing 100 of the 1000 starting balance
+WITHDRAWAL = 7.0
+SALE = 0.1
+
+
+def test_concurrent_withdrawals_and_sales_never_overdraw(database, client, add_asset, login):
+    add_asset('Bitcoin', PRICE)
+    headers = login('alice')
+    assert client.post('/trade/buy', json={'asset_name': 'Bitcoin', 'quantity': BOUGHT}, headers=headers).status_code == 200
+
+    lowest = {'balance': None, 'quantity': None}
+    done = threading.Event()
+
+    def watch():
+        # Samples the committed state the whole time the workers run
+        with sqlite3.connect(database) as conn:
+            while not done.is_set():
+                balance = conn.execute("SELECT balance FROM accounts WHERE username = 'alice'").fetchone()[0]
+                row = conn.execute("SELECT quantity FROM portfolios WHERE username = 'alice'").fetchone()
+                quantity = row[0] if row else 0
+                lowest['balance'] = balance if lowest['balance'] is None else min(lowest['balance'], balance)
+                lowest['quantity'] = quantity if lowest['quantity'] is None else min(lowest['quantity'], quantity)
+
+    results = []
+    lock = threading.Lock()
+
+    def work():
+        worker = server.app.test_client()
+        for _ in range(ROUNDS):
+            withdrawal = worker.post('/withdraw', json={'amount': WITHDRAWAL}, headers=headers)
+            sale = worker.post('/trade/sell', json={'asset_name': 'Bitcoin', 'quantity': SALE}, headers=headers)
+            with lock:
+                results.append(('withdraw', withdrawal.status_code, None))
+                results.append(('sell', sale.status_code, sale.json.get('total_revenue')))
+
+    watcher = threading.Thread(target=watch)
+    watcher.start()
+    workers = [threading.Thread(target=work) for _ in range(THREADS)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    done.set()
+    watcher.join()
+
+    withdrawals = [status for side, status, _ in results if side == 'withdraw']
+    sales = [(status, revenue) for side, status, revenue in results if side == 'sell']
+    assert set(withdrawals) <= {200, 400} and set(status for status, _ in sales) <= {200, 400, 404}
+    # Both run out: withdrawals ask for more than the balance, sales for more than is held
+    assert 400 in withdrawals and {400, 404} & {status for status, _ in sales}
+
+    withdrawn = server.to_micros(WITHDRAWAL) * withdrawals.count(200)
+    revenue = sum(server.to_micros(amount) for status, amount in sales if status == 200)
+    sold = server.to_micros(SALE) * sum(1 for status, _ in sales if status == 200)
+
+    with sqlite3.connect(database) as conn:
+        balance = conn.execute("SELECT balance FROM accounts WHERE username = 'alice'").fetchone()[0]
+        row = conn.execute("SELECT quantity FROM portfolios WHERE username = 'alice'").fetchone()
+        quantity = row[0] if row else 0
+        events = conn.execute("""
+            SELECT username, asset_name, quantity, price, amount FROM ledger_events
+            WHERE username = 'alice' ORDER BY seq
+        """).fetchall()
+        _, rebuilt_balance, rebuilt_positions = server.rebuild_account(conn.cursor(), 'alice')
+
+    start = server.to_micros(1000) - server.to_micros(BOUGHT * PRICE)
+    assert balance == start - withdrawn + revenue >= 0
+    assert quantity == server.to_micros(BOUGHT) - sold >= 0
+    assert lowest['balance'] >= 0 and lowest['quantity'] >= 0
+
+    # No committed prefix of the ledger overdraws the account either
+    accounts = {}
+    for event in events:
+        server.replay_events(accounts, [event])
+        balance_then, positions_then = accounts['alice']
+        assert balance_then >= 0
+        assert all(held > 0 for held, _ in positions_then.values())
+
+    assert rebuilt_balance == balance
+    assert {asset: held for asset, (held, _) in rebuilt_positions.items()} == ({'Bitcoin': quantity} if quantity else {})
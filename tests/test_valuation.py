@@ -0,0 +1,62 @@
+import sqlite3
+
+import pytest
+
+import server
+
+PRICES = {'Shib': 0.0000098, 'Doge': 0.123456789, 'Bitcoin': 12345.678901}
+TICK = {'Shib': 0.0000123, 'Doge': 0.0987654321, 'Bitcoin': 13579.246801}
+BUYS = [('Shib', 1000), ('Shib', 333.333333), ('Doge', 777.777777), ('Bitcoin', 0.012345)]
+
+
+def views(client, headers):
+    """The /portfolio/view and /portfolio/net_worth responses for alice"""
+    body = {'username': 'alice'}
+    view = client.post('/portfolio/view', json=body, headers=headers)
+    net_worth = client.post('/portfolio/net_worth', json=body, headers=headers)
+    assert view.status_code == net_worth.status_code == 200
+    # The database lists holdings by asset name, the cache in the order they were opened
+    portfolio = view.json
+    portfolio['holdings'].sort(key=lambda holding: holding['asset'])
+    return portfolio, net_worth.json
+
+
+@pytest.fixture
+def portfolio(client, add_asset, login, monkeypatch):
+    """alice's auth headers, after buying odd quantities of odd prices without the cache"""
+    monkeypatch.setattr(server, 'valuations', None)
+    for name, price in PRICES.items():
+        add_asset(name, price)
+    headers = login('alice')
+    for name, quantity in BUYS:
+        assert client.post('/trade/buy', json={'asset_name': name, 'quantity': quantity}, headers=headers).status_code == 200
+    return headers
+
+
+def test_cached_and_uncached_views_agree(database, client, portfolio):
+    uncached = views(client, portfolio)
+    assert server.load_valuations() is not None
+    cached = views(client, portfolio)
+
+    assert cached == uncached
+    shib = next(holding for holding in cached[0]['holdings'] if holding['asset'] == 'Shib')
+    assert shib['current_price'] == 0.0000098 and shib['value'] == 0.013067
+
+    # A tick re-marks the cache in one vectorized pass; the database reads the new prices
+    market_data = [{'name': name, 'current_price': price} for name, price in TICK.items()]
+    with sqlite3.connect(database) as conn:
+        conn.executemany("UPDATE assets SET current_price = ? WHERE name = ?", [(price, name) for name, price in TICK.items()])
+    server.apply_market_prices(market_data)
+    cached = views(client, portfolio)
+    server.valuations = None
+    assert views(client, portfolio) == cached
+
+
+def test_cached_and_uncached_snapshots_agree(database, client, portfolio):
+    server.take_portfolio_snapshot(taken_at=1)
+    server.load_valuations()
+    server.take_portfolio_snapshot(taken_at=2)
+
+    with sqlite3.connect(database) as conn:
+        rows = conn.execute("SELECT balance, holdings_value FROM portfolio_snapshots ORDER BY taken_at").fetchall()
+    assert rows[0] == rows[1]
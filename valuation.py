@@ -0,0 +1,252 @@
+import threading
+import numpy as np
+
+# Must match server.MICROS and server.PRICE_SCALE: balances and quantities arrive
+# as integer micro-units, average prices as integer price units
+MICROS = 1_000_000
+PRICE_SCALE = 10 ** 12
+
+
+def position_value(quantity, price):
+    """Value in micro-units of quantity (micro-units) at price (price units)
+
+    The one valuation formula for cached and database reads alike, so both
+    agree to the micro-dollar; remark() does the same float operations
+    vectorized (np.rint rounds half to even like round()).
+    """
+    return round(float(quantity) * (float(price) / PRICE_SCALE))
+
+
+class ValuationCache:
+    """In-memory mark-to-market of every account, updated incrementally
+
+    Positions are kept as a structure of arrays (one slot per
+    user/asset pair) next to a price vector indexed by asset, so a price
+    tick re-marks every position of every user in one vectorized pass::
+
+        values   = quantity[slots] * prices[asset_of[slots]]
+        holdings = bincount(user_of[slots], values)
+
+    Trades only touch the slot they change and adjust the owner's holdings
+    value by the difference. Balances, quantities and holdings values are
+    kept in integer micro-units and prices in integer price units, like the
+    database; positions are valued with position_value().
+    """
+
+    def __init__(self, capacity=1024):
+        self.lock = threading.RLock()
+
+        # Users: username -> row in the per-user arrays
+        self.user_index = {}
+        self.usernames = []
+        self.balances = np.zeros(capacity, dtype=np.int64)
+        self.holdings_value = np.zeros(capacity, dtype=np.int64)
+        self.cost_basis = np.zeros(capacity, dtype=np.float64)
+
+        # Assets: name -> column in the price vector
+        self.asset_index = {}
+        self.asset_names = []
+        self.prices = np.zeros(64, dtype=np.int64)
+
+        # Position slots (structure of arrays); free slots have quantity 0
+        self.slot_user = np.zeros(capacity, dtype=np.int64)
+        self.slot_asset = np.zeros(capacity, dtype=np.int64)
+        self.slot_quantity = np.zeros(capacity, dtype=np.int64)
+        self.slot_avg_price = np.zeros(capacity, dtype=np.int64)
+        self.slot_count = 0
+        self.free_slots = []
+        self.user_slots = {}  # user row -> {asset column: slot}
+
+        # Bumped on every change, so dependants can tell when to recompute
+        self.version = 0
+
+    @staticmethod
+    def _grow(array, size):
+        """Return array enlarged (doubling) to hold at least size entries"""
+        if size <= len(array):
+            return array
+        grown = np.zeros(max(size, 2 * len(array)), dtype=array.dtype)
+        grown[:len(array)] = array
+        return grown
+
+    def _user_row(self, username):
+        row = self.user_index.get(username)
+        if row is None:
+            row = len(self.usernames)
+            self.user_index[username] = row
+            self.usernames.append(username)
+            self.balances = self._grow(self.balances, row + 1)
+            self.holdings_value = self._grow(self.holdings_value, row + 1)
+            self.cost_basis = self._grow(self.cost_basis, row + 1)
+            self.user_slots[row] = {}
+        return row
+
+    def _asset_column(self, asset_name):
+        column = self.asset_index.get(asset_name)
+        if column is None:
+            column = len(self.asset_names)
+            self.asset_index[asset_name] = column
+            self.asset_names.append(asset_name)
+            self.prices = self._grow(self.prices, column + 1)
+        return column
+
+    def _slot_value(self, slot):
+        """Current value of one slot (micro-units)"""
+        return position_value(self.slot_quantity[slot], self.prices[self.slot_asset[slot]])
+
+    def _slot_cost(self, slot):
+        """Dollar cost basis of one slot"""
+        return float(self.slot_quantity[slot]) * float(self.slot_avg_price[slot]) / MICROS / PRICE_SCALE
+
+    def load(self, accounts, positions, prices):
+        """Bulk load (username, balance), (username, asset, quantity, avg_price) and {asset: price units}"""
+        with self.lock:
+            # Resolve the index first: it may grow (replace) the array
+            for asset_name, price in prices.items():
+                column = self._asset_column(asset_name)
+                self.prices[column] = price
+            for username, balance in accounts:
+                row = self._user_row(username)
+                self.balances[row] = balance
+            for username, asset_name, quantity, avg_price in positions:
+                self.set_position(username, asset_name, quantity, avg_price)
+            self.remark()
+
+    def set_balance(self, username, balance):
+        """Record a user's new balance (micro-units)"""
+        with self.lock:
+            row = self._user_row(username)
+            self.balances[row] = balance
+            self.version += 1
+
+    def set_position(self, username, asset_name, quantity, avg_price):
+        """Record a position's new quantity (micro-units) and average price (price units)"""
+        with self.lock:
+            row = self._user_row(username)
+            column = self._asset_column(asset_name)
+            slots = self.user_slots[row]
+            slot = slots.get(column)
+
+            # Remove the old contribution to the user's totals
+            if slot is not None:
+                self.holdings_value[row] -= self._slot_value(slot)
+                self.cost_basis[row] -= self._slot_cost(slot)
+
+            if quantity <= 0:
+                # Position closed: free the slot
+                if slot is not None:
+                    self.slot_quantity[slot] = 0
+                    self.slot_avg_price[slot] = 0
+                    del slots[column]
+                    self.free_slots.append(slot)
+            else:
+                if slot is None:
+                    slot = self._allocate_slot()
+                    slots[column] = slot
+                    self.slot_user[slot] = row
+                    self.slot_asset[slot] = column
+                self.slot_quantity[slot] = quantity
+                self.slot_avg_price[slot] = avg_price
+                self.holdings_value[row] += self._slot_value(slot)
+                self.cost_basis[row] += self._slot_cost(slot)
+            self.version += 1
+
+    def set_account(self, username, balance, positions):
+        """Replace a user's balance and all positions ([(asset, quantity, avg_price)])"""
+        with self.lock:
+            row = self._user_row(username)
+            closed = {self.asset_names[column] for column in self.user_slots[row]}
+            self.set_balance(username, balance)
+            for asset_name, quantity, avg_price in positions:
+                self.set_position(username, asset_name, quantity, avg_price)
+                closed.discard(asset_name)
+            for asset_name in closed:
+                self.set_position(username, asset_name, 0, 0)
+
+    def _allocate_slot(self):
+        if self.free_slots:
+            return self.free_slots.pop()
+        slot = self.slot_count
+        self.slot_count += 1
+        if slot >= len(self.slot_quantity):
+            size = slot + 1
+            self.slot_user = self._grow(self.slot_user, size)
+            self.slot_asset = self._grow(self.slot_asset, size)
+            self.slot_quantity = self._grow(self.slot_quantity, size)
+            self.slot_avg_price = self._grow(self.slot_avg_price, size)
+        return slot
+
+    def mark(self, prices):
+        """Apply a price tick ({asset: price units}) and re-mark every position"""
+        with self.lock:
+            for asset_name, price in prices.items():
+                if price is not None:
+                    column = self._asset_column(asset_name)
+                    self.prices[column] = price
+            self.remark()
+
+    def remark(self):
+        """Recompute every user's holdings value in one vectorized pass"""
+        with self.lock:
+            n = self.slot_count
+            users = len(self.usernames)
+            quantity = self.slot_quantity[:n].astype(np.float64)
+            values = np.rint(quantity * (self.prices[self.slot_asset[:n]].astype(np.float64) / PRICE_SCALE))
+            costs = quantity / MICROS * self.slot_avg_price[:n] / PRICE_SCALE
+            # Free slots have quantity 0 and contribute nothing; the sums of
+            # whole micro-units are exact in float64 below 2**53 ($9 billion)
+            holdings = np.bincount(self.slot_user[:n], weights=values, minlength=users)[:users]
+            self.holdings_value[:users] = np.rint(holdings).astype(np.int64)
+            self.cost_basis[:users] = np.bincount(self.slot_user[:n], weights=costs, minlength=users)[:users]
+            self.version += 1
+
+    def has_user(self, username):
+        with self.lock:
+            return username in self.user_index
+
+    def net_worth(self, username):
+        """Return (balance, holdings value, net worth) in dollars, or None"""
+        with self.lock:
+            row = self.user_index.get(username)
+            if row is None:
+                return None
+            balance = int(self.balances[row])
+            holdings = int(self.holdings_value[row])
+            return balance / MICROS, holdings / MICROS, (balance + holdings) / MICROS
+
+    def net_worths(self):
+        """Return (usernames, net worth array) for every cached user"""
+        with self.lock:
+            users = len(self.usernames)
+            values = (self.balances[:users] + self.holdings_value[:users]) / MICROS
+            return list(self.usernames), values
+
+    def portfolio(self, username):
+        """Return the /portfolio/view payload for a user, or None if unknown"""
+        with self.lock:
+            row = self.user_index.get(username)
+            if row is None:
+                return None
+
+            holdings = []
+            for column, slot in self.user_slots[row].items():
+                quantity = int(self.slot_quantity[slot])
+                avg_price = int(self.slot_avg_price[slot])
+                current_price = int(self.prices[column])
+                holdings.append({
+                    "asset": self.asset_names[column],
+                    "quantity": quantity / MICROS,
+                    "avg_purchase_price": avg_price / PRICE_SCALE,
+                    "current_price": current_price / PRICE_SCALE,
+                    "value": self._slot_value(slot) / MICROS,
+                    "profit_loss_percentage": ((current_price - avg_price) / avg_price * 100) if avg_price > 0 else 0
+                })
+
+            balance = int(self.balances[row])
+            total_value = int(self.holdings_value[row])
+            return {
+                "holdings": holdings,
+                "total_portfolio_value": total_value / MICROS,
+                "account_balance": balance / MICROS,
+                "total_net_worth": (total_value + balance) / MICROS
+            }